@@ -0,0 +1,387 @@
+"""
+Storage backends that encrypted files are written to and read back from by name (see BaseCellar.encrypt_to).
+LocalBackend keeps them as files under a directory (the default), ObjectBackend as objects of an S3 compatible bucket,
+uploaded in parts concurrently while they are encrypted so nothing is staged on disk.
+LocalObjectClient stands in for an S3 server by keeping its buckets in a local directory, for tests and dry runs
+"""
+import os
+import time
+import asyncio
+from uuid import uuid4
+from io import BytesIO
+from hashlib import md5
+from shutil import rmtree
+from threading import Lock
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+
+import aiofiles
+
+from .exceptions import CellarError
+
+
+class Backend:
+    """
+    Base of the storage backends. Names are relative POSIX paths
+    """
+
+    async def writer(self, name):
+        """
+        Writer of the named object, with write(data), close() to commit it and abort() to drop it
+        """
+        raise NotImplementedError
+
+    async def reader(self, name):
+        """
+        Coroutine reading size bytes of the named object at a time
+        """
+        raise NotImplementedError
+
+    async def names(self):
+        """
+        Names of all the objects in the backend
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+#: Suffix of the temp files objects are written to before they are committed
+TMP_SUFFIX = '.cellar-tmp'
+
+
+class LocalWriter:
+    def __init__(self, path):
+        self.path = path
+        self.tmpfile = path.with_name(f'.{path.name}.{uuid4().hex}{TMP_SUFFIX}')
+        self.file = None
+
+    async def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = await aiofiles.open(self.tmpfile, 'wb')
+        return self
+
+    async def write(self, data):
+        await self.file.write(data)
+
+    async def close(self):
+        await self.file.close()
+        self.tmpfile.replace(self.path)
+
+    async def abort(self):
+        await self.file.close()
+        self.tmpfile.unlink()
+
+
+class LocalBackend(Backend):
+    """
+    Files under the root directory
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def __repr__(self):
+        return f'<LocalBackend {self.root}>'
+
+    async def writer(self, name):
+        return await LocalWriter(self.root.joinpath(*PurePosixPath(name).parts)).open()
+
+    async def reader(self, name):
+        fileobj = await aiofiles.open(self.root.joinpath(*PurePosixPath(name).parts), 'rb')
+
+        async def read(size):
+            data = await fileobj.read(size)
+            if not data:
+                await fileobj.close()
+            return data
+        return read
+
+    async def names(self):
+        return sorted(path.relative_to(self.root).as_posix() for path in self.root.rglob('*')
+                      if path.is_file() and not path.name.endswith(TMP_SUFFIX))
+
+
+class MultipartWriter:
+    """
+    Buffers the data written to it into parts of part_size and uploads them concurrently while more is written.
+    Objects smaller than one part are uploaded with a single put
+    """
+
+    def __init__(self, backend, key):
+        self.backend = backend
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.tasks = []
+
+    async def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.backend.part_size:
+            part = bytes(self.buffer[:self.backend.part_size])
+            del self.buffer[:self.backend.part_size]
+            await self.upload(part)
+
+    async def upload(self, part):
+        for task in self.tasks:
+            if task.done() and task.exception() is not None:
+                raise task.exception()
+        backend = self.backend
+        if self.upload_id is None:
+            response = await backend.call('create_multipart_upload', Key=self.key)
+            self.upload_id = response['UploadId']
+        self.parts.append(None)
+        number = len(self.parts)
+        # bounds the parts in flight (and their memory) across all the files of the backend
+        await backend.slots.acquire()
+
+        async def upload_part():
+            response = await backend.call('upload_part', Key=self.key, UploadId=self.upload_id, PartNumber=number,
+                                          Body=part)
+            self.parts[number - 1] = {'ETag': response['ETag'], 'PartNumber': number}
+
+        task = asyncio.ensure_future(upload_part())
+        # released even if the task is cancelled before it starts
+        task.add_done_callback(lambda _: backend.slots.release())
+        self.tasks.append(task)
+
+    async def close(self):
+        if self.upload_id is None:
+            return await self.backend.call('put_object', Key=self.key, Body=bytes(self.buffer))
+        if self.buffer:
+            await self.upload(bytes(self.buffer))
+        await asyncio.gather(*self.tasks)
+        await self.backend.call('complete_multipart_upload', Key=self.key, UploadId=self.upload_id,
+                                MultipartUpload={'Parts': self.parts})
+
+    async def abort(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.upload_id is not None:
+            await self.backend.call('abort_multipart_upload', Key=self.key, UploadId=self.upload_id)
+
+
+class ObjectBackend(Backend):
+    """
+    Objects of an S3 compatible bucket under prefix, through a client with the boto3 S3 client methods.
+    The blocking client calls run in a pool of `concurrency` threads (the size of the connection pool of the client)
+    and up to that many parts of part_size are uploaded or in memory at once.
+    S3 needs parts of at least 5 MiB
+    """
+
+    def __init__(self, client, bucket, prefix='', part_size=8 * 2 ** 20, concurrency=8):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency)
+        self._slots = None
+
+    def __repr__(self):
+        return f'<ObjectBackend {self.bucket}/{self.prefix}>'
+
+    @property
+    def slots(self):
+        """
+        Semaphore bounding the parts in flight. Made in the running loop since it belongs to the loop it was made in
+        and the backend is made before the cellar starts its own
+        """
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots[0] is not loop:
+            self._slots = loop, asyncio.Semaphore(self.concurrency)
+        return self._slots[1]
+
+    def key(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    async def call(self, method, **kwargs):
+        func = getattr(self.client, method)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: func(Bucket=self.bucket, **kwargs))
+
+    async def writer(self, name):
+        return MultipartWriter(self, self.key(name))
+
+    async def reader(self, name):
+        """
+        Reads the object by ranges of part_size, the next range is downloaded while the current one is read
+        """
+        key = self.key(name)
+        size = (await self.call('head_object', Key=key))['ContentLength']
+        ranges = iter(range(0, size, self.part_size))
+        buffer = bytearray()
+
+        async def fetch():
+            start = next(ranges, None)
+            if start is None:
+                return None
+            end = min(start + self.part_size, size) - 1
+            response = await self.call('get_object', Key=key, Range=f'bytes={start}-{end}')
+            return await asyncio.get_running_loop().run_in_executor(self.executor, response['Body'].read)
+
+        pending = asyncio.ensure_future(fetch())
+
+        async def read(size):
+            nonlocal pending
+            while len(buffer) < size and pending is not None:
+                data = await pending
+                if data is None:
+                    pending = None
+                    break
+                buffer.extend(data)
+                pending = asyncio.ensure_future(fetch())
+            data = bytes(buffer[:size])
+            del buffer[:size]
+            return data
+        return read
+
+    async def names(self):
+        names, token = [], None
+        prefix = f'{self.prefix}/' if self.prefix else ''
+        while True:
+            kwargs = {'Prefix': prefix} if token is None else {'Prefix': prefix, 'ContinuationToken': token}
+            response = await self.call('list_objects_v2', **kwargs)
+            names.extend(item['Key'][len(prefix):] for item in response.get('Contents', ()))
+            if not response.get('IsTruncated'):
+                return sorted(names)
+            token = response['NextContinuationToken']
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class LocalObjectClient:
+    """
+    Stand-in for an S3 server with the boto3 client methods ObjectBackend calls,
+    keeping objects as files under root/bucket and the parts of multipart uploads under root/.uploads.
+    Each part takes latency seconds to upload, like over a network.
+    Counts the calls of each method and the most parts it had uploading at once
+    """
+
+    def __init__(self, root, latency=0):
+        self.root = Path(root)
+        self.latency = latency
+        self.calls = {}
+        self.uploading = self.max_uploading = 0
+        self._lock = Lock()
+
+    def __repr__(self):
+        return f'<LocalObjectClient {self.root}>'
+
+    def count(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+    def path(self, bucket, key):
+        parts = PurePosixPath(key).parts
+        if not parts or '..' in parts or PurePosixPath(key).is_absolute():
+            raise CellarError(f'Invalid object key {key!r}')
+        return self.root.joinpath(bucket, *parts)
+
+    def put(self, path, chunks):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmpfile = path.with_name(f'.{path.name}.{uuid4().hex}{TMP_SUFFIX}')
+        with open(tmpfile, 'wb') as fo:
+            for chunk in chunks:
+                fo.write(chunk)
+        os.replace(tmpfile, path)
+
+    def put_object(self, Bucket, Key, Body):
+        self.count('put_object')
+        self.put(self.path(Bucket, Key), [Body])
+        return {'ETag': f'"{md5(Body).hexdigest()}"'}
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.count('create_multipart_upload')
+        upload_id = uuid4().hex
+        (self.root / '.uploads' / upload_id).mkdir(parents=True)
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.count('upload_part')
+        with self._lock:
+            self.uploading += 1
+            self.max_uploading = max(self.max_uploading, self.uploading)
+        try:
+            time.sleep(self.latency)
+            (self.root / '.uploads' / UploadId / str(PartNumber)).write_bytes(Body)
+        finally:
+            with self._lock:
+                self.uploading -= 1
+        return {'ETag': f'"{md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.count('complete_multipart_upload')
+        upload = self.root / '.uploads' / UploadId
+        parts = []
+        for expected, part in enumerate(MultipartUpload['Parts'], 1):
+            data = (upload / str(part['PartNumber'])).read_bytes()
+            if part['PartNumber'] != expected or part['ETag'] != f'"{md5(data).hexdigest()}"':
+                raise CellarError(f'Invalid part {part} of upload {UploadId}')
+            parts.append(data)
+        self.put(self.path(Bucket, Key), parts)
+        rmtree(upload)
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.count('abort_multipart_upload')
+        rmtree(self.root / '.uploads' / UploadId, ignore_errors=True)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        self.count('head_object')
+        return {'ContentLength': self.path(Bucket, Key).stat().st_size}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.count('get_object')
+        with open(self.path(Bucket, Key), 'rb') as fi:
+            if Range is None:
+                return {'Body': BytesIO(fi.read())}
+            start, end = map(int, Range[len('bytes='):].split('-'))
+            fi.seek(start)
+            return {'Body': BytesIO(fi.read(end - start + 1))}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000):
+        self.count('list_objects_v2')
+        bucket = self.root / Bucket
+        keys = sorted(path.relative_to(bucket).as_posix() for path in bucket.rglob('*')
+                      if path.is_file() and not path.name.endswith(TMP_SUFFIX))
+        keys = [key for key in keys
+                if key.startswith(Prefix) and (ContinuationToken is None or key > ContinuationToken)]
+        page = keys[:MaxKeys]
+        response = {'Contents': [{'Key': key} for key in page], 'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+
+def s3_client(endpoint_url=None, max_connections=8):
+    """
+    boto3 S3 client keeping up to max_connections connections open. A file:// endpoint is served by a LocalObjectClient
+    """
+    if endpoint_url and endpoint_url.startswith('file://'):
+        return LocalObjectClient(urlparse(endpoint_url).path)
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        raise CellarError('The s3 backend needs boto3, install it with pip install pynacl-cellar[s3]')
+    return boto3.client('s3', endpoint_url=endpoint_url, config=Config(max_pool_connections=max_connections))
+
+
+def backend_for(url, endpoint_url=None, part_size=8 * 2 ** 20, concurrency=8):
+    """
+    Backend of an s3://bucket/prefix url or a local directory
+    """
+    parsed = urlparse(str(url))
+    if parsed.scheme == 's3':
+        client = s3_client(endpoint_url, concurrency)
+        return ObjectBackend(client, parsed.netloc, parsed.path, part_size, concurrency)
+    if parsed.scheme not in ('', 'file'):
+        raise CellarError(f'Unsupported storage {url}')
+    return LocalBackend(parsed.path if parsed.scheme else url)
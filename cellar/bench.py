@@ -0,0 +1,193 @@
+"""
+Benchmarks for cellar throughput.
+Generates synthetic trees, runs the cellars over them with every combination of cipher engine, block size
+and concurrency and reports MB/s, files/s, ciphertext overhead, peak RSS sampled during each run
+and per-file latency percentiles
+"""
+import asyncio
+from time import perf_counter
+from random import Random
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from itertools import product
+
+from nacl.utils import random as random_bytes
+
+from .crypt import OverwritePathCellar, EncryptedPathCellar, walk
+from .engines import ENGINES
+from .exceptions import CellarError
+from .log import logger
+from .tune import rss
+
+#: name: (number of files, (min size, max size), directory depth)
+PROFILES = {
+    'tiny': (5000, (0, 4096), 2),
+    'huge': (2, (256 * 2 ** 20, 256 * 2 ** 20), 0),
+    'mixed': (1000, (0, 8 * 2 ** 20), 6),
+}
+
+TARGETS = {
+    'overwrite': OverwritePathCellar,
+    'encrypted-path': EncryptedPathCellar,
+    'stream': OverwritePathCellar,
+}
+
+
+class NullStream:
+    def write(self, data):
+        return len(data)
+
+
+def make_tree(root, profile, scale=1.0, seed=0):
+    """
+    Generates the synthetic tree of a profile under root.
+    scale multiplies the number and size of the files for quicker (or bigger) runs
+    """
+    files, (low, high), depth = PROFILES[profile]
+    rand = Random(seed)
+    block = random_bytes(2 ** 20)
+    root = Path(root) / profile
+    for number in range(max(int(files * scale), 1)):
+        parts = [f'd{rand.randrange(4)}' for _ in range(rand.randint(0, depth))]
+        path = root.joinpath(*parts, f'f{number}')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size = int(rand.randint(low, high) * scale)
+        with open(path, 'wb') as fo:
+            while size > 0:
+                size -= fo.write(block[:size])
+    return root
+
+
+def percentiles(values, points=(50, 90, 99, 100)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f'p{point}': values[min(len(values) - 1, len(values) * point // 100)] * 1000 for point in points}
+
+
+async def sample_rss(main, interval=0.01):
+    """
+    Runs the main coroutine while sampling the resident memory of the process every interval seconds.
+    Returns its result and the highest sample in KiB, None if the memory is not known.
+    Where only the peak of the whole process is known (see tune.rss), that is what is returned
+    """
+    samples = []
+
+    async def sample():
+        while True:
+            samples.append(rss())
+            await asyncio.sleep(interval)
+
+    sampler = asyncio.ensure_future(sample())
+    try:
+        result = await main
+    finally:
+        sampler.cancel()
+    samples = [sample for sample in samples + [rss()] if sample is not None]
+    return result, max(samples) // 1024 if samples else None
+
+
+def time_method(cellar, method, latencies):
+    """
+    Wraps a cellar method to record how long each call took
+    """
+    func = getattr(cellar, method)
+
+    async def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.append(perf_counter() - start)
+
+    setattr(cellar, method, wrapper)
+
+
+async def run_tree(cellar, tree, encrypt):
+    method = 'encrypt' if encrypt else 'decrypt'
+    latencies = []
+    if not cellar.processes:
+        # the timing wrapper does not make it to shard worker processes
+        time_method(cellar, f'{method}_file', latencies)
+    result = await getattr(cellar, f'{method}_dir')(tree)
+    return latencies, result or tree
+
+
+async def run_stream(cellar, tree, encrypt):
+    path = max(walk(tree), key=lambda path: path.stat().st_size)
+    cipherfile = tree.with_name(f'{tree.name}.stream')
+    start = perf_counter()
+    if encrypt:
+        with open(path, 'rb') as instream, open(cipherfile, 'wb') as outstream:
+            await cellar.encrypt_stream(instream, outstream)
+    else:
+        with open(cipherfile, 'rb') as instream:
+            await cellar.decrypt_stream(instream, NullStream())
+        cipherfile.unlink()
+    return [perf_counter() - start], tree
+
+
+def output_size(target, tree):
+    """
+    Bytes of ciphertext a run wrote, to compare the overhead of the engines
+    """
+    if target == 'stream':
+        return tree.with_name(f'{tree.name}.stream').stat().st_size
+    return sum(path.stat().st_size for path in walk(tree))
+
+
+def bench(profiles=tuple(PROFILES), targets=tuple(TARGETS), block_sizes=(2 ** 16, 2 ** 20), concurrencies=(10, 100),
+          engines=tuple(ENGINES), scale=1.0, directory=None, key=None, **options):
+    """
+    Runs every combination of profile, target, engine, block size and concurrency and returns a list of result dicts.
+    Trees are generated in a temporary directory under directory (defaults to the system temp dir).
+    Extra options are passed to the cellars, engines the options do not support (like secretstream with
+    seekable containers) are skipped
+    """
+    key = key or random_bytes(32)
+    # swept per run instead
+    for name in ('engine', 'block_size', 'concurrency'):
+        options.pop(name, None)
+    results = []
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        with TemporaryDirectory(dir=directory) as tmpdir:
+            for profile in profiles:
+                tree = make_tree(tmpdir, profile, scale)
+                sizes = [path.stat().st_size for path in walk(tree)]
+                for target, engine, block_size, concurrency in product(targets, engines, block_sizes, concurrencies):
+                    try:
+                        cellar = TARGETS[target](key, block_size=block_size, concurrency=concurrency, engine=engine,
+                                                 **options)
+                    except CellarError as exc:
+                        logger.warning(f'Skipping {engine}: {exc}')
+                        continue
+                    if target == 'stream':
+                        run, files, size = run_stream, 1, max(sizes)
+                    else:
+                        run, files, size = run_tree, len(sizes), sum(sizes)
+                    for encrypt in (True, False):
+                        start = perf_counter()
+                        (latencies, tree), peak = loop.run_until_complete(sample_rss(run(cellar, tree, encrypt)))
+                        seconds = perf_counter() - start
+                        results.append({
+                            'profile': profile,
+                            'target': target,
+                            'operation': 'encrypt' if encrypt else 'decrypt',
+                            'engine': engine,
+                            'block_size': block_size,
+                            'concurrency': concurrency,
+                            'files': files,
+                            'bytes': size,
+                            'overhead': output_size(target, tree) - size if encrypt else None,
+                            'seconds': seconds,
+                            'mb_per_s': size / seconds / 2 ** 20,
+                            'files_per_s': files / seconds,
+                            'latency_ms': percentiles(latencies),
+                            'peak_rss_kb': peak,
+                        })
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    return results
@@ -0,0 +1,96 @@
+"""
+Reusable chunk buffers for the buffer engine (see BaseCellar.buffered_crypto).
+Chunks are read with preadv into preallocated buffers and en/decrypted by the libsodium
+crypto_secretbox_easy primitives straight into preallocated output buffers, so no bytes, EncryptedMessage
+or nonce objects are allocated per chunk. Raw chunks are the same as the ones SecretBox writes::
+
+    nonce(24) MAC(16) ciphertext
+"""
+import os
+import struct
+from itertools import count
+
+from nacl._sodium import ffi, lib
+from nacl.exceptions import CryptoError
+from nacl.secret import SecretBox
+
+
+COUNTER = struct.Struct('<Q')
+
+
+class NonceSequence:
+    """
+    Nonces made of a random prefix and a little endian counter, unique without reading random bytes for every chunk.
+    The prefix is drawn again when the counter runs out and in every process the sequence is copied to (pickled),
+    so shard workers never reuse nonces of each other
+    """
+    prefix_size = SecretBox.NONCE_SIZE - COUNTER.size
+    limit = 2 ** (8 * COUNTER.size)
+
+    def __init__(self):
+        self.reset()
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.reset()
+
+    def reset(self):
+        self.prefix = os.urandom(self.prefix_size)
+        self.counter = count()
+
+    def write(self, buffer, offset=0):
+        """
+        Writes the next nonce into buffer at offset
+        """
+        number = next(self.counter)
+        if number >= self.limit:
+            self.reset()
+            number = next(self.counter)
+        buffer[offset:offset + self.prefix_size] = self.prefix
+        COUNTER.pack_into(buffer, offset + self.prefix_size, number)
+
+
+class Slot:
+    """
+    Input and output buffers of one chunk in flight, with their cffi pointers made once
+    """
+
+    def __init__(self, insize, outsize):
+        self.input = bytearray(insize)
+        self.output = bytearray(outsize)
+        self.inview = memoryview(self.input)
+        self.outview = memoryview(self.output)
+        self.inptr = ffi.from_buffer(self.input)
+        self.outptr = ffi.from_buffer(self.output, require_writable=True)
+
+    def read(self, fd, size, offset):
+        """
+        Reads up to size bytes of fd at offset into the input buffer, returns the number of bytes read
+        """
+        return os.preadv(fd, [self.inview[:size]], offset)
+
+    def encrypt(self, key, nonces, size):
+        """
+        Encrypts size bytes of the input buffer into the output buffer after a new nonce.
+        Returns the size of the chunk in the output buffer
+        """
+        nonces.write(self.output)
+        nonce_size = SecretBox.NONCE_SIZE
+        lib.crypto_secretbox_easy(self.outptr + nonce_size, self.inptr, size, self.outptr, key)
+        return nonce_size + SecretBox.MACBYTES + size
+
+    def decrypt(self, key, size):
+        """
+        Authenticates and decrypts the chunk of size bytes in the input buffer into the output buffer.
+        Returns the size of the plaintext
+        """
+        overhead = SecretBox.NONCE_SIZE + SecretBox.MACBYTES
+        if size < overhead:
+            raise CryptoError('Input ciphertext is too short')
+        nonce_size = SecretBox.NONCE_SIZE
+        if lib.crypto_secretbox_open_easy(self.outptr, self.inptr + nonce_size, size - nonce_size,
+                                          self.inptr, key):
+            raise CryptoError('Decryption failed. Ciphertext failed verification')
+        return size - overhead
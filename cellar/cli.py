@@ -1,14 +1,24 @@
 import click
 import sys
+import json
 from pathlib import Path
 import asyncio
+from datetime import datetime
 
 
-from cellar.crypt import OverwritePathCellar as Cellar, DecryptionError
-from cellar.log import setup
+from cellar.crypt import OverwritePathCellar as Cellar, EncryptedPathCellar, stream_writer
+from cellar.engines import ENGINES
+from cellar.exceptions import CellarError
+from cellar.stats import progress_line
+from cellar.log import setup, shutdown
+from cellar.backends import backend_for
+from cellar.bench import bench as run_bench, PROFILES, TARGETS
 from cellar import __version__ as pkg
 
 
+#: Commands that do not need the secret key
+KEYLESS_COMMANDS = ('bench',)
+
 USAGE = """
 Toolkit for encrypting/decrypting files and directories using symetric (secret key) encryption.
 Requires a secret key to be passed either by file, prompt or read from stdin.
@@ -23,39 +33,287 @@ If key is too long, it will be truncated.
 @click.option('-v', '--verbosity', default=1, count=True, help='Output level WARN/INFO/DEBUG')
 @click.option('-l', '--log-file', envvar='CELLAR_LOGFILE', type=click.File('w'),
               help='File path to write logs to')
+@click.option('--log-json', envvar='CELLAR_LOG_JSON', is_flag=True, help='Write logs as one JSON object per line')
 @click.option('-k', '--key-file', envvar='CELLAR_KEYFILE', type=click.File('rb'),
               help='File path to use for secret key or CELLAR_KEYFILE env var')
 @click.option('-p', '--key-phrase', envvar='CELLAR_KEYPHRASE', default=None,
               help='Text to use as secret key. Use "-" to read from stdin. Do NOT type your key via command line! It will show in your shell history')
 @click.option('-P', '--key-prompt', is_flag=True,
               help='Prompt for the secret key (default)')
+@click.option('-b', '--block-size', envvar='CELLAR_BLOCK_SIZE', default=2 ** 20, type=click.IntRange(1),
+              help='Bytes of plaintext per chunk. Raw chunks only decrypt with the block size they were encrypted with')
+@click.option('-c', '--concurrency', envvar='CELLAR_CONCURRENCY', default=100, type=click.IntRange(1),
+              help='Most files en/decrypted at once')
+@click.option('-a', '--auto-tune', envvar='CELLAR_AUTO_TUNE', is_flag=True,
+              help='Pick the block size of each file from its size and move the files in flight with the throughput, '
+                   'up to --concurrency. Implies --seekable, so the block sizes are recorded')
+@click.option('--max-rss', envvar='CELLAR_MAX_RSS', default=None, type=click.IntRange(1),
+              help='Bytes of resident memory --auto-tune keeps the process under by lowering the files in flight')
+@click.option('-w', '--workers', envvar='CELLAR_WORKERS', default=0, type=click.IntRange(0),
+              help='Number of threads to run chunk encryption in parallel. 0 runs it on the event loop')
+@click.option('-j', '--processes', envvar='CELLAR_PROCESSES', default=0, type=click.IntRange(0),
+              help='Number of processes to shard directory encryption across. 0 runs it in this process')
+@click.option('-m', '--mmap-size', envvar='CELLAR_MMAP_SIZE', default=None, type=click.IntRange(1),
+              help='Memory map files of at least this many bytes and write chunks to preallocated output')
+@click.option('-B', '--buffers', envvar='CELLAR_BUFFERS', default=0, type=click.IntRange(0),
+              help='Number of reusable chunk buffers to en/decrypt files through with the libsodium primitives. 0 disables')
+@click.option('-s', '--seekable', 'container', envvar='CELLAR_SEEKABLE', is_flag=True,
+              help='Encrypt into the seekable container format with a header and chunk index')
+@click.option('-M', '--manifest', envvar='CELLAR_MANIFEST', is_flag=True,
+              help='Keep an encrypted manifest next to directories and skip files unchanged since the last run')
+@click.option('-D', '--delta', envvar='CELLAR_DELTA', is_flag=True,
+              help='Only re-encrypt the changed chunks of files that were encrypted before. '
+                   'Needs encrypted names and --keep, implies --manifest')
+@click.option('--dedup', 'store', envvar='CELLAR_DEDUP', type=click.Path(file_okay=False, path_type=Path),
+              help='Chunk store to deduplicate files into, each file becomes a recipe of its chunks')
+@click.option('-J', '--journal', envvar='CELLAR_JOURNAL', is_flag=True,
+              help='Keep an encrypted journal next to directories so an interrupted run resumes where it stopped')
+@click.option('-r', '--read-ahead', envvar='CELLAR_READ_AHEAD', default=0, type=click.IntRange(0),
+              help='Number of blocks to read ahead and en/decrypt in parallel while writing, for streams and files')
+@click.option('-e', '--engine', envvar='CELLAR_ENGINE', default='secretbox', type=click.Choice(list(ENGINES)),
+              help='Cipher of the chunks: independent secretbox chunks or chained secretstream ones with less overhead')
+@click.option('-N', '--names', envvar='CELLAR_NAMES', default='plain',
+              type=click.Choice(['plain', 'random', 'deterministic']),
+              help='Keep file names as they are (plain) or encrypt them with random or deterministic nonces')
+@click.option('-K', '--keep', is_flag=True,
+              help='Keep the sources of paths en/decrypted with encrypted names')
+@click.option('-z', '--compress', 'compression', envvar='CELLAR_COMPRESS', default=None,
+              type=click.Choice(['zlib', 'lzma', 'bz2']),
+              help='Compress each chunk before encrypting it. Implies --seekable, decryption detects it')
+@click.option('--level', 'compression_level', envvar='CELLAR_COMPRESS_LEVEL', default=None, type=click.IntRange(0, 9),
+              help='Compression level, defaults to the one of the codec')
+@click.option('--progress', envvar='CELLAR_PROGRESS', default=0, type=click.FloatRange(0),
+              help='Print a progress line with throughput and time per phase to stderr every this many seconds')
+@click.option('--stats-json', type=click.File('w'), help='File to write the final run stats to as JSON')
 @click.pass_context
-def cli(ctx, key_prompt, key_phrase, key_file, log_file, verbosity):
+def cli(ctx, key_prompt, key_phrase, key_file, log_file, log_json, verbosity, names, keep, stats_json, **options):
     ctx.ensure_object(object)
-    setup(verbosity, log_file)
+    setup(verbosity, log_file, log_json)
+    ctx.call_on_close(shutdown)
+    ctx.meta['options'] = options
+    if ctx.invoked_subcommand in KEYLESS_COMMANDS:
+        return
     if key_prompt:
         secret = click.prompt('Secret key', hide_input=True, err=True).encode()
     elif key_phrase:
         secret = sys.stdin.buffer.read() if key_phrase == '-' else key_phrase.encode()
     elif key_file:
         secret = key_file.read()
-    ctx.obj = Cellar(secret)
+    try:
+        if names == 'plain':
+            if keep:
+                raise CellarError('--keep needs encrypted names')
+            ctx.obj = Cellar(secret, **options)
+        else:
+            ctx.obj = EncryptedPathCellar(secret, deterministic=names == 'deterministic', keep=keep, **options)
+    except CellarError as exc:
+        ctx.fail(str(exc))
+    if options['progress']:
+        ctx.obj.stats.subscribe(lambda snapshot: click.echo(progress_line(snapshot), err=True))
+    if stats_json:
+        ctx.call_on_close(lambda: json.dump(ctx.obj.stats.snapshot(), stats_json, indent=2))
+
+
+def backend_options(func):
+    "Options of the storage backends of encrypt --to and decrypt --from"
+    options = [
+        click.option('--endpoint', envvar='CELLAR_ENDPOINT', default=None,
+                     help='Endpoint URL of the S3 compatible server, file:///DIR to keep the buckets in DIR'),
+        click.option('--part-size', envvar='CELLAR_PART_SIZE', default=8 * 2 ** 20, type=click.IntRange(1),
+                     help='Bytes of the parts objects are uploaded and downloaded by'),
+        click.option('--uploads', envvar='CELLAR_UPLOADS', default=8, type=click.IntRange(1),
+                     help='Number of parts uploaded at once (and connections to the server)'),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+def run_backend(ctx, url, endpoint, part_size, uploads, coro):
+    "Runs coro(backend) against the storage backend of url"
+    try:
+        backend = backend_for(url, endpoint, part_size, uploads)
+    except CellarError as exc:
+        ctx.fail(str(exc))
+    try:
+        return ctx.obj.run(coro(backend))
+    finally:
+        backend.close()
 
 
 @cli.command()
 @click.argument('paths', nargs=-1, type=click.Path(exists=True, allow_dash=True, path_type=Path), required=True)
+@click.option('--to-stream', is_flag=True, help='Encrypt one directory into a single stream on stdout')
+@click.option('--to', 'url', default=None,
+              help='Write the encrypted files to this storage instead: s3://BUCKET/PREFIX or a directory')
+@backend_options
 @click.pass_context
-def encrypt(ctx, paths):
+def encrypt(ctx, paths, to_stream, url, endpoint, part_size, uploads):
     "Encrypts given paths. Can be either files or directories"
-    ctx.obj(paths)
+    if url is not None:
+        return run_backend(ctx, url, endpoint, part_size, uploads, lambda backend: ctx.obj.encrypt_to(paths, backend))
+    if not to_stream:
+        return ctx.obj(paths)
+    if len(paths) != 1 or not paths[0].is_dir():
+        ctx.fail('--to-stream takes one directory')
+    ctx.obj.run(ctx.obj.pack_stream(paths[0]))
 
 
 @cli.command()
-@click.argument('paths', nargs=-1, type=click.Path(exists=True, allow_dash=True, path_type=Path), required=True)
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, allow_dash=True, path_type=Path))
+@click.option('--from-stream', 'outdir', type=click.Path(file_okay=False, path_type=Path),
+              help='Rebuild the directory of a stream encrypted with --to-stream from stdin into this directory')
+@click.option('--only', multiple=True,
+              help='Only decrypt this file or directory (relative to the encrypted directory), found through its index')
+@click.option('--from', 'url', default=None,
+              help='Read the files encrypted with encrypt --to from this storage: s3://BUCKET/PREFIX or a directory')
+@click.option('-C', '--directory', default='.', type=click.Path(file_okay=False, path_type=Path),
+              help='Directory to decrypt the files of --from into')
+@backend_options
 @click.pass_context
-def decrypt(ctx, paths):
+def decrypt(ctx, paths, outdir, only, url, directory, endpoint, part_size, uploads):
     "Decrypts given paths. Can be either files or directories"
-    ctx.obj(paths, False)
+    if url is not None:
+        if paths or outdir is not None:
+            ctx.fail('--from takes no paths')
+        return run_backend(ctx, url, endpoint, part_size, uploads,
+                           lambda backend: ctx.obj.decrypt_from(backend, directory))
+    if outdir is not None:
+        if paths:
+            ctx.fail('--from-stream takes no paths')
+        return ctx.obj.run(ctx.obj.unpack_stream(outdir))
+    if not paths:
+        ctx.fail('Missing argument PATHS')
+    if not only:
+        return ctx.obj(paths, False)
+    cellar = index_cellar(ctx)
+    for path in paths:
+        if not path.is_dir():
+            ctx.fail(f'--only needs encrypted directories, {path} is not one')
+        cellar.run(cellar.decrypt_dir(path, only=only))
+
+
+@cli.command()
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, allow_dash=True, path_type=Path), required=True)
+@click.option('-o', '--output', type=click.File('w'), default='-', help='File to write the JSON report to')
+@click.pass_context
+def verify(ctx, paths, output):
+    "Authenticates every chunk of the given paths without writing any plaintext and reports corrupt files"
+    report = ctx.obj.run(ctx.obj.verify_paths(paths))
+    json.dump(report, output, indent=2)
+    output.write('\n')
+    if not report['ok']:
+        ctx.exit(1)
+
+
+def index_cellar(ctx):
+    if not isinstance(ctx.obj, EncryptedPathCellar):
+        ctx.fail('The name index is only kept for encrypted names, pass --names random or deterministic')
+    return ctx.obj
+
+
+def load_index(ctx, directory):
+    try:
+        return index_cellar(ctx).load_index(directory)
+    except CellarError as exc:
+        ctx.fail(str(exc))
+
+
+def echo_entries(entries):
+    for relpath, entry in entries:
+        size, mtime = entry['size'], entry['mtime_ns']
+        mtime = '-' if mtime is None else datetime.fromtimestamp(mtime / 1e9).isoformat(' ', 'seconds')
+        click.echo(f'{"-" if size is None else size:>12}  {mtime:19}  {relpath}')
+
+
+@cli.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.pass_context
+def ls(ctx, directory):
+    "Lists the files of an encrypted directory with their size and mtime from its index"
+    echo_entries(sorted(load_index(ctx, directory).files.items()))
+
+
+@cli.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.argument('pattern')
+@click.pass_context
+def find(ctx, directory, pattern):
+    "Lists the files of an encrypted directory whose path or name matches a glob pattern, from its index"
+    entries = load_index(ctx, directory).find(pattern)
+    echo_entries(entries)
+    if not entries:
+        ctx.exit(1)
+
+
+@cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option('-o', '--offset', default=0, type=click.IntRange(0), help='Plaintext byte offset to start from')
+@click.option('-n', '--length', default=None, type=click.IntRange(0), help='Number of plaintext bytes to output')
+@click.pass_context
+def cat(ctx, path, offset, length):
+    "Decrypts a byte range of an encrypted file to stdout. Only the chunks covering the range are decrypted"
+    ctx.obj.run(ctx.obj.decrypt_range(path, stream_writer(sys.stdout.buffer), offset, length))
+
+
+@cli.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.argument('output', type=click.Path(dir_okay=False, path_type=Path))
+@click.option('--volume-size', default=None, type=click.IntRange(1),
+              help='Start a new volume (OUTPUT.1, OUTPUT.2 ...) after this many bytes')
+@click.pass_context
+def pack(ctx, directory, output, volume_size):
+    "Packs the files of a directory into one encrypted container with an index of its members"
+    ctx.obj.run(ctx.obj.pack_dir(directory, output, volume_size))
+
+
+@cli.command()
+@click.argument('pack', type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument('members', nargs=-1)
+@click.option('-C', '--directory', default='.', type=click.Path(file_okay=False, path_type=Path),
+              help='Directory to extract to')
+@click.pass_context
+def unpack(ctx, pack, members, directory):
+    "Extracts all the files of a pack, or only the given members"
+    ctx.obj.run(ctx.obj.unpack(pack, directory, members or None))
+
+
+@cli.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option('-i', '--interval', envvar='CELLAR_WATCH_INTERVAL', default=1.0, type=click.FloatRange(0, min_open=True),
+              help='Seconds between checks for new files')
+@click.option('--settle', envvar='CELLAR_WATCH_SETTLE', default=2.0, type=click.FloatRange(0),
+              help='Seconds a file has to stay unchanged before it is encrypted')
+@click.option('--poll', is_flag=True, help='Poll the directory mtimes even where inotify is available')
+@click.pass_context
+def watch(ctx, directory, interval, settle, poll):
+    "Keeps encrypting the files created or moved into a directory until interrupted"
+    try:
+        ctx.obj.run(ctx.obj.watch(directory, interval, settle, poll))
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command()
+@click.option('--profile', 'profiles', multiple=True, type=click.Choice(list(PROFILES)), default=list(PROFILES),
+              help='Synthetic trees to run: many tiny files, a few huge files or a deep mix')
+@click.option('--target', 'targets', multiple=True, type=click.Choice(list(TARGETS)), default=list(TARGETS),
+              help='Cellars to run over the trees')
+@click.option('-b', '--block-size', 'block_sizes', multiple=True, type=click.IntRange(1), default=[2 ** 16, 2 ** 20],
+              help='Block sizes to sweep')
+@click.option('-e', '--engine', 'engines', multiple=True, type=click.Choice(list(ENGINES)), default=list(ENGINES),
+              help='Cipher engines to compare')
+@click.option('-c', '--concurrency', 'concurrencies', multiple=True, type=click.IntRange(1), default=[10, 100],
+              help='Concurrency limits to sweep')
+@click.option('--scale', default=1.0, type=click.FloatRange(0, min_open=True),
+              help='Multiplies the number and size of the generated files')
+@click.option('-d', '--directory', type=click.Path(exists=True, file_okay=False, path_type=Path),
+              help='Directory to generate the trees in, to benchmark its disk. Defaults to the temp dir')
+@click.option('-o', '--output', type=click.File('w'), default='-', help='File to write the JSON report to')
+@click.pass_context
+def bench(ctx, output, **kwargs):
+    "Benchmarks throughput over synthetic trees with a random key and writes a JSON report"
+    json.dump(run_bench(**kwargs, **ctx.meta['options']), output, indent=2)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,48 @@
+"""
+Compression of plaintext chunks before they are encrypted.
+Every chunk is compressed on its own so chunks stay independent for parallel crypto and range decryption.
+The codec is recorded in the container header flags
+"""
+import bz2
+import lzma
+import zlib
+
+from .container import FLAG_ZLIB, FLAG_LZMA, FLAG_BZ2
+from .exceptions import ContainerError
+
+
+#: name: (header flag, compress(data, level), decompress(data))
+CODECS = {
+    'zlib': (FLAG_ZLIB, lambda data, level: zlib.compress(data, -1 if level is None else level), zlib.decompress),
+    'lzma': (FLAG_LZMA, lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+    'bz2': (FLAG_BZ2, lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress),
+}
+
+#: Compression levels each codec accepts
+LEVELS = {'zlib': range(0, 10), 'lzma': range(0, 10), 'bz2': range(1, 10)}
+
+FLAGS = FLAG_ZLIB | FLAG_LZMA | FLAG_BZ2
+
+
+def compressor(name, level=None):
+    """
+    Function compressing a chunk with the named codec at level (the codec default if None)
+    """
+    _, compress, _ = CODECS[name]
+
+    def func(data):
+        return compress(data, level)
+    return func
+
+
+def decompressor(flags):
+    """
+    Function decompressing the chunks of a container with header flags, None if they are not compressed
+    """
+    flags &= FLAGS
+    if not flags:
+        return None
+    for flag, _, decompress in CODECS.values():
+        if flags == flag:
+            return decompress
+    raise ContainerError(f'Unsupported container compression flags {flags}')
@@ -0,0 +1,136 @@
+"""
+Seekable container format for encrypted files.
+All integers are little endian::
+
+    header   magic(6) version(u8) flags(u8) block_size(u32) reserved(u32) chunk_count(u64) length(u64)
+    chunks   size(u32) ciphertext(size)  ...  size(u32)=0
+    index    offset(u64) of every chunk frame
+    trailer  offset(u64) of the index
+
+Every chunk except the last one holds block_size bytes of plaintext so the chunks covering
+a plaintext byte range are found without decrypting anything else.
+chunk_count and length are 0 when they were not known up front (streams).
+Files packed from a tree (see cellar.pack) have the FLAG_PACK flag set.
+Chunks compressed before encryption have the flag of their codec set (see cellar.compress).
+Streams of the secretstream engine have the FLAG_SECRETSTREAM flag set and a different body (see cellar.engines).
+Recipes of files deduplicated into a chunk store have the FLAG_RECIPE flag set (see cellar.store).
+"""
+import sys
+import struct
+from array import array
+
+from .exceptions import ContainerError
+
+
+MAGIC = b'CELLAR'
+VERSION = 1
+FRAME = struct.Struct('<I')
+OFFSET = struct.Struct('<Q')
+FLAG_PACK = 1
+FLAG_ZLIB = 2
+FLAG_LZMA = 4
+FLAG_BZ2 = 8
+FLAG_SECRETSTREAM = 16
+FLAG_RECIPE = 32
+
+
+class Header:
+    struct = struct.Struct('<6sBBIIQQ')
+    size = struct.size
+
+    def __init__(self, block_size, chunk_count=0, length=0, flags=0, version=VERSION):
+        self.block_size = block_size
+        self.chunk_count = chunk_count
+        self.length = length
+        self.flags = flags
+        self.version = version
+
+    def __repr__(self):
+        return f'<Header v{self.version} block_size={self.block_size} chunks={self.chunk_count} length={self.length}>'
+
+    def pack(self):
+        return self.struct.pack(MAGIC, self.version, self.flags, self.block_size, 0, self.chunk_count, self.length)
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Parses a header from data. Returns None if data is not a container (raw chunks)
+        """
+        if not is_container(data):
+            return None
+        if len(data) < cls.size:
+            raise ContainerError('Truncated container header')
+        magic, version, flags, block_size, _, chunk_count, length = cls.struct.unpack(data[:cls.size])
+        if version > VERSION:
+            raise ContainerError(f'Unsupported container version {version}')
+        return cls(block_size, chunk_count, length, flags, version)
+
+
+def is_container(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+class ContainerWriter:
+    """
+    Frames chunks written through the write coroutine and appends the chunk index when closed
+    """
+
+    def __init__(self, write, header):
+        self._write = write
+        self.header = header
+        self.offset = 0
+        self.index = array('Q')
+
+    async def _emit(self, data):
+        await self._write(data)
+        self.offset += len(data)
+
+    async def open(self):
+        await self._emit(self.header.pack())
+
+    async def write(self, chunk):
+        self.index.append(self.offset)
+        await self._emit(FRAME.pack(len(chunk)) + chunk)
+
+    async def close(self):
+        await self._emit(FRAME.pack(0))
+        index = array('Q', self.index)
+        if sys.byteorder == 'big':
+            index.byteswap()
+        index_offset = self.offset
+        await self._emit(index.tobytes())
+        await self._emit(OFFSET.pack(index_offset))
+
+
+async def read_frames(read):
+    """
+    Yields the chunks of a container from the read coroutine, positioned after the header
+    """
+    while True:
+        data = await read(FRAME.size)
+        if len(data) < FRAME.size:
+            raise ContainerError('Truncated container, missing end of chunks')
+        size, = FRAME.unpack(data)
+        if not size:
+            return
+        chunk = await read(size)
+        if len(chunk) < size:
+            raise ContainerError('Truncated container chunk')
+        yield chunk
+
+
+async def read_index_entry(fileobj, filesize, number):
+    """
+    Returns the offset of the chunk frame number from the index of a seekable container file
+    or None if there is no such chunk
+    """
+    if filesize < Header.size + OFFSET.size:
+        raise ContainerError('Truncated container, missing index')
+    await fileobj.seek(filesize - OFFSET.size)
+    index_offset, = OFFSET.unpack(await fileobj.read(OFFSET.size))
+    count = (filesize - OFFSET.size - index_offset) // OFFSET.size
+    if number >= count:
+        return None
+    await fileobj.seek(index_offset + number * OFFSET.size)
+    offset, = OFFSET.unpack(await fileobj.read(OFFSET.size))
+    return offset
@@ -1,20 +1,182 @@
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+import os
 import sys
+import mmap
 from shutil import rmtree
 import asyncio
+import json
+import zlib
+import lzma
+import pickle
+import multiprocessing
+from io import BytesIO
+from itertools import islice, chain
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED
 
 import click
 import aiofiles
 from nacl.secret import SecretBox
 from nacl.utils import random
 from nacl.exceptions import CryptoError
-from nacl.encoding import URLSafeBase64Encoder, RawEncoder
+from nacl.encoding import URLSafeBase64Encoder, RawEncoder, HexEncoder
+from nacl.hash import blake2b
+from nacl import hashlib as nacl_hashlib
 
-from .log import logger
+from .log import logger, summary
+from .exceptions import CellarError, DecryptionError, ContainerError
+from .container import (Header, ContainerWriter, FLAG_PACK, FLAG_RECIPE, is_container,
+                        read_frames, read_index_entry)
+from .manifest import Manifest
+from .journal import Journal
+from .index import Index
+from .store import ChunkStore
+from .backends import LocalBackend
+from .stats import Stats
+from .watch import watcher
+from .tune import Tuner, pick_block_size
+from .buffers import NonceSequence, Slot
+from .engines import ENGINES, BoxDecryptor, engine_for
+from .compress import CODECS, LEVELS, compressor, decompressor
+from .pack import OFFSET, PackReader, PackExtractor, member_path, volume_path, volumes
 
 
-class DecryptionError(Exception):
-    pass
+def chunked(iterable, size):
+    """
+    Splits an iterable into lists of at most size items without consuming it all up front
+    """
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def walk(top):
+    """
+    Yields the files under top as they are found using os.scandir, without building the full list first.
+    Each directory is listed completely before its files are yielded,
+    so temp files created next to them while walking are never picked up
+    """
+    stack = [os.fspath(top)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            entries = list(entries)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file():
+                yield Path(entry.path)
+
+
+def memoize(func):
+    """
+    Wraps a coroutine function of one argument so it only runs once for each argument.
+    Concurrent callers with the same argument all wait for the first call
+    """
+    cache = {}
+
+    async def wrapper(arg):
+        if arg not in cache:
+            cache[arg] = asyncio.ensure_future(func(arg))
+        return await cache[arg]
+
+    return wrapper
+
+
+async def tag_last(chunks):
+    """
+    Yields (chunk, last) pairs from the chunks async iterator, reading one chunk ahead to know the last one.
+    An empty iterator yields one empty last chunk
+    """
+    previous = None
+    async for chunk in chunks:
+        if previous is not None:
+            yield previous, False
+        previous = chunk
+    yield previous or b'', True
+
+
+async def read_blocks(read, size):
+    """
+    Yields blocks of size bytes from the read coroutine until it is exhausted
+    """
+    chunk = await read(size)
+    while chunk:
+        yield chunk
+        chunk = await read(size)
+
+
+def stream_reader(stream, threaded=False):
+    """
+    Coroutine reading from a blocking stream, in the default executor if threaded so the event loop keeps running
+    """
+    async def read(size):
+        if threaded:
+            return await asyncio.get_event_loop().run_in_executor(None, stream.read, size)
+        return stream.read(size)
+    return read
+
+
+def stream_writer(stream, threaded=False):
+    """
+    Coroutine writing to a blocking stream, in the default executor if threaded so the event loop keeps running
+    """
+    async def write(data):
+        if threaded:
+            return await asyncio.get_event_loop().run_in_executor(None, stream.write, data)
+        stream.write(data)
+    return write
+
+
+def discard(task):
+    """
+    Cancels a task we no longer want the result of, retrieving its exception if it already failed
+    """
+    if task.done():
+        if not task.cancelled():
+            task.exception()
+    else:
+        task.cancel()
+
+
+_shard_loop = _shard_cellar = None
+
+
+def _init_shard_worker(state):
+    """
+    Sets up the event loop and cellar copy for a shard worker process
+    """
+    global _shard_loop, _shard_cellar
+    _shard_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_shard_loop)
+    _shard_cellar = pickle.loads(state)
+    _shard_cellar.semaphore = _shard_cellar.new_semaphore()
+
+
+def _run_shard(method, items):
+    """
+    Runs the cellar method on every item of the shard in the worker process event loop.
+    Returns the stats of the shard, a list of (item, error) failures
+    and a list of the non None results of the method
+    """
+    failures, results = [], []
+    _shard_cellar.stats = Stats()
+
+    async def run(item):
+        try:
+            result = await getattr(_shard_cellar, method)(item)
+        except Exception as exc:
+            failures.append((str(item), str(exc)))
+        else:
+            if result is not None:
+                results.append(result)
+
+    main = _shard_cellar.map_crypto(run, items)
+    if _shard_cellar.tuner is not None:
+        main = _shard_cellar.tuner.watch(main, _shard_cellar.stats)
+    _shard_loop.run_until_complete(main)
+    return _shard_cellar.stats, failures, results
 
 
 class BaseCellar:
@@ -22,13 +184,22 @@ class BaseCellar:
     Main encryption class to enc/decrypt streams, files and directories.
     Manages the PyNaCl SecretBox/nonce/keys
     """
+    #: Bytes added to each encrypted chunk (nonce + MAC)
+    overhead = SecretBox.NONCE_SIZE + SecretBox.MACBYTES
 
-    def __init__(self, key, encoder_class=URLSafeBase64Encoder, block_size=2 ** 20, concurrency=100):
+    def __init__(self, key, encoder_class=URLSafeBase64Encoder, block_size=2 ** 20, concurrency=100, workers=0,
+                 processes=0, shard_size=1000, mmap_size=None, container=False, manifest=False, read_ahead=0,
+                 progress=0, compression=None, compression_level=None, journal=False, buffers=0,
+                 engine='secretbox', delta=False, store=None, auto_tune=False, max_rss=None):
         self.encoder_class = encoder_class
         self.block_size = block_size
-        self.semaphore = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        # concurrency is the most files the tuner lets in flight
+        self.tuner = Tuner(max_limit=concurrency, max_rss=max_rss) if auto_tune else None
+        self.semaphore = self.new_semaphore()
         self.key_size = SecretBox.KEY_SIZE
-        self.total_bytes = 0
+        self.stats = Stats()
+        self.progress = progress
         if isinstance(key, str):
             key = key.encode()
         if len(key) < self.key_size:
@@ -37,24 +208,167 @@ class BaseCellar:
         elif len(key) > self.key_size:
             key = key[:self.key_size]
             logger.warning(f'Key too long, truncating to {self.key_size} bytes')
+        self.key = key
         self.box = SecretBox(key)
-        
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(workers) if workers else None
+        self.processes = processes
+        self.shard_size = shard_size
+        self.mmap_size = mmap_size
+        if compression is not None and compression not in CODECS:
+            raise CellarError(f'Unknown compression {compression}')
+        if compression is not None and compression_level is not None and \
+                compression_level not in LEVELS[compression]:
+            levels = LEVELS[compression]
+            raise CellarError(f'{compression} compression levels go from {levels[0]} to {levels[-1]}, '
+                              f'not {compression_level}')
+        # compression is flagged in the container header
+        self.container = container or compression is not None
+        self.compression = compression
+        self.compression_level = compression_level
+        # chunk hashes are kept in the manifest
+        self.manifest = manifest or delta
+        self.delta = delta
+        self.journal = journal
+        self.read_ahead = read_ahead
+        self.buffers = buffers
+        self.nonces = NonceSequence()
+        self.engine = ENGINES[engine](key)
+        if self.engine.chained and self.container:
+            raise CellarError(f'The {engine} engine can not write seekable or compressed containers')
+        if auto_tune and (delta or store is not None):
+            raise CellarError('Delta re-encryption and deduplication need the same block size for every file, '
+                              'not auto-tuned ones')
+        # the block size of each file is recorded in its container header (secretstream ones have one already)
+        self.container = self.container or auto_tune and not self.engine.chained
+        if delta and (self.engine.chained or self.container):
+            raise CellarError('Delta re-encryption needs raw secretbox chunks, not containers or chained engines')
+        self.store = None if store is None else ChunkStore(store)
+        if self.store is not None:
+            if self.engine.chained or self.container or delta:
+                raise CellarError('Deduplication stores secretbox chunks, not compressed, chained or delta ones')
+            self.store_key = self.derive_key(b'cellar-dedup')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['semaphore'], state['executor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.semaphore = self.new_semaphore()
+        self.executor = ThreadPoolExecutor(self.workers) if self.workers else None
+
     def __call__(self, paths, encrypt=True):
-        for path in set(paths):
-            if str(path) == '-':
-                method = self.encrypt_stream if encrypt else self.decrypt_stream
-                main = method(sys.stdin.buffer)
-            elif path.is_file():
-                method = self.encrypt_file if encrypt else self.decrypt_file
-                main = method(path)
-            elif path.is_dir():
-                method = self.encrypt_dir if encrypt else self.decrypt_dir
-                main = method(path)
+        failures = self.run(self.crypt_paths(paths, encrypt))
+        for path, exc in failures:
+            click.secho(f'Failed to {"en" if encrypt else "de"}crypt {path}: {exc}', fg='red', err=True)
+        if failures:
+            raise click.Abort
+
+    async def crypt_path(self, path, encrypt=True, threaded=False):
+        """
+        En/decrypts a file, directory or stdin (-) to stdout.
+        If threaded, stdin and stdout are read and written in threads so a slow pipe does not block other paths
+        """
+        if str(path) == '-':
+            method = self.encrypt_stream if encrypt else self.decrypt_stream
+            return await method(sys.stdin.buffer, threaded=threaded)
+        elif path.is_file():
+            method = self.encrypt_file if encrypt else self.decrypt_file
+        elif path.is_dir():
+            method = self.encrypt_dir if encrypt else self.decrypt_dir
+        else:
+            raise CellarError(f'No such file or directory {path}')
+        return await method(path)
+
+    async def crypt_paths(self, paths, encrypt=True):
+        """
+        En/decrypts all the paths concurrently. Files of every path share the concurrency budget of the cellar.
+        A failing path does not stop the others, returns the list of (path, exception) failures
+        """
+        paths = list(dict.fromkeys(paths))
+        if self.progress:
+            counter = asyncio.get_running_loop().run_in_executor(None, self.count_bytes, paths)
+
+        async def crypt_path(path):
             try:
-                asyncio.get_event_loop().run_until_complete(main)
-            except DecryptionError as exc:
-                click.secho(exc, fg='red')
-                raise click.Abort
+                await self.crypt_path(path, encrypt, len(paths) > 1)
+            except Exception as exc:
+                logger.debug(f'Failed on {path}', exc_info=True)
+                return exc
+
+        try:
+            errors = await asyncio.gather(*map(crypt_path, paths))
+        finally:
+            if self.progress:
+                discard(counter)
+        return [(path, exc) for path, exc in zip(paths, errors) if exc is not None]
+
+    def run(self, main):
+        """
+        Runs the coroutine to completion in a new event loop, aborting the CLI on any cellar errors.
+        If progress is set, stats subscribers are notified every progress seconds while it runs
+        """
+        async def run():
+            # the semaphore belongs to the loop it was first used in
+            self.semaphore = self.new_semaphore()
+            tuned = main if self.tuner is None else self.tuner.watch(main, self.stats)
+            if self.progress:
+                return await self.stats.watch(tuned, self.progress)
+            return await tuned
+
+        try:
+            return asyncio.run(run())
+        except CellarError as exc:
+            click.secho(exc, fg='red')
+            raise click.Abort
+
+    def new_semaphore(self):
+        """
+        Semaphore bounding the files in flight, the limiter of the tuner when auto-tuning
+        """
+        if self.tuner is not None:
+            return self.tuner.limiter
+        return asyncio.Semaphore(self.concurrency)
+
+    def block_size_for(self, length):
+        """
+        Block size to encrypt length bytes of plaintext with: picked from the length when auto-tuning
+        (see cellar.tune), block_size otherwise or if the length is not known
+        """
+        if self.tuner is None or not length:
+            return self.block_size
+        return pick_block_size(length)
+
+    @property
+    def total_bytes(self):
+        return self.stats.bytes
+
+    @total_bytes.setter
+    def total_bytes(self, value):
+        self.stats.bytes = value
+
+    def count_bytes(self, paths):
+        """
+        Sets the bytes expected to be processed for paths in the stats, for progress estimates.
+        Left unknown if reading from stdin
+        """
+        total = 0
+        for path in paths:
+            if str(path) == '-':
+                return
+            total += sum(path.stat().st_size for path in walk(path)) if path.is_dir() else path.stat().st_size
+        self.stats.expected_bytes = total
+
+    def timed(self, phase, func):
+        """
+        Wraps a coroutine function to add the time spent in it to the phase in the stats
+        """
+        async def wrapper(*args):
+            with self.stats.timer(phase):
+                return await func(*args)
+        return wrapper
 
     @property
     def nonce(self):
@@ -63,6 +377,19 @@ class BaseCellar:
         """
         return random(self.box.NONCE_SIZE)
 
+    async def run_crypto(self, func, *args):
+        """
+        Runs a blocking crypto call in the thread pool if workers were given, otherwise inline.
+        libsodium releases the GIL so chunks run in parallel across cores
+        """
+        def timed(*args):
+            with self.stats.timer('crypto'):
+                return func(*args)
+
+        if self.executor is None:
+            return timed(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, timed, *args)
+
     async def encrypt(self, plaintext, encode=True):
         """
         Encrypts plaintext to ciphertext.
@@ -71,7 +398,7 @@ class BaseCellar:
         encoder = self.encoder_class if encode else RawEncoder
         if isinstance(plaintext, str):
             plaintext = plaintext.encode()
-        return self.box.encrypt(plaintext, self.nonce, encoder())
+        return await self.run_crypto(self.box.encrypt, plaintext, self.nonce, encoder)
 
     async def decrypt(self, ciphertext, decode=True):
         """
@@ -81,74 +408,1209 @@ class BaseCellar:
         """
         encoder = self.encoder_class if decode else RawEncoder
         try:
-            return self.box.decrypt(ciphertext, encoder=encoder)
+            return await self.run_crypto(self.box.decrypt, ciphertext, None, encoder)
         except CryptoError as exc:
-            msg = f'{exc}. Make sure the decryption key is correct'
-            logger.critical(msg)
-            raise DecryptionError(msg)
+            raise self.decryption_error(exc)
 
-    async def encrypt_stream(self, instream, outstream=sys.stdout.buffer, encode=False):
+    @property
+    def flags(self):
         """
-        Encrypts a stream and outputs it to another (default stdout)
+        Container header flags of the chunks this cellar encrypts
         """
-        chunk = instream.read(self.block_size)
-        while chunk:
-            outstream.write(await self.encrypt(chunk, encode))
-            chunk = instream.read(self.block_size)
+        return CODECS[self.compression][0] if self.compression else 0
+
+    async def decompress(self, decompress, plaintext):
+        try:
+            return await self.run_crypto(decompress, plaintext)
+        except (zlib.error, lzma.LZMAError, OSError, ValueError) as exc:
+            raise ContainerError(f'Could not decompress chunk: {exc}')
 
-    async def decrypt_stream(self, instream, outstream=sys.stdout.buffer, decode=False):
+    def derive_key(self, purpose):
         """
-        Decrypts a stream and outputs it to another (default stdout)
+        Derives a subkey from the secret key for the purpose (up to 16 bytes), like keyed hashes
         """
-        chunk = instream.read(self.block_size + 40)
-        while chunk:
-            outstream.write(await self.decrypt(chunk, decode))
-            chunk = instream.read(self.block_size + 40)
+        return blake2b(b'', key=self.key, person=purpose, encoder=RawEncoder)
 
-    async def read_write_crypto(self, infile, outfile, encrypt=True):
-        method = self.encrypt if encrypt else self.decrypt
-        block_size = self.block_size if encrypt else self.block_size + 40
+    async def hash_file(self, path):
+        """
+        Keyed BLAKE2b hex digest of the file content
+        """
+        digest = nacl_hashlib.blake2b(key=self.derive_key(b'cellar-hash'))
+        async with aiofiles.open(path, 'rb') as fi:
+            async for chunk in read_blocks(fi.read, self.block_size):
+                await self.run_crypto(digest.update, chunk)
+        return digest.hexdigest()
+
+    async def load_manifest(self, directory):
+        """
+        Loads and decrypts the manifest kept next to the directory, or starts an empty one
+        """
+        path = Manifest.for_dir(directory)
+        if not path.is_file():
+            return Manifest(path)
+        out = BytesIO()
+        async with aiofiles.open(path, 'rb') as fi:
+            await self.decrypt_chunks(fi.read, stream_writer(out), count=False)
+        data = json.loads(out.getvalue())
+        return Manifest(path, data['files'], data['root'])
+
+    async def save_manifest(self, manifest):
+        """
+        Encrypts the manifest and atomically replaces the previous one
+        """
+        data = json.dumps(manifest.to_dict()).encode()
+        tmpfile = manifest.path.with_name(f'{manifest.path.name}.tmp')
+        async with aiofiles.open(tmpfile, 'wb') as fo:
+            await self.encrypt_chunks(stream_reader(BytesIO(data)), fo.write, len(data), count=False)
+        tmpfile.replace(manifest.path)
+        logger.debug(f'Saved manifest {manifest.path} with {len(manifest)} files')
+
+    def chunk_hash(self, chunk, key):
+        """
+        Keyed BLAKE2b hex digest of a plaintext chunk, for delta re-encryption
+        """
+        return blake2b(chunk, 16, key, encoder=HexEncoder).decode()
+
+    def delta_hashes(self, entry, cipherfile):
+        """
+        Chunk hashes of the manifest entry if cipherfile still holds the raw chunks they were made for, else ()
+        """
+        hashes = entry.get('chunks')
+        if hashes is None or len(hashes) != -(-entry['size'] // self.block_size):
+            # never hashed or hashed with another block size
+            return ()
+        if os.path.getsize(cipherfile) != entry['size'] + len(hashes) * self.overhead:
+            return ()
+        return hashes if self.raw_chunks(cipherfile, False) else ()
+
+    async def delta_crypto(self, plainfile, cipherfile, hashes=()):
+        """
+        Encrypts plainfile into the raw chunks of cipherfile, only rewriting in place the chunks whose keyed hash
+        differs from hashes (the chunk hashes of the plaintext cipherfile was last written from),
+        then truncates cipherfile to the new size. With no hashes every chunk is written.
+        Returns the keyed hash of the whole file and the list of chunk hashes
+        """
+        chunk_key = self.derive_key(b'cellar-chunks')
+        digest = nacl_hashlib.blake2b(key=self.derive_key(b'cellar-hash'))
+        chunk_size = self.block_size + self.overhead
+        chunks, size = [], 0
+
+        async def changed():
+            nonlocal size
+            async for chunk in read_blocks(self.timed('read', fi.read), self.block_size):
+                await self.run_crypto(digest.update, chunk)
+                index = len(chunks)
+                chunks.append(await self.run_crypto(self.chunk_hash, chunk, chunk_key))
+                size += len(chunk)
+                if index >= len(hashes) or hashes[index] != chunks[index]:
+                    self.total_bytes += len(chunk)
+                    yield index, chunk
+
+        async def encrypt(item):
+            index, chunk = item
+            return index, await self.encrypt(chunk, False)
+
+        async def write(item):
+            index, ciphertext = item
+            with self.stats.timer('write'):
+                await fo.seek(index * chunk_size)
+                await fo.write(ciphertext)
+
+        mode = 'r+b' if hashes else 'wb'
         async with self.semaphore:
-            async with aiofiles.open(infile, 'rb') as fi, aiofiles.open(outfile, 'wb') as fo:
-                chunk = await fi.read(block_size)
-                while chunk:
+            self.stats.in_flight += 1
+            try:
+                async with aiofiles.open(plainfile, 'rb') as fi, aiofiles.open(cipherfile, mode) as fo:
+                    await self.crypt_chunks(changed(), encrypt, write, False)
+                    await fo.truncate(size + len(chunks) * self.overhead)
+            finally:
+                self.stats.in_flight -= 1
+            self.stats.files += 1
+        summary.add('Re-encrypted', plainfile)
+        return digest.hexdigest(), chunks
+
+    async def unchanged(self, path, entry):
+        """
+        Returns the content hash of path if it still matches the manifest entry, else None
+        """
+        if entry is None or path.stat().st_size != entry['size']:
+            return None
+        digest = await self.hash_file(path)
+        return digest if digest == entry['hash'] else None
+
+    @asynccontextmanager
+    async def journaling(self, directory, operation):
+        """
+        Opens the journal of an operation on the directory if the cellar keeps journals, else yields None.
+        If a previous run was interrupted, the partial outputs of the files it had started are removed
+        unless their source is gone, in which case the output is complete and the file is marked done.
+        The journal is removed once the run completes and kept for the next run if it fails
+        """
+        if not self.journal:
+            yield None
+            return
+        journal = Journal(Journal.for_dir(directory, operation), directory, self.box).load()
+        journal.open()
+        for relpath, target in journal.started.items():
+            if target is None or not Path(target).exists():
+                continue
+            if (journal.top / relpath).exists():
+                logger.info(f'Removing partial output {target}')
+                Path(target).unlink()
+            else:
+                journal.finish(relpath, target)
+        loop = asyncio.get_running_loop()
+        try:
+            yield journal
+        except BaseException:
+            await loop.run_in_executor(None, journal.close, False)
+            raise
+        await loop.run_in_executor(None, journal.close)
+
+    def journaled(self, journal, func, target=None, processed=None):
+        """
+        Wraps the per file coroutine function func so the journal records each file as started and done.
+        Items are paths or (relpath, path, entry) tuples of Manifest.pending.
+        Files done in an interrupted run are skipped with their recorded result.
+        target(path) is the partial output to remove if the run stops while func runs,
+        without it func records the start itself once it knows its output (see Journal.start).
+        processed(item) returns (True, result) for items an interrupted run already processed
+        without recording it (only called when resuming)
+        """
+        async def wrapper(item):
+            path = item[1] if isinstance(item, tuple) else item
+            relpath = path.relative_to(journal.top).as_posix()
+            if relpath in journal.done:
+                return journal.done[relpath]
+            if journal.resumed and processed is not None:
+                done, result = await processed(item)
+                if done:
+                    journal.finish(relpath, path, result)
+                    return result
+            if target is not None:
+                journal.start(relpath, target(path))
+            result = await func(item)
+            if journal.finish(relpath, result if isinstance(result, Path) else path, result):
+                await asyncio.get_running_loop().run_in_executor(None, journal.sync)
+            return result
+        return wrapper
+
+    async def is_encrypted(self, path, full=False):
+        """
+        Whether the first chunk of path, or every chunk if full, authenticates as ciphertext of this cellar.
+        Empty files count as encrypted
+        """
+        async with aiofiles.open(path, 'rb') as fi:
+            try:
+                if full:
+                    return not await self.verify_chunks(fi.read, False)
+                _, chunks, decryptor = await self.read_chunks(fi.read)
+                async for chunk in chunks:
+                    await self.run_crypto(decryptor.decrypt, chunk)
+                    break
+            except (CryptoError, ContainerError):
+                return False
+        return True
+
+    def decryption_error(self, exc):
+        msg = f'{exc}. Make sure the decryption key is correct'
+        logger.critical(msg)
+        return DecryptionError(msg)
+
+    async def encrypt_stream(self, instream, outstream=sys.stdout.buffer, encode=False, threaded=False):
+        """
+        Encrypts a stream and outputs it to another (default stdout).
+        With read_ahead or threaded the stream is read and written in threads, pipelined with the crypto
+        """
+        threaded = threaded or self.read_ahead > 0
+        await self.encrypt_chunks(stream_reader(instream, threaded), stream_writer(outstream, threaded), encode=encode)
+
+    async def decrypt_stream(self, instream, outstream=sys.stdout.buffer, decode=False, threaded=False):
+        """
+        Decrypts a stream and outputs it to another (default stdout).
+        With read_ahead or threaded the stream is read and written in threads, pipelined with the crypto
+        """
+        threaded = threaded or self.read_ahead > 0
+        await self.decrypt_chunks(stream_reader(instream, threaded), stream_writer(outstream, threaded), decode)
+
+    async def crypt_chunks(self, chunks, method, write, count=True):
+        """
+        Runs method on every chunk of the chunks async iterator and writes the results in order.
+        Reading, crypto and writing are pipelined: a reader schedules the crypto of each chunk into a queue
+        of up to read_ahead (at least 1) chunks in flight which an ordered writer drains.
+        Chunk sizes are added to total_bytes if count is True
+        """
+        queue = asyncio.Queue(max(self.read_ahead, 1))
+
+        async def read():
+            async for chunk in chunks:
+                if count:
+                    self.total_bytes += len(chunk)
+                await queue.put(asyncio.ensure_future(method(chunk)))
+            await queue.put(None)
+
+        async def write_all():
+            task = await queue.get()
+            while task is not None:
+                await write(await task)
+                task = await queue.get()
+
+        tasks = [asyncio.ensure_future(read()), asyncio.ensure_future(write_all())]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                discard(task)
+            while not queue.empty():
+                task = queue.get_nowait()
+                if task is not None:
+                    discard(task)
+            raise
+
+    async def encrypt_chunks(self, read, write, length=0, encode=False, count=True, header=None):
+        """
+        Encrypts blocks of plaintext from the read coroutine with the write coroutine.
+        In container mode, or if a header is given, the chunks are framed after the header
+        and followed by the chunk index.
+        length is the plaintext size recorded in the header if known
+        """
+        compress = compressor(self.compression, self.compression_level) if self.compression else None
+
+        async def encrypt(chunk):
+            if compress is not None:
+                chunk = await self.run_crypto(compress, chunk)
+            return await self.encrypt(chunk, encode)
+
+        read, write = self.timed('read', read), self.timed('write', write)
+        block_size = self.block_size_for(length) if header is None else header.block_size
+        chunks = read_blocks(read, block_size)
+        if header is None:
+            if self.engine.chained:
+                return await self.encrypt_chained(chunks, write, length, count, block_size)
+            if not self.container:
+                return await self.crypt_chunks(chunks, encrypt, write, count)
+            header = Header(block_size, -(-length // block_size), length)
+        header.flags |= self.flags
+        writer = ContainerWriter(write, header)
+        await writer.open()
+        await self.crypt_chunks(chunks, encrypt, writer.write, count)
+        await writer.close()
+
+    async def encrypt_chained(self, chunks, write, length=0, count=True, block_size=None):
+        """
+        Encrypts the chunks async iterator with a chained engine (see cellar.engines) after its container header.
+        Chunks depend on the previous ones, so each is encrypted on the event loop as soon as its task starts,
+        which is in the order they were read. The last chunk is tagged as the end of the stream
+        """
+        block_size = block_size or self.block_size
+        header = Header(block_size, -(-length // block_size), length, self.engine.flag)
+        head = header.pack()
+        encryptor = self.engine.encryptor(head)
+        await write(head + encryptor.header)
+
+        async def counted():
+            async for chunk in chunks:
+                if count:
+                    self.total_bytes += len(chunk)
+                yield chunk
+
+        async def encrypt(item):
+            with self.stats.timer('crypto'):
+                return encryptor.encrypt(*item)
+
+        await self.crypt_chunks(tag_last(counted()), encrypt, write, False)
+
+    async def read_chunks(self, read):
+        """
+        Returns the container header (None for raw chunks), an async iterator of the ciphertext chunks
+        from the read coroutine and the decryptor of the chunks (see cellar.engines).
+        Anything that is not a container is read as raw fixed size secretbox chunks
+        """
+        head = await read(Header.size)
+        header = Header.unpack(head)
+        engine = None if header is None else engine_for(header.flags)
+        if engine is not None:
+            engine = engine(self.key)
+            try:
+                decryptor = engine.decryptor(await read(engine.header_size), head[:Header.size])
+            except CryptoError as exc:
+                raise ContainerError(str(exc))
+            return header, read_blocks(read, header.block_size + engine.overhead), decryptor
+        if header is not None:
+            return header, read_frames(read), BoxDecryptor(self.box)
+        chunk_size = self.block_size + self.overhead
+
+        async def read_raw(size):
+            nonlocal head
+            if head:
+                chunk, head = head + await read(size - len(head)), b''
+                return chunk
+            return await read(size)
+
+        return None, read_blocks(read_raw, chunk_size), BoxDecryptor(self.box)
+
+    async def decrypt_chunks(self, read, write, decode=False, count=True):
+        """
+        Decrypts chunks from the read coroutine with the write coroutine.
+        Containers are detected by their header and decompressed if flagged (see read_chunks)
+        """
+        read, write = self.timed('read', read), self.timed('write', write)
+        header, chunks, decryptor = await self.read_chunks(read)
+        if decryptor.chained:
+            return await self.decrypt_chained(chunks, decryptor, write, count)
+        if header is not None and header.flags & FLAG_RECIPE:
+            return await self.decrypt_recipe(chunks, write, count)
+        decompress = None if header is None else decompressor(header.flags)
+
+        async def decrypt(chunk):
+            plaintext = await self.decrypt(chunk, decode)
+            if decompress is not None:
+                plaintext = await self.decompress(decompress, plaintext)
+            return plaintext
+
+        await self.crypt_chunks(chunks, decrypt, write, count)
+
+    def chunk_digest(self, chunk):
+        """
+        Keyed BLAKE2b digest a plaintext chunk is stored under in the chunk store
+        """
+        return blake2b(chunk, ChunkStore.digest_size, self.store_key, encoder=RawEncoder)
+
+    async def store_crypto(self, infile, outfile):
+        """
+        Encrypts the chunks of infile that are not in the chunk store yet into it and writes the recipe of infile
+        to outfile, a container flagged FLAG_RECIPE of the digests of its chunks (see cellar.store)
+        """
+        digests, length, stored = bytearray(), 0, 0
+
+        async def store(chunk):
+            nonlocal length, stored
+            length += len(chunk)
+            digest = await self.run_crypto(self.chunk_digest, chunk)
+            if digest not in self.store:
+                await self.store.put(digest, await self.encrypt(chunk, False))
+                stored += 1
+            return digest
+
+        async def collect(digest):
+            digests.extend(digest)
+
+        async with aiofiles.open(infile, 'rb') as fi:
+            await self.crypt_chunks(read_blocks(self.timed('read', fi.read), self.block_size), store, collect)
+        count = len(digests) // ChunkStore.digest_size
+        header = Header(self.block_size, count, length, FLAG_RECIPE)
+        async with aiofiles.open(outfile, 'wb') as fo:
+            await self.encrypt_chunks(stream_reader(BytesIO(digests)), fo.write, count=False, header=header)
+        logger.debug(f'Stored {stored} new chunks of the {count} of {infile}')
+
+    async def decrypt_recipe(self, chunks, write, count=True):
+        """
+        Rebuilds the plaintext of a recipe from the chunk store, chunks are the encrypted frames of its digests.
+        Every chunk has to match its digest so chunks swapped in the store are caught
+        """
+        if self.store is None:
+            raise ContainerError('Deduplicated file, decrypting it needs its chunk store')
+        size = ChunkStore.digest_size
+
+        async def digests():
+            # frames hold block_size bytes of digests, which may split one
+            buffer = b''
+            async for chunk in chunks:
+                buffer += await self.decrypt(chunk, False)
+                for start in range(0, len(buffer) - size + 1, size):
+                    yield buffer[start:start + size]
+                buffer = buffer[len(buffer) - len(buffer) % size:]
+            if buffer:
+                raise ContainerError('Truncated recipe digest')
+
+        async def load(digest):
+            plaintext = await self.decrypt(await self.store.get(digest), False)
+            if await self.run_crypto(self.chunk_digest, plaintext) != digest:
+                raise self.decryption_error(CryptoError(f'Chunk {digest.hex()} does not match its digest'))
+            if count:
+                self.total_bytes += len(plaintext)
+            return plaintext
+
+        await self.crypt_chunks(digests(), load, write, False)
+
+    async def decrypt_chained(self, chunks, decryptor, write, count=True):
+        """
+        Decrypts chained chunks in order (see encrypt_chained). Fails if the stream ends before its last chunk
+        """
+        async def decrypt(chunk):
+            with self.stats.timer('crypto'):
+                try:
+                    return decryptor.decrypt(chunk)
+                except CryptoError as exc:
+                    raise self.decryption_error(exc)
+
+        await self.crypt_chunks(chunks, decrypt, write, count)
+        if not decryptor.finished:
+            raise self.decryption_error(CryptoError('Truncated stream, its last chunk is missing'))
+
+    async def verify_chunks(self, read, count=True):
+        """
+        Authenticates every chunk from the read coroutine without writing any plaintext.
+        Returns the offsets in the ciphertext of the chunks that failed to authenticate.
+        Structural damage to a container (like truncation) raises a ContainerError.
+        Chunk sizes are added to total_bytes if count is True
+        """
+        offset, corrupt = 0, []
+
+        async def read_counted(size):
+            nonlocal offset
+            data = await read(size)
+            offset += len(data)
+            return data
+
+        async def located(chunks):
+            async for chunk in chunks:
+                if count:
                     self.total_bytes += len(chunk)
-                    await fo.write(await method(chunk, False))
-                    chunk = await fi.read(block_size)
+                yield offset - len(chunk), chunk
+
+        async def verify(item):
+            chunk_offset, chunk = item
+            try:
+                if decryptor.chained:
+                    # chained chunks are checked in order, as their tasks start
+                    with self.stats.timer('crypto'):
+                        decryptor.decrypt(chunk)
+                else:
+                    await self.run_crypto(decryptor.decrypt, chunk)
+            except CryptoError:
+                corrupt.append(chunk_offset)
+
+        async def drop(_):
+            pass
+
+        _, chunks, decryptor = await self.read_chunks(self.timed('read', read_counted))
+        await self.crypt_chunks(located(chunks), verify, drop, False)
+        if not corrupt and not decryptor.finished:
+            raise ContainerError('Truncated stream, its last chunk is missing')
+        return sorted(corrupt)
+
+    def verify_report(self, path, corrupt=(), error=None):
+        return {'path': str(path), 'ok': not corrupt and error is None, 'corrupt_chunks': list(corrupt),
+                'error': None if error is None else str(error)}
+
+    async def verify_stream(self, instream=sys.stdin.buffer):
+        """
+        Authenticates an encrypted stream (default stdin), returns its report
+        """
+        try:
+            corrupt = await self.verify_chunks(stream_reader(instream, self.read_ahead > 0))
+        except ContainerError as exc:
+            return self.verify_report('-', error=exc)
+        return self.verify_report('-', corrupt)
+
+    async def verify_file(self, path):
+        """
+        Authenticates every chunk of an encrypted file, returns its report
+        """
+        async with self.semaphore:
+            self.stats.in_flight += 1
+            try:
+                async with aiofiles.open(path, 'rb') as fi:
+                    corrupt = await self.verify_chunks(fi.read)
+            except (ContainerError, OSError) as exc:
+                return self.verify_report(path, error=exc)
+            finally:
+                self.stats.in_flight -= 1
+            self.stats.files += 1
+        if corrupt:
+            logger.error(f'Corrupt chunks in {path} at offsets {corrupt}')
+        return self.verify_report(path, corrupt)
+
+    async def verify_dir(self, directory):
+        """
+        Authenticates all the files under directory in parallel, returns their reports
+        """
+        reports = []
+        await self.map_files('verify_file', walk(directory), reports.extend)
+        return reports
+
+    async def verify_paths(self, paths):
+        """
+        Authenticates files, directories and stdin (-) concurrently.
+        Returns a report with the number of files checked and the reports of the ones that failed
+        """
+        paths = list(dict.fromkeys(paths))
+
+        async def verify_path(path):
+            if str(path) == '-':
+                return [await self.verify_stream()]
+            if Path(path).is_dir():
+                return await self.verify_dir(path)
+            return [await self.verify_file(path)]
+
+        results = await asyncio.gather(*map(verify_path, paths))
+        reports = [report for result in results for report in result]
+        failed = [report for report in reports if not report['ok']]
+        return {'ok': not failed, 'files': len(reports), 'bytes': self.total_bytes, 'failed': failed}
+
+    async def read_write_crypto(self, infile, outfile, encrypt=True):
+        """
+        Reads infile by chunks and writes the en/decrypted chunks to outfile
+        """
+        async with self.semaphore:
+            self.stats.in_flight += 1
+            try:
+                if self.store is not None and encrypt:
+                    await self.store_crypto(infile, outfile)
+                elif self.use_mmap(infile, encrypt):
+                    await self.mmap_crypto(infile, outfile, encrypt)
+                elif self.use_buffers(infile, encrypt):
+                    await self.buffered_crypto(infile, outfile, encrypt)
+                else:
+                    async with aiofiles.open(infile, 'rb') as fi, aiofiles.open(outfile, 'wb') as fo:
+                        if encrypt:
+                            await self.encrypt_chunks(fi.read, fo.write, os.path.getsize(infile))
+                        else:
+                            await self.decrypt_chunks(fi.read, fo.write)
+            finally:
+                self.stats.in_flight -= 1
+            self.stats.files += 1
+
+    async def decrypt_range(self, path, write, offset=0, length=None):
+        """
+        Decrypts only the chunks of path covering length bytes of plaintext from offset
+        (or to the end) and writes that plaintext with the write coroutine.
+        Containers are found by their chunk index, raw files by their fixed chunk size
+        """
+        if length == 0:
+            return
+        filesize = os.path.getsize(path)
+        async with aiofiles.open(path, 'rb') as fi:
+            header = Header.unpack(await fi.read(Header.size))
+            if header is not None and engine_for(header.flags) is not None:
+                await fi.seek(0)
+                return await self.decrypt_chained_range(fi.read, write, offset, length)
+            if header is not None and header.flags & FLAG_RECIPE:
+                raise ContainerError(f'{path} is deduplicated, decrypt it whole')
+            block_size = self.block_size if header is None else header.block_size
+            decompress = None if header is None else decompressor(header.flags)
+            number = offset // block_size
+            if header is None:
+                position = number * (block_size + self.overhead)
+                if position >= filesize:
+                    return
+                await fi.seek(position)
+                chunks = read_blocks(fi.read, block_size + self.overhead)
+            else:
+                position = await read_index_entry(fi, filesize, number)
+                if position is None:
+                    return
+                await fi.seek(position)
+                chunks = read_frames(fi.read)
+            skip = offset - number * block_size
+            async for chunk in chunks:
+                plaintext = await self.decrypt(chunk, False)
+                if decompress is not None:
+                    plaintext = await self.decompress(decompress, plaintext)
+                plaintext = plaintext[skip:]
+                skip = 0
+                if length is not None:
+                    plaintext, length = plaintext[:length], length - len(plaintext)
+                await write(plaintext)
+                if length is not None and length <= 0:
+                    break
+
+    async def decrypt_chained_range(self, read, write, offset=0, length=None):
+        """
+        Decrypts chained chunks from the start, since they can not be decrypted on their own,
+        and writes only the plaintext of the range
+        """
+        position = 0
+
+        async def write_range(plaintext):
+            nonlocal position
+            start, position = position, position + len(plaintext)
+            first = max(start, offset)
+            end = position if length is None else min(position, offset + length)
+            if end > first:
+                await write(plaintext[first - start:end - start])
+
+        await self.decrypt_chunks(read, write_range, count=False)
+
+    async def decrypt_bytes(self, path, offset, length):
+        """
+        Returns length bytes of plaintext of path from offset (see decrypt_range)
+        """
+        out = BytesIO()
+
+        async def write(data):
+            out.write(data)
+
+        await self.decrypt_range(path, write, offset, length)
+        return out.getvalue()
+
+    async def pack_dir(self, directory, output, volume_size=None):
+        """
+        Packs the files under directory into the container output, one stream of member headers and data
+        followed by an index of the members (see cellar.pack).
+        If volume_size is given, a new volume (output.1, output.2 ...) is started after that many bytes.
+        Returns the volume paths
+        """
+        directory, output = Path(directory), Path(output)
+        if directory.resolve() in output.resolve().parents:
+            raise CellarError(f'Pack {output} can not be inside the packed directory {directory}')
+        paths, packed = iter(walk(directory)), []
+        while paths is not None:
+            path = volume_path(output, len(packed))
+            reader = PackReader(directory, paths, self.block_size, volume_size, self.read_ahead)
+            header = Header(self.block_size, flags=FLAG_PACK)
+            async with aiofiles.open(path, 'wb') as fo:
+                await self.encrypt_chunks(reader.read, fo.write, header=header)
+                # the plaintext length in the header locates the index of the members
+                header.length, header.chunk_count = reader.offset, -(-reader.offset // self.block_size)
+                await fo.seek(0)
+                await fo.write(header.pack())
+            self.stats.files += len(reader.index)
+            logger.info(f'Packed {len(reader.index)} files of {directory} into {path}')
+            packed.append(path)
+            paths = None if reader.pending is None else chain(reader.pending, paths)
+        # drop volumes left over from a bigger pack
+        number = len(packed)
+        while volume_path(output, number).is_file():
+            volume_path(output, number).unlink()
+            number += 1
+        return packed
+
+    async def read_pack_index(self, path):
+        """
+        Decrypts only the member index of a pack volume, as a dict of name: [offset, size, mode, mtime_ns].
+        Returns None if the plaintext length is not in the header (packs written to streams)
+        """
+        async with aiofiles.open(path, 'rb') as fi:
+            header = Header.unpack(await fi.read(Header.size))
+        if header is None or not header.flags & FLAG_PACK:
+            raise ContainerError(f'{path} is not a pack')
+        if not header.length:
+            return None
+        index_offset, = OFFSET.unpack(await self.decrypt_bytes(path, header.length - OFFSET.size, OFFSET.size))
+        return json.loads(await self.decrypt_bytes(path, index_offset, header.length - OFFSET.size - index_offset))
+
+    async def extract_member(self, path, name, entry, outdir):
+        """
+        Extracts the member name of the pack volume path under outdir, decrypting only the chunks of its data
+        """
+        offset, size, mode, mtime_ns = entry
+        target = member_path(outdir, name)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        async with aiofiles.open(target, 'wb') as fo:
+            await self.decrypt_range(path, fo.write, offset, size)
+        os.chmod(target, mode)
+        os.utime(target, ns=(mtime_ns, mtime_ns))
+
+    async def unpack(self, pack, outdir, members=None):
+        """
+        Extracts the files of the pack and its volumes under outdir, or only the named members.
+        Named members are found through the index of each volume, the whole tree is decrypted in one pass.
+        Returns the names of the extracted files
+        """
+        if not Path(pack).is_file():
+            raise CellarError(f'No pack found at {pack}')
+        extracted, missing = [], None if members is None else set(members)
+        for path in volumes(pack):
+            index = None if missing is None else await self.read_pack_index(path)
+            if index is not None:
+                for name in sorted(missing & index.keys()):
+                    await self.extract_member(path, name, index[name], outdir)
+                    extracted.append(name)
+                missing -= index.keys()
+                continue
+            extractor = PackExtractor(outdir, missing)
+            async with aiofiles.open(path, 'rb') as fi:
+                await self.decrypt_chunks(fi.read, extractor.write)
+            extractor.close()
+            extracted.extend(extractor.extracted)
+            if missing is not None:
+                missing -= set(extractor.extracted)
+        if missing:
+            raise CellarError(f'Not in pack {pack}: {", ".join(sorted(missing))}')
+        self.stats.files += len(extracted)
+        logger.info(f'Extracted {len(extracted)} files of {pack} to {outdir}')
+        return extracted
+
+    async def pack_stream(self, directory, outstream=sys.stdout.buffer):
+        """
+        Encrypts the tree under directory into one ordered stream of pack chunks (default stdout),
+        with the names and metadata of the files encrypted inline with their content (see cellar.pack).
+        With read_ahead, that many chunks are encrypted and small files read in parallel
+        """
+        reader = PackReader(directory, walk(directory), self.block_size, prefetch=self.read_ahead)
+        header = Header(self.block_size, flags=FLAG_PACK)
+        await self.encrypt_chunks(reader.read, stream_writer(outstream, self.read_ahead > 0), header=header)
+        self.stats.files += len(reader.index)
+        logger.info(f'Encrypted {len(reader.index)} files of {directory} to a stream')
+
+    async def unpack_stream(self, outdir, instream=sys.stdin.buffer):
+        """
+        Rebuilds under outdir the tree of a pack_stream from instream (default stdin) in one pass.
+        Returns the names of the extracted files
+        """
+        read = stream_reader(instream, self.read_ahead > 0)
+        head = await read(Header.size)
+        header = Header.unpack(head)
+        if header is None or not header.flags & FLAG_PACK:
+            raise ContainerError('Not an encrypted tree stream')
+
+        async def replay(size):
+            nonlocal head
+            if head:
+                data, head = head[:size], head[size:]
+                return data
+            return await read(size)
+
+        extractor = PackExtractor(outdir)
+        await self.decrypt_chunks(replay, extractor.write)
+        extractor.close()
+        self.stats.files += len(extractor.extracted)
+        logger.info(f'Decrypted {len(extractor.extracted)} files from a stream to {outdir}')
+        return extractor.extracted
+
+    async def backend_name(self, relpath):
+        """
+        Name of the relative path of a file in a storage backend
+        """
+        return PurePosixPath(relpath).as_posix()
+
+    async def backend_path(self, name):
+        """
+        Relative path of a file from its name in a storage backend
+        """
+        return PurePosixPath(name)
+
+    async def encrypt_to(self, paths, backend=None):
+        """
+        Encrypts files and directories straight into a storage backend (see cellar.backends), the current directory
+        by default. Nothing is staged on disk and the sources are kept. Files are named by their path relative
+        to the parent of the given path. Returns the names written
+        """
+        if self.store:
+            raise CellarError('Deduplicated files can not be written to a storage backend')
+        backend = backend or LocalBackend('.')
+        written = []
+
+        async def encrypt(item):
+            path, relpath = item
+            name = await self.backend_name(relpath)
+            async with self.semaphore:
+                self.stats.in_flight += 1
+                writer = await backend.writer(name)
+                try:
+                    async with aiofiles.open(path, 'rb') as fi:
+                        await self.encrypt_chunks(self.timed('read', fi.read), writer.write, os.path.getsize(path))
+                    await writer.close()
+                except BaseException:
+                    await writer.abort()
+                    raise
+                finally:
+                    self.stats.in_flight -= 1
+                self.stats.files += 1
+            summary.add('Encrypted', path)
+            written.append(name)
+
+        def items():
+            for path in map(Path, paths):
+                if path.is_dir():
+                    yield from ((file, file.relative_to(path.parent)) for file in walk(path))
+                else:
+                    yield path, Path(path.name)
+
+        await self.map_crypto(encrypt, items())
+        logger.info(f'Encrypted {len(written)} files to {backend}')
+        return written
+
+    async def decrypt_from(self, backend, outdir, names=None):
+        """
+        Decrypts the files of a storage backend (or only the given names) under outdir, reading them straight from it.
+        Returns the relative paths of the decrypted files
+        """
+        decrypted = []
+
+        async def decrypt(name):
+            relpath = await self.backend_path(name)
+            target = member_path(outdir, relpath.as_posix())
+            target.parent.mkdir(parents=True, exist_ok=True)
+            async with self.semaphore:
+                self.stats.in_flight += 1
+                try:
+                    read = await backend.reader(name)
+                    async with aiofiles.open(target, 'wb') as fo:
+                        await self.decrypt_chunks(read, fo.write)
+                finally:
+                    self.stats.in_flight -= 1
+                self.stats.files += 1
+            summary.add('Decrypted', target)
+            decrypted.append(relpath.as_posix())
+
+        await self.map_crypto(decrypt, await backend.names() if names is None else names)
+        logger.info(f'Decrypted {len(decrypted)} files from {backend} to {outdir}')
+        return decrypted
+
+    def use_mmap(self, infile, encrypt=True):
+        """
+        Whether infile is big enough to go through the mmap engine (needs os.pwrite).
+        Only raw chunks are memory mapped, not containers
+        """
+        if self.mmap_size is None or not hasattr(os, 'pwrite'):
+            return False
+        if os.path.getsize(infile) < max(self.mmap_size, 1):
+            return False
+        return self.raw_chunks(infile, encrypt)
+
+    def use_buffers(self, infile, encrypt=True):
+        """
+        Whether infile goes through the buffer engine (needs os.preadv and os.pwrite).
+        Only raw chunks are handled, not containers
+        """
+        if not self.buffers or not hasattr(os, 'preadv') or not hasattr(os, 'pwrite'):
+            return False
+        return self.raw_chunks(infile, encrypt)
+
+    def raw_chunks(self, infile, encrypt=True):
+        """
+        Whether infile is en/decrypted as raw chunks rather than a container
+        """
+        if encrypt:
+            return not self.container and not self.engine.chained
+        with open(infile, 'rb') as fi:
+            return not is_container(fi.read(Header.size))
+
+    async def mmap_crypto(self, infile, outfile, encrypt=True):
+        """
+        Memory maps infile, preallocates outfile to its exact final size and
+        writes each en/decrypted chunk straight to its offset in outfile.
+        Chunks are independent so they run in parallel on the executor and are written out of order
+        """
+        insize, outsize = self.block_size, self.block_size + self.overhead
+        if not encrypt:
+            insize, outsize = outsize, insize
+        size = os.path.getsize(infile)
+        chunks = -(-size // insize)
+        total = size + chunks * (outsize - insize)
+        if total < 0:
+            raise self.decryption_error(CryptoError(f'{infile} is too short to be encrypted'))
+        with open(infile, 'rb') as fi, open(outfile, 'wb') as fo:
+            fd = fo.fileno()
+            os.ftruncate(fd, total)
+            if hasattr(os, 'posix_fallocate') and total:
+                try:
+                    os.posix_fallocate(fd, 0, total)
+                except OSError:
+                    pass  # not supported by the filesystem, ftruncate has already sized it
+
+            with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as src:
+                def crypt_chunk(index):
+                    chunk = src[index * insize:(index + 1) * insize]
+                    data = self.box.encrypt(chunk, self.nonce) if encrypt else self.box.decrypt(chunk)
+                    os.pwrite(fd, data, index * outsize)
+                    return len(chunk)
+
+                window = max(self.workers, 1) * 2
+                try:
+                    for start in range(0, chunks, window):
+                        indexes = range(start, min(start + window, chunks))
+                        sizes = await asyncio.gather(*(self.run_crypto(crypt_chunk, index) for index in indexes))
+                        self.total_bytes += sum(sizes)
+                except CryptoError as exc:
+                    raise self.decryption_error(exc)
+
+    async def buffered_crypto(self, infile, outfile, encrypt=True):
+        """
+        En/decrypts infile into outfile through a fixed pool of `buffers` reusable chunk buffers.
+        Each chunk is read with preadv into its buffer, run through the libsodium secretbox primitives
+        into the output buffer and written with pwrite at its offset, all in one crypto call.
+        Nonces come from the counter of the cellar (see cellar.buffers), memory use stays at 2 chunks per buffer
+        """
+        insize, outsize = self.block_size, self.block_size + self.overhead
+        if not encrypt:
+            insize, outsize = outsize, insize
+        size = os.path.getsize(infile)
+        chunks = -(-size // insize)
+        total = size + chunks * (outsize - insize)
+        if total < 0:
+            raise self.decryption_error(CryptoError(f'{infile} is too short to be encrypted'))
+        slots = [Slot(insize, outsize) for _ in range(min(self.buffers, chunks))]
+        with open(infile, 'rb') as fi, open(outfile, 'wb') as fo:
+            infd, outfd = fi.fileno(), fo.fileno()
+            os.ftruncate(outfd, total)
+
+            def crypt_chunk(slot, index):
+                read = slot.read(infd, insize, index * insize)
+                if encrypt:
+                    written = slot.encrypt(self.key, self.nonces, read)
+                else:
+                    written = slot.decrypt(self.key, read)
+                os.pwrite(outfd, slot.outview[:written], index * outsize)
+                return read
+
+            try:
+                for start in range(0, chunks, self.buffers):
+                    indexes = range(start, min(start + self.buffers, chunks))
+                    sizes = await asyncio.gather(*(self.run_crypto(crypt_chunk, slot, index)
+                                                   for slot, index in zip(slots, indexes)))
+                    self.total_bytes += sum(sizes)
+            except CryptoError as exc:
+                raise self.decryption_error(exc)
 
     async def map_crypto(self, func, iters):
-        await asyncio.gather(*(func(arg) for arg in iters))
+        """
+        Streams iters through a bounded queue drained by `concurrency` workers running func.
+        Memory stays constant no matter how many items there are and the first one starts right away
+        """
+        queue = asyncio.Queue(self.concurrency)
+
+        async def produce():
+            for arg in iters:
+                await queue.put(arg)
+                self.stats.queued += 1
+            for _ in workers:
+                await queue.put(None)
+
+        async def consume():
+            arg = await queue.get()
+            while arg is not None:
+                self.stats.queued -= 1
+                await func(arg)
+                arg = await queue.get()
+
+        workers = [asyncio.ensure_future(consume()) for _ in range(self.concurrency)]
+        tasks = [asyncio.ensure_future(produce())] + workers
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def map_shards(self, method, paths, collect=None):
+        """
+        Splits paths into shards of shard_size and runs the named method on them in a pool of worker processes.
+        Each worker has its own event loop and copy of the cellar (and key).
+        Stats of the shards are merged into the cellar stats, results are passed to collect
+        and any failures are raised together at the end
+        """
+        loop = asyncio.get_event_loop()
+        failures, pending = [], set()
+
+        def gather(done):
+            for future in done:
+                stats, errors, results = future.result()
+                self.stats.merge(stats)
+                failures.extend(errors)
+                if collect is not None:
+                    collect(results)
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.processes, context, _init_shard_worker, (pickle.dumps(self),)) as pool:
+            for shard in chunked(paths, self.shard_size):
+                if len(pending) >= self.processes * 2:
+                    done, pending = await asyncio.wait(pending, return_when=FIRST_COMPLETED)
+                    gather(done)
+                pending.add(loop.run_in_executor(pool, _run_shard, method, shard))
+            if pending:
+                done, _ = await asyncio.wait(pending)
+                gather(done)
+        for path, error in failures:
+            logger.error(f'Failed {method} on {path}: {error}')
+        if failures:
+            raise CellarError(f'{len(failures)} files failed to {method.split("_")[0]}')
+
+    async def map_files(self, method, paths, collect=None, journal=None, **options):
+        """
+        Runs the named method on all paths, sharded across processes if the cellar has any.
+        Non None results of the method are passed to collect in lists.
+        With a journal, the files are recorded as they are processed (see journaled, options are passed to it)
+        and are not sharded
+        """
+        if self.processes and journal is None:
+            return await self.map_shards(method, paths, collect)
+        func = getattr(self, method)
+        if journal is not None:
+            func = self.journaled(journal, func, **options)
+
+        async def run(path):
+            result = await func(path)
+            if collect is not None and result is not None:
+                collect([result])
+
+        await self.map_crypto(run, paths)
+
+    async def watch_file(self, path):
+        """
+        Encrypts a file found by watch unless it is already ciphertext of this cellar
+        """
+        if path.is_file() and not await self.is_encrypted(path):
+            await self.encrypt_file(path)
+
+    async def watch(self, directory, interval=1.0, settle=1.0, poll=False, stop=None):
+        """
+        Encrypts the files created or moved under directory until stop (an asyncio.Event) is set, forever by default.
+        Every interval seconds the files that did not change for settle seconds are encrypted as one batch
+        in the background while the watching goes on. Files are found with inotify where available
+        (unless poll is True) and with a poller of the directory mtimes elsewhere, so the tree is only walked once
+        """
+        changes = watcher(directory, settle, poll)
+        batches, busy = set(), set()
+
+        async def encrypt(path):
+            # skip the temp files written by the files being encrypted
+            if path in busy or path.with_suffix('') in busy:
+                return
+            busy.add(path)
+            try:
+                await self.watch_file(path)
+            except Exception as exc:
+                logger.error(f'Failed to encrypt {path}: {exc}')
+            finally:
+                busy.discard(path)
+
+        logger.info(f'Watching {directory} with {changes.__class__.__name__.lower()}')
+        stop = stop or asyncio.Event()
+        try:
+            while not stop.is_set():
+                ready = changes.poll()
+                if ready:
+                    batch = asyncio.ensure_future(self.map_crypto(encrypt, ready))
+                    batches.add(batch)
+                    batch.add_done_callback(batches.discard)
+                try:
+                    await asyncio.wait_for(stop.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+            if batches:
+                await asyncio.wait(batches)
+        finally:
+            for batch in batches:
+                batch.cancel()
+            changes.close()
+        logger.info(f'Stopped watching {directory}')
 
 
 class OverwritePathCellar(BaseCellar):
+    def __init__(self, key, *args, **kwargs):
+        super().__init__(key, *args, **kwargs)
+        if self.delta:
+            raise CellarError('Delta re-encryption compares files with the plaintext they were encrypted from, '
+                              'it needs encrypted names and keep')
+
     async def encrypt_file(self, plainfile, preserve=None):
-        tmpfile = plainfile.with_suffix(f'{plainfile.suffix}.enc')
+        tmpfile = self.tmp_path(plainfile)
         await self.read_write_crypto(plainfile, tmpfile)
-        tmpfile.replace(plainfile)
-        logger.info(f'Encrypted file {plainfile}')
+        with self.stats.timer('rename'):
+            tmpfile.replace(plainfile)
+        summary.add('Encrypted', plainfile)
 
     async def decrypt_file(self, cipherfile, preserve=None):
-        tmpfile = cipherfile.with_suffix(f'{cipherfile.suffix}.dec')
+        tmpfile = self.tmp_path(cipherfile, False)
         await self.read_write_crypto(cipherfile, tmpfile, False)
-        tmpfile.replace(cipherfile)
-        logger.info(f'Decrypted file {cipherfile}')
+        with self.stats.timer('rename'):
+            tmpfile.replace(cipherfile)
+        summary.add('Decrypted', cipherfile)
+
+    @staticmethod
+    def tmp_path(path, encrypt=True):
+        """
+        Temp file the en/decrypted content of path is written to before it replaces path
+        """
+        return path.with_suffix(f'{path.suffix}.{"enc" if encrypt else "dec"}')
 
     async def encrypt_dir(self, plaindir, preserve=False):
-        await self.map_crypto(self.encrypt_file, (path for path in plaindir.rglob('*') if path.is_file()))
+        async def processed(item):
+            # files encrypted by an interrupted run whose records were lost authenticate
+            if isinstance(item, tuple):
+                relpath, path, _ = item
+                if await self.is_encrypted(path):
+                    return True, (relpath, Manifest.entry(path.stat(), None, relpath))
+                return False, None
+            return await self.is_encrypted(item), None
+
+        async with self.journaling(plaindir, 'encrypt') as journal:
+            if not self.manifest:
+                await self.map_files('encrypt_file', walk(plaindir), None, journal, target=self.tmp_path,
+                                     processed=processed)
+            else:
+                manifest = await self.load_manifest(plaindir)
+                await self.map_files('update_file', manifest.pending(plaindir, walk(plaindir)), manifest.update,
+                                     journal, target=self.tmp_path, processed=processed)
+                manifest.prune()
+                await self.save_manifest(manifest)
         logger.info(f'Encrypted directory {plaindir}')
 
+    async def update_file(self, item):
+        """
+        Encrypts a (relpath, path, entry) item from Manifest.pending unless it is still the ciphertext of the entry.
+        Returns the relpath and its new manifest entry.
+        Only the stats of the ciphertext are recorded. A file whose stats changed is only left as is
+        if every one of its chunks still authenticates (it was only touched), anything else is encrypted again
+        """
+        relpath, path, entry = item
+        if entry is None or not await self.is_encrypted(path, True):
+            await self.encrypt_file(path)
+        return relpath, Manifest.entry(path.stat(), None, relpath)
+
     async def decrypt_dir(self, cipherdir, preserve=False):
-        await self.map_crypto(self.decrypt_file, (path for path in cipherdir.rglob('*') if path.is_file()))
+        async with self.journaling(cipherdir, 'decrypt') as journal:
+            async def processed(path):
+                # the interrupted run started this file and its journal decrypted so the key is right:
+                # if it no longer authenticates it was decrypted in place
+                relpath = path.relative_to(cipherdir).as_posix()
+                return relpath in journal.started and not await self.is_encrypted(path), None
+
+            await self.map_files('decrypt_file', walk(cipherdir), None, journal,
+                                 target=lambda path: self.tmp_path(path, False), processed=processed)
         logger.info(f'Decrypted directory {cipherdir}')
 
 
 class EncryptedPathCellar(BaseCellar):
     """
-    Cellar that encrypts the filenames as well as the content
+    Cellar that encrypts the filenames as well as the content.
+    If deterministic is True, names are encrypted with a nonce derived from a keyed hash of the name (SIV style)
+    so the same name always gets the same ciphertext and trees keep the same layout between runs.
+    If keep is True, the sources of en/decrypted files and directories are preserved unless told otherwise
     """
     prefix = '.enc.'
 
-    async def encrypt_file(self, plainfile, cipherfile=None, preserve=False):
+    def __init__(self, key, *args, deterministic=False, keep=False, **kwargs):
+        super().__init__(key, *args, **kwargs)
+        if self.delta and not keep:
+            raise CellarError('Delta re-encryption compares files with the plaintext they were encrypted from, '
+                              'it needs keep')
+        self.deterministic = deterministic
+        self.keep = keep
+        self.name_key = self.derive_key(b'cellar-names')
+
+    async def encrypt_name(self, name):
+        """
+        Encrypts and encodes a file or directory name
+        """
+        if isinstance(name, str):
+            name = name.encode()
+        if not self.deterministic:
+            encname = await self.encrypt(name)
+        else:
+            nonce = blake2b(name, self.box.NONCE_SIZE, self.name_key, encoder=RawEncoder)
+            encname = await self.run_crypto(self.box.encrypt, name, nonce, self.encoder_class())
+        return encname.decode()
+
+    async def decrypt_name(self, encname):
+        """
+        Decodes and decrypts a file or directory name without its prefix
+        """
+        name = await self.decrypt(encname[len(self.prefix):].encode())
+        return name.decode()
+
+    async def backend_name(self, relpath):
+        parts = [f'{self.prefix}{await self.encrypt_name(part)}' for part in PurePosixPath(relpath).parts]
+        return '/'.join(parts)
+
+    async def backend_path(self, name):
+        return PurePosixPath(*[await self.decrypt_name(part) for part in PurePosixPath(name).parts])
+
+    async def encrypt_file(self, plainfile, cipherfile=None, preserve=None):
         f"""
         Encrypts a plainfile and creates the cipherfile.
         By default it encrypts the filename and file content itself.
@@ -156,17 +1618,22 @@ class EncryptedPathCellar(BaseCellar):
         The new file starts with the '{self.prefix}' prefix
         """
         plainfile = plainfile if isinstance(plainfile, Path) else Path(plainfile)
+        preserve = self.keep if preserve is None else preserve
         if cipherfile is None:
-            enc = await self.encrypt(plainfile.name.encode())
-            enc = enc.decode()
+            enc = await self.encrypt_name(plainfile.name)
             cipherfile = plainfile.parent / f'{self.prefix}{enc}'
         await self.read_write_crypto(plainfile, cipherfile)
-        logger.debug(f'Encrypted file {plainfile} -> {cipherfile}')
+        summary.add('Encrypted', plainfile)
         if not preserve:
             plainfile.unlink()
         return cipherfile
 
-    async def decrypt_file(self, cipherfile, plainfile=None, preserve=False):
+    async def watch_file(self, path):
+        # ciphertext this cellar is still writing may not authenticate yet
+        if not path.name.startswith(self.prefix):
+            await super().watch_file(path)
+
+    async def decrypt_file(self, cipherfile, plainfile=None, preserve=None):
         f"""
         Decrypts a cipherfile into the plainfile.
         By default it decrypts the filename and file content itself.
@@ -174,67 +1641,208 @@ class EncryptedPathCellar(BaseCellar):
         The cipherfile file starts with the '{self.prefix}' prefix
         """
         cipherfile = cipherfile if isinstance(cipherfile, Path) else Path(cipherfile)
-        dec = await self.decrypt(cipherfile.name[len(self.prefix):])
-        dec = dec.decode()
+        preserve = self.keep if preserve is None else preserve
+        dec = await self.decrypt_name(cipherfile.name)
         if plainfile is None:
             plainfile = cipherfile.parent / dec
         await self.read_write_crypto(cipherfile, plainfile, False)
         if not preserve:
             cipherfile.unlink()
-        logger.debug(f'Decrypted file {cipherfile} -> {plainfile}')
+        summary.add('Decrypted', cipherfile)
         return plainfile
 
-    async def encrypt_dir(self, plaindir, preserve=False):
+    @contextmanager
+    def indexing(self, root):
+        """
+        Opens the name index of the encrypted tree root to append to, compacted once the run completes
+        """
+        index = Index(Index.for_tree(root), self.box).load().open()
+        try:
+            yield index
+        except BaseException:
+            index.close(False)
+            raise
+        index.close()
+
+    def load_index(self, encdir):
+        """
+        Loads the name index of the encrypted tree encdir
+        """
+        path = Index.for_tree(encdir)
+        if not path.is_file():
+            raise CellarError(f'No index of {encdir}, encrypt it again to create one')
+        return Index(path, self.box).load()
+
+    async def encrypt_dir(self, plaindir, preserve=None):
         """
         Encrypts entire directory with all file/dir names and file content
-        If preserve is True, plaindir is preserved but by default it's deleted
+        If preserve is True, plaindir is preserved but by default it's deleted.
+        Each source directory name is encrypted and created only once per run.
+        The files are recorded in the name index of the encrypted tree (see cellar.index).
+        With a journal, an interrupted run resumes into the same encrypted directories
         """
         plaindir = plaindir if isinstance(plaindir, Path) else Path(plaindir)
-        encplain = await self.encrypt(plaindir.name.encode())
-        encbase = plaindir.parent / f'{self.prefix}{encplain.decode()}'
-        tasks = []
-        for path in plaindir.rglob('*'):
-            if path.name.startswith(self.prefix) or path.is_dir():
-                # dont double encrypt files, skip dirs
-                continue
-            relpath = path.relative_to(plaindir)
-            encparent = await self.encrypt(bytes(relpath.parent))
-            encparent = encparent.decode()
-            encname = await self.encrypt(path.name.encode())
-            encname = encname.decode()
-            cipherfile = encbase / f'{self.prefix}{encparent}' / f'{self.prefix}{encname}'
-            cipherfile.parent.mkdir(parents=True, exist_ok=True)
-            tasks.append(self.encrypt_file(path, cipherfile, preserve))
-        await asyncio.gather(*tasks)
-        if not preserve:
-            rmtree(plaindir)
+        preserve = self.keep if preserve is None else preserve
+        if self.delta and not preserve:
+            raise CellarError('Delta re-encryption needs the plaintext to be preserved')
+        async with self.journaling(plaindir, 'encrypt') as journal:
+            manifest = await self.load_manifest(plaindir) if self.manifest else None
+            if journal is not None and '' in journal.dirs:
+                encbase = Path(journal.dirs[''])
+            elif manifest is not None and manifest.root:
+                encbase = plaindir.parent / manifest.root
+            else:
+                encplain = await self.encrypt_name(plaindir.name)
+                encbase = plaindir.parent / f'{self.prefix}{encplain}'
+            if journal is not None:
+                journal.dir('', encbase)
+            encbase.mkdir(parents=True, exist_ok=True)
+            with self.indexing(encbase) as index:
+
+                @memoize
+                async def encrypt_parent(relparent):
+                    if journal is not None and relparent.as_posix() in journal.dirs:
+                        return Path(journal.dirs[relparent.as_posix()])
+                    encparent = await self.encrypt_name(bytes(relparent))
+                    encparent = encbase / f'{self.prefix}{encparent}'
+                    encparent.mkdir(parents=True, exist_ok=True)
+                    if journal is not None:
+                        journal.dir(relparent.as_posix(), encparent)
+                    return encparent
+
+                async def cipher_path(path):
+                    relpath = path.relative_to(plaindir)
+                    encparent = await encrypt_parent(relpath.parent)
+                    encname = await self.encrypt_name(path.name)
+                    cipherfile = encparent / f'{self.prefix}{encname}'
+                    if journal is not None:
+                        journal.start(relpath.as_posix(), cipherfile)
+                    return cipherfile
+
+                async def encrypt_path(path):
+                    stat = path.stat()
+                    cipherfile = await cipher_path(path)
+                    await self.encrypt_file(path, cipherfile, preserve)
+                    index.add(path.relative_to(plaindir).as_posix(), cipherfile.relative_to(encbase), stat)
+                    return cipherfile
+
+                async def update_path(item):
+                    relpath, path, entry = item
+                    digest = oldfile = chunks = None
+                    if entry is not None:
+                        oldfile = plaindir.parent / entry['cipher']
+                        if oldfile.is_file() and self.delta:
+                            digest, chunks = await self.delta_crypto(path, oldfile, self.delta_hashes(entry, oldfile))
+                        elif oldfile.is_file():
+                            digest = await self.unchanged(path, entry)
+                    if digest is not None:
+                        cipher = entry['cipher']
+                        index.add(relpath, (plaindir.parent / cipher).relative_to(encbase), path.stat())
+                    elif self.delta:
+                        cipherfile = await cipher_path(path)
+                        digest, chunks = await self.delta_crypto(path, cipherfile)
+                        cipher = cipherfile.relative_to(plaindir.parent).as_posix()
+                        index.add(relpath, cipherfile.relative_to(encbase), path.stat())
+                    else:
+                        digest = await self.hash_file(path) if preserve else None
+                        cipherfile = await encrypt_path(path)
+                        cipher = cipherfile.relative_to(plaindir.parent).as_posix()
+                        if oldfile is not None and oldfile != cipherfile and oldfile.is_file():
+                            # the file changed, drop its outdated ciphertext
+                            oldfile.unlink()
+                    if preserve:
+                        return relpath, Manifest.entry(path.stat(), digest, cipher, chunks)
+
+                # dont double encrypt files
+                paths = (path for path in walk(plaindir) if not path.name.startswith(self.prefix))
+                if manifest is None:
+                    encrypt = encrypt_path if journal is None else self.journaled(journal, encrypt_path)
+                    await self.map_crypto(encrypt, paths)
+                else:
+                    manifest.root = encbase.name
+
+                    update = update_path if journal is None else self.journaled(journal, update_path)
+
+                    async def collect(item):
+                        result = await update(item)
+                        if result is not None:
+                            manifest.update([result])
+
+                    await self.map_crypto(collect, manifest.pending(plaindir, paths))
+                    manifest.prune()
+                    index.prune(manifest.seen)
+                    await self.save_manifest(manifest)
+            if not preserve:
+                rmtree(plaindir)
         logger.info(f'Encrypted directory {plaindir}')
         return encbase
 
-    async def decrypt_dir(self, encdir, preserve=False):
+    async def decrypt_dir(self, encdir, preserve=None, only=None):
         """
         Decrypts entire directory with all file/dir names and file content
         If preserve is True, encdir is preserved but by default it's deleted
+        Each encrypted directory name is decrypted and created only once per run.
+        If only is given, just the files that are or are under those relative paths are decrypted,
+        found through the name index (see decrypt_selected)
         """
         encdir = encdir if isinstance(encdir, Path) else Path(encdir)
-        decbase = await self.decrypt(encdir.name[len(self.prefix):])
-        decbase = encdir.parent / Path(decbase.decode())
-        tasks = []
-        for path in encdir.rglob('*'):
-            if path.is_dir():
-                continue
-            relpath = path.relative_to(encdir)
-            decparent = await self.decrypt(str(relpath.parent)[len(self.prefix):].encode())
-            decparent = decparent.decode()
-            decname = await self.decrypt(relpath.name[len(self.prefix):])
-            decname = decname.decode()
-            decpath = decbase / decparent / decname
-            decpath.parent.mkdir(parents=True, exist_ok=True)
-            tasks.append(self.decrypt_file(path, decpath, preserve))
-
-        await asyncio.gather(*tasks)
-        #     asyncio.run(main())
-        if not preserve:
-            rmtree(encdir)
+        preserve = self.keep if preserve is None else preserve
+        decbase = await self.decrypt_name(encdir.name)
+        decbase = encdir.parent / Path(decbase)
+        if only is not None:
+            await self.decrypt_selected(encdir, decbase, only, preserve)
+            return decbase
+
+        @memoize
+        async def decrypt_parent(encparent):
+            decparent = await self.decrypt_name(encparent)
+            decparent = decbase / decparent
+            decparent.mkdir(parents=True, exist_ok=True)
+            return decparent
+
+        async with self.journaling(encdir, 'decrypt') as journal:
+            async def decrypt_path(path):
+                relpath = path.relative_to(encdir)
+                decparent = await decrypt_parent(str(relpath.parent))
+                decname = await self.decrypt_name(relpath.name)
+                if journal is not None:
+                    journal.start(relpath.as_posix(), decparent / decname)
+                return await self.decrypt_file(path, decparent / decname, preserve)
+
+            decrypt = decrypt_path if journal is None else self.journaled(journal, decrypt_path)
+            await self.map_crypto(decrypt, walk(encdir))
+            if not preserve:
+                rmtree(encdir)
+                if Index.for_tree(encdir).is_file():
+                    Index.for_tree(encdir).unlink()
         logger.info(f'Decrypted directory {encdir}')
         return decbase
+
+    async def decrypt_selected(self, encdir, decbase, paths, preserve):
+        """
+        Decrypts the files of encdir that are or are under the relative paths into decbase.
+        They are looked up in the name index, no other names or files are decrypted.
+        Unless preserved, their ciphertext is deleted and they are removed from the index.
+        Returns the relative paths of the decrypted files
+        """
+        index = self.load_index(encdir)
+        selected, missing = index.select(paths)
+        if missing:
+            raise CellarError(f'Not in {encdir}: {", ".join(missing)}')
+
+        async def decrypt(item):
+            relpath, entry = item
+            plainfile = decbase.joinpath(*PurePosixPath(relpath).parts)
+            plainfile.parent.mkdir(parents=True, exist_ok=True)
+            await self.decrypt_file(encdir / entry['cipher'], plainfile, preserve)
+            if not preserve:
+                index.remove(relpath)
+
+        if not preserve:
+            index.open()
+        try:
+            await self.map_crypto(decrypt, selected)
+        finally:
+            index.close()
+        logger.info(f'Decrypted {len(selected)} files of {encdir}')
+        return [relpath for relpath, _ in selected]
@@ -0,0 +1,130 @@
+"""
+Cipher engines for the content of files and streams.
+
+secretbox (the default and the format of existing files) writes raw chunks of nonce(24) MAC(16) ciphertext,
+each one independent so they are en/decrypted in parallel and by range.
+Its chunks are encrypted by the cellar itself (see BaseCellar.encrypt), the engine only stands for it in ENGINES
+and decrypts them. Only chained engines are pluggable: they make the encryptors and decryptors of their streams
+and are found back from their container header flag (see engine_for).
+
+secretstream writes a container header flagged FLAG_SECRETSTREAM, the 24 byte secretstream header
+and raw chunks of block_size plaintext as MAC(16) tag(1) ciphertext (libsodium crypto_secretstream_xchacha20poly1305).
+Chunks are chained so truncated, dropped or reordered chunks fail to decrypt, and the last one is tagged
+as the end of the stream. The container header is authenticated with every chunk.
+Being chained, its chunks are en/decrypted in order and can not be decrypted by range
+"""
+from nacl.secret import SecretBox
+from nacl.exceptions import CryptoError
+from nacl import bindings
+
+from .container import FLAG_SECRETSTREAM
+
+
+class Engine:
+    """
+    Base of the cipher engines. A chained engine makes an encryptor for every stream of chunks it encrypts
+    and a decryptor from the engine header that encryptor wrote
+    """
+    name = None
+    #: Container header flag of the streams it writes, 0 for raw chunks
+    flag = 0
+    #: Bytes added to each chunk
+    overhead = 0
+    #: Bytes of engine header written before the chunks
+    header_size = 0
+    #: Whether chunks depend on the previous ones so they have to be en/decrypted in order
+    chained = False
+
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name}>'
+
+
+class BoxDecryptor:
+    chained = False
+    finished = True
+
+    def __init__(self, box):
+        self.box = box
+
+    def decrypt(self, chunk):
+        return self.box.decrypt(chunk)
+
+
+class SecretBoxEngine(Engine):
+    name = 'secretbox'
+    overhead = SecretBox.NONCE_SIZE + SecretBox.MACBYTES
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.box = SecretBox(key)
+
+    def decryptor(self, header=b'', ad=None):
+        return BoxDecryptor(self.box)
+
+
+class StreamEncryptor:
+    """
+    Pushes chunks through a secretstream state, the header has to be written before them
+    """
+
+    def __init__(self, key, ad=None):
+        self.state = bindings.crypto_secretstream_xchacha20poly1305_state()
+        self.header = bindings.crypto_secretstream_xchacha20poly1305_init_push(self.state, key)
+        self.ad = ad
+
+    def encrypt(self, chunk, last=False):
+        tag = (bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL if last else
+               bindings.crypto_secretstream_xchacha20poly1305_TAG_MESSAGE)
+        return bindings.crypto_secretstream_xchacha20poly1305_push(self.state, chunk, self.ad, tag)
+
+
+class StreamDecryptor:
+    """
+    Pulls chunks through a secretstream state. finished is only True once the final chunk was decrypted
+    """
+    chained = True
+
+    def __init__(self, key, header, ad=None):
+        self.state = bindings.crypto_secretstream_xchacha20poly1305_state()
+        bindings.crypto_secretstream_xchacha20poly1305_init_pull(self.state, header, key)
+        self.ad = ad
+        self.finished = False
+
+    def decrypt(self, chunk):
+        if self.finished:
+            raise CryptoError('Chunk after the end of the stream')
+        plaintext, tag = bindings.crypto_secretstream_xchacha20poly1305_pull(self.state, chunk, self.ad)
+        self.finished = tag == bindings.crypto_secretstream_xchacha20poly1305_TAG_FINAL
+        return plaintext
+
+
+class SecretStreamEngine(Engine):
+    name = 'secretstream'
+    flag = FLAG_SECRETSTREAM
+    overhead = bindings.crypto_secretstream_xchacha20poly1305_ABYTES
+    header_size = bindings.crypto_secretstream_xchacha20poly1305_HEADERBYTES
+    chained = True
+
+    def encryptor(self, ad=None):
+        return StreamEncryptor(self.key, ad)
+
+    def decryptor(self, header, ad=None):
+        if len(header) < self.header_size:
+            raise CryptoError('Truncated secretstream header')
+        return StreamDecryptor(self.key, header, ad)
+
+
+ENGINES = {engine.name: engine for engine in (SecretBoxEngine, SecretStreamEngine)}
+
+
+def engine_for(flags):
+    """
+    Chained engine class of a container from its header flags, None for secretbox chunks
+    """
+    for engine in ENGINES.values():
+        if engine.chained and flags & engine.flag:
+            return engine
+    return None
@@ -0,0 +1,12 @@
+class CellarError(Exception):
+    pass
+
+
+class DecryptionError(CellarError):
+    pass
+
+
+class ContainerError(DecryptionError):
+    """
+    Raised for malformed or truncated container files
+    """
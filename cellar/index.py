@@ -0,0 +1,111 @@
+"""
+Encrypted name index of a tree written by EncryptedPathCellar.encrypt_dir, so it can be listed, searched
+and partly restored without decrypting any names or content.
+Each line is an encrypted JSON object::
+
+    {relpath: {"cipher": ciphertext path relative to the tree, "size": plaintext size, "mtime_ns": plaintext mtime}}
+
+with null entries for files removed from the tree. Later lines override earlier ones.
+A line is appended as each file is encrypted, so interrupted runs keep theirs,
+and the index is compacted into lines of `batch` entries once a run changed it
+"""
+from fnmatch import fnmatch
+from pathlib import Path, PurePosixPath
+
+from .log import logger
+from .records import RecordFile
+
+
+class Index(RecordFile):
+    kind = 'index'
+    #: Entries per line when compacted
+    batch = 1000
+
+    def __init__(self, path, box):
+        super().__init__(path, box)
+        self.files = {}
+        self.changed = False
+
+    def __repr__(self):
+        return f'<Index {self.path} files={len(self.files)}>'
+
+    def __len__(self):
+        return len(self.files)
+
+    @classmethod
+    def for_tree(cls, root):
+        """
+        Index path of the encrypted tree root (a hidden sibling file)
+        """
+        root = Path(root)
+        return root.parent / f'.{root.name}.index'
+
+    def load(self):
+        """
+        Reads the index if there is one
+        """
+        for entries in self.records():
+            self.files.update(entries)
+        self.files = {relpath: entry for relpath, entry in self.files.items() if entry is not None}
+        return self
+
+    def add(self, relpath, cipher, stat=None):
+        """
+        Records the ciphertext path (relative to the tree) of relpath and the stat of its plaintext if known
+        """
+        entry = {'cipher': PurePosixPath(cipher).as_posix(), 'size': stat and stat.st_size,
+                 'mtime_ns': stat and stat.st_mtime_ns}
+        self.files[relpath] = entry
+        self.append({relpath: entry})
+
+    def remove(self, relpath):
+        if self.files.pop(relpath, None) is not None:
+            self.append({relpath: None})
+
+    def append(self, entries):
+        self.changed = True
+        if self.file is not None:
+            self.write(entries)
+
+    def prune(self, seen):
+        """
+        Removes the files not in seen
+        """
+        for relpath in [relpath for relpath in self.files if relpath not in seen]:
+            self.remove(relpath)
+
+    def find(self, pattern):
+        """
+        Sorted (relpath, entry) pairs whose path or file name matches the glob pattern
+        """
+        return [(relpath, entry) for relpath, entry in sorted(self.files.items())
+                if fnmatch(relpath, pattern) or fnmatch(PurePosixPath(relpath).name, pattern)]
+
+    def select(self, paths):
+        """
+        Sorted (relpath, entry) pairs of the files that are or are under one of the relative paths.
+        Returns the paths that matched nothing as well
+        """
+        paths = [PurePosixPath(path).as_posix().strip('/') for path in paths]
+        found, missing = {}, []
+        for path in paths:
+            if path in self.files:
+                found[path] = self.files[path]
+                continue
+            under = {relpath: entry for relpath, entry in self.files.items() if relpath.startswith(f'{path}/')}
+            if not under:
+                missing.append(path)
+            found.update(under)
+        return sorted(found.items()), missing
+
+    def close(self, compact=True):
+        """
+        Closes the index and compacts it if it changed
+        """
+        super().close()
+        if not compact or not self.changed:
+            return
+        items = sorted(self.files.items())
+        self.rewrite(dict(items[start:start + self.batch]) for start in range(0, len(items), self.batch))
+        self.changed = False
+        logger.debug(f'Saved index {self.path} with {len(self)} files')
@@ -0,0 +1,105 @@
+"""
+Write-ahead journal of a directory run, so an interrupted run can resume where it stopped.
+Each line is an encrypted JSON record::
+
+    {"op": "start", "path": relpath, "target": path written to or null}
+    {"op": "done", "path": relpath, "result": result of the file method}
+    {"op": "dir", "path": relpath ("" for the top), "target": encrypted directory}
+
+Records are written as soon as they happen but only fsynced in batches (see Journal.sync),
+together with the files completed since the last batch
+"""
+import os
+from pathlib import Path
+
+from .log import logger
+from .records import RecordFile
+
+
+class Journal(RecordFile):
+    kind = 'journal'
+    #: Number of completed files between fsyncs
+    sync_every = 100
+
+    def __init__(self, path, top, box):
+        super().__init__(path, box)
+        self.top = Path(top)
+        self.started = {}
+        self.done = {}
+        self.dirs = {}
+        self.resumed = False
+        self.pending = []
+
+    def __repr__(self):
+        return f'<Journal {self.path} done={len(self.done)} started={len(self.started)}>'
+
+    @classmethod
+    def for_dir(cls, directory, operation):
+        """
+        Journal path of an operation on the directory (a hidden sibling file)
+        """
+        directory = Path(directory)
+        return directory.parent / f'.{directory.name}.{operation}.journal'
+
+    def load(self):
+        """
+        Reads the records of an interrupted run, if any. Files started but not done are left in started
+        """
+        if not self.path.is_file():
+            return self
+        self.resumed = True
+        for record in self.records():
+            if record['op'] == 'start':
+                self.started[record['path']] = record['target']
+            elif record['op'] == 'done':
+                self.started.pop(record['path'], None)
+                self.done[record['path']] = record['result']
+            elif record['op'] == 'dir':
+                self.dirs[record['path']] = record['target']
+        logger.info(f'Resuming from journal {self.path}: {len(self.done)} files done, {len(self.started)} partial')
+        return self
+
+    def start(self, relpath, target=None):
+        self.write({'op': 'start', 'path': relpath, 'target': target and str(target)})
+
+    def finish(self, relpath, path, result=None):
+        """
+        Records relpath as done, written to path. Returns True when a batch is ready to be synced
+        """
+        self.write({'op': 'done', 'path': relpath, 'result': result})
+        self.done[relpath] = result
+        self.pending.append(path)
+        return len(self.pending) >= self.sync_every
+
+    def dir(self, relpath, target):
+        self.write({'op': 'dir', 'path': relpath, 'target': str(target)})
+        self.dirs[relpath] = str(target)
+
+    def sync(self):
+        """
+        Fsyncs the files completed since the last sync and their directories, then the journal
+        (records are only flushed as they are written).
+        Blocking, the cellar runs it in the default executor
+        """
+        pending, self.pending = self.pending, []
+        directories = {Path(path).parent for path in pending}
+        for path in list(pending) + list(directories):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def close(self, remove=True):
+        """
+        Closes the journal and removes it once the run completed
+        """
+        self.sync()
+        super().close()
+        if remove:
+            self.path.unlink()
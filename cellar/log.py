@@ -1,4 +1,11 @@
+import json
+import queue
+import atexit
 import logging
+from time import monotonic
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+
 import click
 
 
@@ -10,6 +17,9 @@ LEVEL_MAP = {
     3: logging.DEBUG
 }
 
+_listener = _queue_handler = None
+
+
 class ClickHandler(logging.Handler):
     _use_stderr = True
     colors = {
@@ -20,26 +30,109 @@ class ClickHandler(logging.Handler):
         'critical': 'bright_red',
     }
 
+    def __init__(self, level=logging.NOTSET, color=True):
+        super().__init__(level)
+        self.color = color
+
     def emit(self, record):
         try:
             msg = self.format(record)
             level = record.levelname.lower()
-            click.secho(msg, fg=self.colors[level], err=self._use_stderr)
+            click.secho(msg, fg=self.colors[level] if self.color else None, err=self._use_stderr)
         except Exception:
             self.handleError(record)
 
-def setup(level=0, filename=None):
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line
+    """
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class Summary:
+    """
+    Aggregates per file log lines into one INFO line every `every` files or `interval` seconds,
+    whichever comes first. The line of each file is only logged at DEBUG
+    """
+
+    def __init__(self, logger, every=1000, interval=5.0):
+        self.logger = logger
+        self.every = every
+        self.interval = interval
+        self.counts = Counter()
+        self.started = monotonic()
+
+    def add(self, action, path):
+        self.logger.debug('%s file %s', action, path)
+        self.counts[action] += 1
+        if sum(self.counts.values()) >= self.every or monotonic() - self.started >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.counts:
+            counts = ', '.join(f'{action} {count} files' for action, count in self.counts.items())
+            self.logger.info('%s in the last %.1fs', counts, monotonic() - self.started)
+        self.counts.clear()
+        self.started = monotonic()
+
+
+#: Summary of the files en/decrypted by the cellars
+summary = Summary(logger)
+
+
+def setup(level=0, filename=None, json_format=False):
+    """
+    Sends the cellar logs through a queue to the console (and filename) handlers,
+    which a background thread writes to so logging never blocks the event loop
+    """
+    global _listener, _queue_handler
+    shutdown()
     level = LEVEL_MAP.get(level)
     logger.setLevel(level)
     format = '%(asctime)s %(levelname)s %(name)s %(funcName)s: %(message)s'
     # logging.basicConfig(filename=filename, level=level, format=format)
-    formatter = logging.Formatter(format)
-    console = ClickHandler()
+    formatter = JSONFormatter() if json_format else logging.Formatter(format)
+    console = ClickHandler(color=not json_format)
     console.setLevel(level)
     console.setFormatter(formatter)
-    logger.addHandler(console)
+    handlers = [console]
     if filename:
         filehandler = logging.FileHandler(filename.name)
         filehandler.setLevel(level)
         filehandler.setFormatter(formatter)
-        logger.addHandler(filehandler)
+        handlers.append(filehandler)
+    records = queue.SimpleQueue()
+    _queue_handler = QueueHandler(records)
+    logger.addHandler(_queue_handler)
+    _listener = QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown():
+    """
+    Logs the pending summary and waits for the background writer to drain the queue
+    """
+    global _listener, _queue_handler
+    summary.flush()
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        logger.removeHandler(_queue_handler)
+        _listener = _queue_handler = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,73 @@
+from pathlib import Path
+
+
+class Manifest:
+    """
+    Record of the files in a tree a cellar has already encrypted, so later runs only process new or modified ones.
+    Maps the path of each file relative to the tree root to the size, mtime_ns, inode and keyed content hash
+    it had when last processed (no hash for files encrypted in place) and the ciphertext path it was written to,
+    plus the keyed hashes of its chunks for delta re-encryption (see BaseCellar.delta_crypto).
+    The cellar stores it encrypted next to the tree (see BaseCellar.load_manifest)
+    """
+    version = 1
+
+    def __init__(self, path, files=None, root=None):
+        self.path = Path(path)
+        self.files = files or {}
+        self.root = root
+        self.seen = set()
+
+    def __repr__(self):
+        return f'<Manifest {self.path} files={len(self.files)}>'
+
+    def __len__(self):
+        return len(self.files)
+
+    @classmethod
+    def for_dir(cls, directory):
+        """
+        Manifest path for the directory (a hidden sibling file)
+        """
+        directory = Path(directory)
+        return directory.parent / f'.{directory.name}.manifest'
+
+    def to_dict(self):
+        return {'version': self.version, 'root': self.root, 'files': self.files}
+
+    @staticmethod
+    def entry(stat, digest, cipher=None, chunks=None):
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino, 'hash': digest,
+                 'cipher': cipher}
+        if chunks is not None:
+            entry['chunks'] = chunks
+        return entry
+
+    @staticmethod
+    def same_stat(entry, stat):
+        return (entry['size'], entry['mtime_ns'], entry['inode']) == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def pending(self, top, paths):
+        """
+        Yields (relpath, path, entry) for each of the paths under top whose size, mtime and inode
+        differ from its manifest entry (entry is None for new files).
+        Files with matching stats are skipped without reading them
+        """
+        for path in paths:
+            relpath = path.relative_to(top).as_posix()
+            self.seen.add(relpath)
+            entry = self.files.get(relpath)
+            if entry is not None and self.same_stat(entry, path.stat()):
+                continue
+            yield relpath, path, entry
+
+    def update(self, results):
+        """
+        Updates entries from (relpath, entry) pairs
+        """
+        self.files.update(results)
+
+    def prune(self):
+        """
+        Drops the entries of files that were not seen in the last pending walk
+        """
+        self.files = {relpath: entry for relpath, entry in self.files.items() if relpath in self.seen}
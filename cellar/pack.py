@@ -0,0 +1,219 @@
+"""
+Pack format bundling the files of a tree into the plaintext of a single container, like tar with an index.
+All integers are little endian::
+
+    members  name_size(u32) mode(u32) mtime_ns(i64) size(u64) name(name_size) data(size)  ...  name_size(u32)=0 ...
+    index    JSON object of name: [data offset, size, mode, mtime_ns]
+    trailer  offset(u64) of the index
+
+Members can be extracted in one pass from the start (streams) or one by one through the index
+with the chunk index of the container (see BaseCellar.read_pack_index)
+"""
+import os
+import json
+import struct
+import asyncio
+from collections import deque
+from itertools import chain
+from pathlib import Path, PurePosixPath
+
+import aiofiles
+
+from .exceptions import ContainerError
+
+
+MEMBER = struct.Struct('<IIqQ')
+OFFSET = struct.Struct('<Q')
+END = MEMBER.pack(0, 0, 0, 0)
+
+
+def volumes(path):
+    """
+    Yields the volumes of the pack at path (path, path.1, path.2 ...) that exist
+    """
+    number = 0
+    while volume_path(path, number).is_file():
+        yield volume_path(path, number)
+        number += 1
+
+
+def volume_path(path, number):
+    path = Path(path)
+    return path if not number else path.with_name(f'{path.name}.{number}')
+
+
+def member_path(outdir, name):
+    """
+    Path to extract the member name to under outdir, refusing names that would escape it
+    """
+    parts = PurePosixPath(name).parts
+    if not parts or PurePosixPath(name).is_absolute() or '..' in parts:
+        raise ContainerError(f'Invalid pack member name {name!r}')
+    return Path(outdir).joinpath(*parts)
+
+
+async def read_member(path, size):
+    async with aiofiles.open(path, 'rb') as fi:
+        return await fi.read(size)
+
+
+class PackReader:
+    """
+    Reads the files under top as the plaintext of a pack through the read coroutine.
+    If volume_size is given, the volume ends after the member that reaches that many bytes
+    and pending is set to the next paths, for the next volume to start from.
+    With prefetch, up to that many of the next files of at most block_size bytes are read concurrently
+    while the current one is packed
+    """
+
+    def __init__(self, top, paths, block_size, volume_size=None, prefetch=0):
+        self.top = Path(top)
+        self.paths = paths
+        self.prefetch = prefetch
+        self.ahead = deque()
+        self.block_size = block_size
+        self.volume_size = volume_size
+        self.buffer = bytearray()
+        self.offset = 0
+        self.index = {}
+        self.file = None
+        self.remaining = 0
+        self.pending = None
+        self.done = False
+
+    async def read(self, size):
+        while len(self.buffer) < size and not self.done:
+            await self.fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def emit(self, data):
+        self.buffer += data
+        self.offset += len(data)
+
+    async def fill(self):
+        if self.file is not None:
+            data = await self.file.read(min(self.remaining, self.block_size))
+            if not data:
+                raise ContainerError(f'{self.file.name} was truncated while packing it')
+            self.remaining -= len(data)
+            self.emit(data)
+            if not self.remaining:
+                await self.close_member()
+            return
+        path, stat, data = self.next_member()
+        if path is not None and self.volume_size is not None and self.offset >= self.volume_size:
+            self.pending = [path] + [ahead[0] for ahead in self.ahead]
+            for _, _, future in chain([(path, stat, data)], self.ahead):
+                if future is not None:
+                    future.cancel()
+            self.ahead.clear()
+            path = None
+        if path is None:
+            return self.finish()
+        name = path.relative_to(self.top).as_posix().encode()
+        self.emit(MEMBER.pack(len(name), stat.st_mode & 0o7777, stat.st_mtime_ns, stat.st_size) + name)
+        self.index[name.decode()] = [self.offset, stat.st_size, stat.st_mode & 0o7777, stat.st_mtime_ns]
+        if data is not None:
+            data = await data
+            if len(data) < stat.st_size:
+                raise ContainerError(f'{path} was truncated while packing it')
+            self.emit(data)
+        elif stat.st_size:
+            self.file, self.remaining = await aiofiles.open(path, 'rb'), stat.st_size
+
+    def next_member(self):
+        """
+        Returns the (path, stat, data) of the next file to pack, (None, None, None) at the end.
+        data is the future of the content of prefetched files and None for the others
+        """
+        while len(self.ahead) <= self.prefetch:
+            path = next(self.paths, None)
+            if path is None:
+                break
+            stat, data = path.stat(), None
+            if self.prefetch and 0 < stat.st_size <= self.block_size:
+                data = asyncio.ensure_future(read_member(path, stat.st_size))
+            self.ahead.append((path, stat, data))
+        return self.ahead.popleft() if self.ahead else (None, None, None)
+
+    async def close_member(self):
+        await self.file.close()
+        self.file = None
+
+    def finish(self):
+        self.emit(END)
+        index_offset = self.offset
+        self.emit(json.dumps(self.index).encode())
+        self.emit(OFFSET.pack(index_offset))
+        self.done = True
+
+
+class PackExtractor:
+    """
+    Extracts the members of a pack under outdir from its plaintext, passed through the write coroutine in one pass.
+    If members is given, only those names are extracted
+    """
+
+    def __init__(self, outdir, members=None):
+        self.outdir = Path(outdir)
+        self.members = members
+        self.buffer = bytearray()
+        self.header = None
+        self.file = None
+        self.remaining = 0
+        self.extracted = []
+        self.done = False
+
+    async def write(self, data):
+        self.buffer += data
+        while self.buffer and not self.done:
+            if self.header is None:
+                if len(self.buffer) < MEMBER.size or not self.read_header():
+                    return
+            elif self.remaining:
+                data = bytes(self.buffer[:self.remaining])
+                del self.buffer[:len(data)]
+                self.remaining -= len(data)
+                if self.file is not None:
+                    self.file.write(data)
+            if self.header is not None and not self.remaining:
+                self.close_member()
+        if self.done:
+            self.buffer.clear()
+
+    def read_header(self):
+        name_size, mode, mtime_ns, size = MEMBER.unpack(self.buffer[:MEMBER.size])
+        if not name_size:
+            self.done = True
+            return True
+        if len(self.buffer) < MEMBER.size + name_size:
+            return False
+        name = bytes(self.buffer[MEMBER.size:MEMBER.size + name_size]).decode()
+        del self.buffer[:MEMBER.size + name_size]
+        self.header, self.remaining = (name, mode, mtime_ns), size
+        if self.members is None or name in self.members:
+            path = member_path(self.outdir, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # members are mostly small, plain writes avoid a thread hop per file
+            self.file = open(path, 'wb')
+        return True
+
+    def close_member(self):
+        name, mode, mtime_ns = self.header
+        self.header = None
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        path = member_path(self.outdir, name)
+        os.chmod(path, mode)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        self.extracted.append(name)
+
+    def close(self):
+        if self.header is not None or not self.done:
+            if self.file is not None:
+                self.file.close()
+            raise ContainerError('Truncated pack')
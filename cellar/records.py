@@ -0,0 +1,81 @@
+"""
+Append-only files of encrypted JSON records, the storage of journals and indexes (see cellar.journal and cellar.index).
+Each line is one record encrypted with the secret box and URL safe base64 encoded
+"""
+import os
+import json
+from pathlib import Path
+
+from nacl.encoding import URLSafeBase64Encoder
+from nacl.exceptions import CryptoError
+
+from .log import logger
+from .exceptions import DecryptionError
+
+
+class RecordFile:
+    #: What the records are called in warnings
+    kind = 'record file'
+
+    def __init__(self, path, box):
+        self.path = Path(path)
+        self.box = box
+        self.file = None
+        # end of the last whole line if the file ends with a torn one
+        self.torn = None
+
+    def records(self):
+        """
+        Yields the records of the file, if there is one. A damaged last line after whole ones (torn by a crash
+        while writing it) is skipped and cut off when the file is opened again.
+        Any other damaged line raises a DecryptionError, most likely the key is not the one the file was written with
+        """
+        if not self.path.is_file():
+            return
+        offset = 0
+        with open(self.path, 'rb') as fi:
+            for number, line in enumerate(fi, 1):
+                try:
+                    record = json.loads(self.box.decrypt(line.strip(), encoder=URLSafeBase64Encoder))
+                except (CryptoError, ValueError):
+                    if not offset or fi.read(1):
+                        raise DecryptionError(f'Can not decrypt line {number} of {self.kind} {self.path}. '
+                                              f'Make sure the decryption key is correct')
+                    logger.warning(f'Skipping torn last line of {self.kind} {self.path}')
+                    self.torn = offset
+                    return
+                offset += len(line)
+                yield record
+
+    def encode(self, record):
+        data = json.dumps(record, default=str).encode()
+        return self.box.encrypt(data, encoder=URLSafeBase64Encoder) + b'\n'
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        if self.torn is not None:
+            self.file.truncate(self.torn)
+            self.torn = None
+        return self
+
+    def write(self, record):
+        self.file.write(self.encode(record))
+        # flushed right away so killed processes lose nothing
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def rewrite(self, records):
+        """
+        Atomically replaces the whole file with records
+        """
+        tmpfile = self.path.with_name(f'{self.path.name}.tmp')
+        with open(tmpfile, 'wb') as fo:
+            for record in records:
+                fo.write(self.encode(record))
+            fo.flush()
+            os.fsync(fo.fileno())
+        tmpfile.replace(self.path)
@@ -0,0 +1,132 @@
+import asyncio
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+
+
+class Stats:
+    """
+    Runtime metrics of a cellar: bytes and files processed, time spent reading, en/decrypting, writing
+    and renaming and how many files are queued or in flight.
+    Subscribed callbacks get a snapshot dict every progress interval while the cellar runs (see watch)
+    """
+    phases = ('read', 'crypto', 'write', 'rename')
+
+    def __init__(self):
+        self.bytes = 0
+        self.files = 0
+        self.expected_bytes = None
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.queued = 0
+        self.in_flight = 0
+        self.started = perf_counter()
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'<Stats bytes={self.bytes} files={self.files}>'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock'], state['callbacks']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def add_time(self, phase, seconds):
+        # crypto times are added from the executor threads
+        with self._lock:
+            self.times[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, perf_counter() - start)
+
+    def merge(self, other):
+        """
+        Adds the counts and times of other stats, like the ones of shard worker processes
+        """
+        self.bytes += other.bytes
+        self.files += other.files
+        for phase, seconds in other.times.items():
+            self.add_time(phase, seconds)
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self.started
+
+    def snapshot(self):
+        elapsed = self.elapsed
+        rate = self.bytes / elapsed if elapsed else 0.0
+        eta = None
+        if self.expected_bytes is not None and rate:
+            eta = max(self.expected_bytes - self.bytes, 0) / rate
+        return {
+            'elapsed': elapsed,
+            'bytes': self.bytes,
+            'files': self.files,
+            'bytes_per_s': rate,
+            'files_per_s': self.files / elapsed if elapsed else 0.0,
+            'times': dict(self.times),
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'expected_bytes': self.expected_bytes,
+            'eta': eta,
+        }
+
+    def subscribe(self, callback):
+        """
+        Calls callback with a snapshot dict on every notification
+        """
+        self.callbacks.append(callback)
+
+    def notify(self):
+        snapshot = self.snapshot()
+        for callback in self.callbacks:
+            callback(snapshot)
+
+    async def watch(self, main, interval):
+        """
+        Runs the main coroutine, notifying subscribers every interval seconds and once more at the end
+        """
+        async def report():
+            while True:
+                await asyncio.sleep(interval)
+                self.notify()
+
+        reporter = asyncio.ensure_future(report())
+        try:
+            return await main
+        finally:
+            reporter.cancel()
+            self.notify()
+
+
+def sizeof(nbytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(nbytes) < 1024:
+            break
+        nbytes /= 1024
+    else:
+        unit = 'TiB'
+    return f'{nbytes:.1f} {unit}'
+
+
+def progress_line(snapshot):
+    """
+    One line summary of a snapshot, with the share of time spent in each phase
+    """
+    busy = sum(snapshot['times'].values()) or 1
+    phases = ' '.join(f'{phase} {seconds / busy:.0%}' for phase, seconds in snapshot['times'].items())
+    line = (f'{sizeof(snapshot["bytes"])} {snapshot["files"]} files {sizeof(snapshot["bytes_per_s"])}/s '
+            f'in flight {snapshot["in_flight"]} queued {snapshot["queued"]} | {phases}')
+    if snapshot['eta'] is not None:
+        line += f' | eta {snapshot["eta"]:.0f}s'
+    return line
@@ -0,0 +1,53 @@
+"""
+Content addressed store of encrypted chunks for deduplication (see BaseCellar.store_crypto).
+Every unique chunk of plaintext is encrypted once and kept under the keyed BLAKE2b hash of its plaintext::
+
+    store/ab/abcdef...   secretbox ciphertext of the chunk whose hash is abcdef...
+
+Files become recipes: containers flagged FLAG_RECIPE whose plaintext is the 32 byte hashes of their chunks in order.
+Chunks are never removed, so a store only grows
+"""
+import os
+from pathlib import Path
+
+import aiofiles
+from nacl.utils import random
+
+from .exceptions import ContainerError
+
+
+class ChunkStore:
+    #: Bytes of the chunk hashes
+    digest_size = 32
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def __repr__(self):
+        return f'<ChunkStore {self.path}>'
+
+    def object_path(self, digest):
+        name = digest.hex()
+        return self.path / name[:2] / name
+
+    def __contains__(self, digest):
+        return self.object_path(digest).is_file()
+
+    async def put(self, digest, data):
+        """
+        Writes the encrypted chunk of digest. Concurrent writers of the same chunk each write their own temp file
+        and atomically replace the object with the same content
+        """
+        path = self.object_path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmpfile = path.with_name(f'{path.name}.{random(8).hex()}.tmp')
+        async with aiofiles.open(tmpfile, 'wb') as fo:
+            await fo.write(data)
+        os.replace(tmpfile, path)
+
+    async def get(self, digest):
+        try:
+            async with aiofiles.open(self.object_path(digest), 'rb') as fi:
+                return await fi.read()
+        except FileNotFoundError:
+            raise ContainerError(f'Chunk {digest.hex()} is missing from the store {self.path}')
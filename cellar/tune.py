@@ -0,0 +1,206 @@
+"""
+Auto-tuning of the block size of each file and of the number of files en/decrypted at once (see BaseCellar auto_tune).
+Block sizes grow with the size of the files, between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE,
+and are recorded in the container header of every file so decryption does not need to know them.
+The files in flight are bounded by a Limiter whose limit a Tuner moves while the cellar runs,
+from the throughput, the time each file takes and the resident memory of the process
+"""
+import os
+import sys
+import asyncio
+from collections import deque
+from time import perf_counter
+
+from .log import logger
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+MIN_BLOCK_SIZE = 2 ** 16
+MAX_BLOCK_SIZE = 2 ** 23
+
+
+def pick_block_size(length, chunks=16):
+    """
+    Block size cutting length bytes into about chunks chunks: a power of two between MIN_BLOCK_SIZE and MAX_BLOCK_SIZE
+    """
+    size = 1 << max(length // chunks - 1, 0).bit_length()
+    return min(max(size, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def rss():
+    """
+    Resident memory of the process in bytes, the peak one where the current one is not known. None if neither is
+    """
+    try:
+        with open('/proc/self/statm') as fi:
+            return int(fi.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Limiter:
+    """
+    Semaphore whose limit can be changed while it is held.
+    Lowering it lets the current holders finish and holds back the next ones.
+    Keeps the number of releases, of acquisitions that had to wait and the total seconds it was held for,
+    summed over the holders
+    """
+
+    def __init__(self, limit):
+        self._limit = max(limit, 1)
+        self.held = 0
+        self.waiters = deque()
+        self.releases = 0
+        self.waits = 0
+        self._held_time = 0.0
+        self._changed = perf_counter()
+
+    def __repr__(self):
+        return f'<Limiter {self.held}/{self._limit}>'
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, value):
+        self._limit = max(value, 1)
+        self.wake()
+
+    @property
+    def held_time(self):
+        return self._held_time + self.held * (perf_counter() - self._changed)
+
+    def add(self, count):
+        now = perf_counter()
+        self._held_time += self.held * (now - self._changed)
+        self._changed = now
+        self.held += count
+
+    def wake(self):
+        while self.waiters and self.held < self._limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.add(1)
+                waiter.set_result(None)
+
+    async def acquire(self):
+        if self.held < self._limit and not self.waiters:
+            self.add(1)
+            return
+        self.waits += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # woken up and cancelled before running
+            if waiter.done() and not waiter.cancelled():
+                self.add(-1)
+                self.wake()
+            raise
+
+    def release(self):
+        self.add(-1)
+        self.releases += 1
+        self.wake()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class Tuner:
+    """
+    Moves the limit of files in flight every interval seconds by hill climbing on the throughput:
+    it keeps moving the limit the way that raised the bytes per second and turns back when they dropped
+    or when the time each file takes grew without any gain. The limit is halved whenever the resident memory
+    goes over max_rss and never raised past what max_rss leaves room for
+    """
+    #: Relative change of the throughput and latency that counts as one
+    tolerance = 0.05
+
+    def __init__(self, limit=4, max_limit=100, max_rss=None, interval=0.5):
+        self.max_limit = max_limit
+        self.max_rss = max_rss
+        self.interval = interval
+        self.limiter = Limiter(min(limit, max_limit))
+        self.direction = 1
+        self.previous = None
+        self.history = []
+
+    def __repr__(self):
+        return f'<Tuner limit={self.limiter.limit}/{self.max_limit}>'
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['limiter'] = Limiter(self.limiter.limit)
+        return state
+
+    def adjust(self, rate, latency, memory=None, saturated=True):
+        """
+        New limit from the throughput (bytes per second), the mean seconds per file and the resident memory
+        measured at the current limit. It is not raised unless the limit was saturated (files were waiting on it)
+        """
+        limit = self.limiter.limit
+        tolerance = self.tolerance
+        if self.max_rss and memory is not None and memory > self.max_rss:
+            new = limit // 2
+            # the throughput over the ceiling is no reference for the next move
+            self.direction, self.previous = 1, None
+        else:
+            if self.previous is not None:
+                last_rate, last_latency = self.previous
+                if rate < last_rate * (1 - tolerance):
+                    self.direction = -self.direction
+                elif rate <= last_rate * (1 + tolerance) and latency > last_latency * (1 + tolerance):
+                    # more files only wait for each other
+                    self.direction = -1
+            new = limit + self.direction * max(limit // 4, 1)
+            if new > limit and not saturated:
+                new = limit
+            if new > limit and self.max_rss and memory is not None and memory * new / limit > self.max_rss:
+                new = limit
+            self.previous = rate, latency
+        new = min(max(new, 1), self.max_limit)
+        self.history.append((limit, rate, latency, memory))
+        if new != limit:
+            logger.debug(f'Auto-tune: {limit} -> {new} files in flight at {rate:.0f} B/s, {latency:.3f}s per file')
+        self.limiter.limit = new
+        return new
+
+    async def watch(self, main, stats):
+        """
+        Runs the main coroutine, adjusting the limit from stats every interval seconds while files are in flight
+        """
+        async def tune():
+            limiter = self.limiter
+            last = (perf_counter(), stats.bytes, limiter.releases, limiter.waits, limiter.held_time)
+            while True:
+                await asyncio.sleep(self.interval)
+                now = (perf_counter(), stats.bytes, limiter.releases, limiter.waits, limiter.held_time)
+                elapsed, nbytes, releases, waits, held_time = (b - a for a, b in zip(last, now))
+                if not nbytes and not releases:
+                    # waiting on something else than the files in flight
+                    continue
+                # mean time in flight of the files (Little's law), or the whole interval if none finished
+                latency = held_time / releases if releases else elapsed
+                self.adjust(nbytes / elapsed, latency, rss(), waits > 0 or limiter.held >= limiter.limit)
+                last = now
+
+        tuner = asyncio.ensure_future(tune())
+        try:
+            return await main
+        finally:
+            tuner.cancel()
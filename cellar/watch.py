@@ -0,0 +1,196 @@
+"""
+Watchers finding the files that appear under a directory (see BaseCellar.watch).
+Both hand out files once they have settled: no change for `settle` seconds.
+Inotify is used on Linux, elsewhere the Poller lists again only the directories whose mtime changed
+"""
+import os
+import sys
+import ctypes
+import ctypes.util
+import struct
+from time import monotonic
+from pathlib import Path
+
+from .log import logger
+
+
+def stat_key(stat):
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+class Watcher:
+    """
+    Base of the watchers. poll returns the files that settled since the last call
+    """
+
+    def __init__(self, top, settle=1.0):
+        self.top = Path(top)
+        self.settle = settle
+        #: path: (stat key, time it was last seen changing)
+        self.pending = {}
+
+    def touch(self, path):
+        """
+        Marks path as changed, it is handed out once it settles
+        """
+        try:
+            key = stat_key(os.stat(path))
+        except OSError:
+            self.pending.pop(path, None)
+            return
+        previous = self.pending.get(path)
+        if previous is None or previous[0] != key:
+            self.pending[path] = key, monotonic()
+
+    def settled(self):
+        """
+        Pops the pending files which did not change for settle seconds
+        """
+        now, ready = monotonic(), []
+        for path, (key, changed) in list(self.pending.items()):
+            self.touch(path)
+            if path in self.pending and self.pending[path] == (key, changed) and now - changed >= self.settle:
+                del self.pending[path]
+                ready.append(path)
+        return ready
+
+    def poll(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class Poller(Watcher):
+    """
+    Keeps the mtime of every directory under top and lists again the ones that changed.
+    Files are found when they are created, moved in or replaced, not when rewritten in place
+    """
+
+    def __init__(self, top, settle=1.0):
+        super().__init__(top, settle)
+        #: directory: (mtime_ns, {file name: stat key})
+        self.dirs = {}
+        self.scan(os.fspath(self.top))
+
+    def scan(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError:
+            self.dirs.pop(directory, None)
+            return
+        files = {}
+        old = self.dirs.get(directory, (None, {}))[1]
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in self.dirs:
+                    self.scan(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                key = stat_key(entry.stat(follow_symlinks=False))
+                files[entry.name] = key
+                if old.get(entry.name) != key:
+                    self.touch(Path(entry.path))
+        self.dirs[directory] = mtime, files
+
+    def poll(self):
+        for directory, (mtime, _) in list(self.dirs.items()):
+            try:
+                changed = os.stat(directory).st_mtime_ns != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self.scan(directory)
+        return self.settled()
+
+
+class Inotify(Watcher):
+    """
+    Watches every directory under top with inotify (Linux) and reads its events without blocking.
+    Files are found when they are closed after writing or moved in
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    event = struct.Struct('iIII')
+
+    def __init__(self, top, settle=1.0):
+        super().__init__(top, settle)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.add_tree(os.fspath(self.top))
+
+    @classmethod
+    def available(cls):
+        return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def add_tree(self, directory):
+        """
+        Watches directory and the ones under it, and marks the files already in them as changed
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.mask)
+        if wd < 0:
+            logger.warning(f'Could not watch {directory}: {os.strerror(ctypes.get_errno())}')
+            return
+        self.watches[wd] = directory
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.add_tree(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                self.touch(Path(entry.path))
+
+    def read(self):
+        try:
+            return os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return b''
+
+    def poll(self):
+        data = self.read()
+        while data:
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = self.event.unpack_from(data, offset)
+                name = data[offset + self.event.size:offset + self.event.size + size].rstrip(b'\0')
+                offset += self.event.size + size
+                if mask & self.IN_Q_OVERFLOW:
+                    logger.warning(f'Inotify queue overflowed, rescanning {self.top}')
+                    self.add_tree(os.fspath(self.top))
+                elif mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                elif wd in self.watches and name:
+                    path = os.path.join(self.watches[wd], os.fsdecode(name))
+                    if mask & self.IN_ISDIR:
+                        self.add_tree(path)
+                    elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                        self.touch(Path(path))
+            data = self.read()
+        return self.settled()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(top, settle=1.0, poll=False):
+    """
+    Inotify watcher of top if available (and poll is False), else a Poller
+    """
+    if not poll and Inotify.available():
+        try:
+            return Inotify(top, settle)
+        except OSError as exc:
+            logger.warning(f'Falling back to polling: {exc}')
+    return Poller(top, settle)
@@ -26,10 +26,11 @@ setup(
     long_description=read_file('README.md'),
     long_description_content_type='text/markdown',
     install_requires=['pynacl', 'click', 'aiofiles'],
+    extras_require={'s3': ['boto3']},
     entry_points={
         'console_scripts': ['cellar = cellar.cli:cli']
     },
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     project_urls={
         'Documentation': 'https://pynacl-cellar.readthedocs.io/',
         'Source': 'https://github.com/justquick/salt-cellar',
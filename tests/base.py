@@ -1,5 +1,6 @@
 from pathlib import Path
 from hashlib import sha1
+from shutil import copytree
 from unittest.mock import patch
 
 from nacl.secret import SecretBox
@@ -17,15 +18,25 @@ class CellarTests:
     key = b'k' * SecretBox.KEY_SIZE
     testdir = Path(__file__).parent
     cellar_class = crypt.BaseCellar
+    cellar_kwargs = {}
 
     @property
     def cellar(self):
-        return self.cellar_class(self.key)
+        return self.cellar_class(self.key, **self.cellar_kwargs)
 
     def get_path(self, *args):
         # testdir = os.path.abspath(os.path.dirname(__file__))
         return joinpath(self.testdir, 'data', *args)
 
+    def copy_data(self, tmp_path):
+        return copytree(self.get_path('level1'), tmp_path / 'level1')
+
+    def read_tree(self, root):
+        return {path.relative_to(root).as_posix(): path.read_bytes() for path in root.rglob('*') if path.is_file()}
+
+    def shas(self, adir):
+        return {path.relative_to(adir).as_posix(): self.sha(path) for path in adir.rglob('*') if path.is_file()}
+
     def file_shas(self, adir):
         return self.sha(*[p for p in adir.rglob('*') if p.is_file()])
 
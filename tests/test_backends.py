@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+from cellar.crypt import OverwritePathCellar, EncryptedPathCellar, CellarError
+from cellar.backends import LocalBackend, ObjectBackend, LocalObjectClient, backend_for
+
+from .base import CellarTests
+
+
+class TestObjectBackend(CellarTests):
+    cellar_class = OverwritePathCellar
+    cellar_kwargs = {'block_size': 1000, 'concurrency': 4}
+
+    def backend_for(self, tmp_path):
+        self.client = LocalObjectClient(tmp_path / 's3', latency=0.01)
+        return ObjectBackend(self.client, 'bucket', 'backups', part_size=5000, concurrency=4)
+
+    def make_tree(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        (plaindir / 'big.bin').write_bytes(os.urandom(60000))
+        return plaindir
+
+    @pytest.mark.asyncio
+    async def test_round_trip(self, tmp_path):
+        plaindir = self.make_tree(tmp_path)
+        backend = self.backend_for(tmp_path)
+        cellar = self.cellar
+        names = await cellar.encrypt_to([plaindir], backend)
+        assert len(names) == 5 and sorted(names) == await backend.names()
+        # the sources are kept
+        assert (plaindir / 'big.bin').stat().st_size == 60000
+
+        # the big file went up in parts, several at once, the small ones in a single put
+        assert self.client.calls['complete_multipart_upload'] == 1
+        assert self.client.calls['upload_part'] == 13
+        assert self.client.calls['put_object'] == 4
+        assert self.client.max_uploading > 1
+        assert not list((tmp_path / 's3' / '.uploads').iterdir())
+
+        outdir = tmp_path / 'restored'
+        assert sorted(await cellar.decrypt_from(backend, outdir)) == sorted(
+            f'level1/{relpath}' for relpath in self.read_tree(plaindir))
+        assert self.read_tree(outdir / 'level1') == self.read_tree(plaindir)
+        backend.close()
+
+    def test_loops(self, tmp_path):
+        # made outside of the loops the cellar runs in, like the CLI does
+        plaindir = self.make_tree(tmp_path)
+        backend = self.backend_for(tmp_path)
+        cellar = self.cellar
+        for _ in range(2):
+            assert len(cellar.run(cellar.encrypt_to([plaindir], backend))) == 5
+        assert self.client.max_uploading > 1
+        backend.close()
+
+    @pytest.mark.asyncio
+    async def test_abort(self, tmp_path):
+        plaindir = self.make_tree(tmp_path)
+        backend = self.backend_for(tmp_path)
+
+        def fail(**kwargs):
+            raise OSError('Connection reset')
+        self.client.complete_multipart_upload = fail
+        with pytest.raises(OSError):
+            await self.cellar.encrypt_to([plaindir / 'big.bin'], backend)
+        assert self.client.calls['abort_multipart_upload'] == 1
+        assert not list((tmp_path / 's3' / '.uploads').iterdir())
+        assert await backend.names() == []
+        backend.close()
+
+    @pytest.mark.asyncio
+    async def test_backend_for(self, tmp_path):
+        backend = backend_for('s3://bucket/some/prefix', f'file://{tmp_path}')
+        assert (backend.bucket, backend.prefix) == ('bucket', 'some/prefix')
+        assert isinstance(backend.client, LocalObjectClient)
+        backend.close()
+        assert isinstance(backend_for(tmp_path), LocalBackend)
+        with pytest.raises(CellarError):
+            backend_for('ftp://host/dir')
+
+
+class TestEncryptedObjectBackend(TestObjectBackend):
+    cellar_class = EncryptedPathCellar
+    cellar_kwargs = {'block_size': 1000, 'concurrency': 4, 'deterministic': True}
+
+    @pytest.mark.asyncio
+    async def test_names(self, tmp_path):
+        plaindir = self.make_tree(tmp_path)
+        backend = self.backend_for(tmp_path)
+        names = await self.cellar.encrypt_to([plaindir], backend)
+        assert all(part.startswith('.enc.') for name in names for part in name.split('/'))
+        assert not any('level' in name for name in names)
+        backend.close()
+
+
+class TestLocalBackend(TestObjectBackend):
+
+    @pytest.mark.asyncio
+    async def test_round_trip(self, tmp_path):
+        plaindir = self.make_tree(tmp_path)
+        backend = LocalBackend(tmp_path / 'encrypted')
+        cellar = self.cellar
+        await cellar.encrypt_to([plaindir, plaindir / 'foo1.txt'], backend)
+        assert await backend.names() == ['foo1.txt', 'level1/bar1.txt', 'level1/big.bin', 'level1/foo1.txt',
+                                         'level1/level2/bar2.txt', 'level1/level2/foo2.txt']
+        assert (tmp_path / 'encrypted' / 'level1' / 'big.bin').read_bytes() != (plaindir / 'big.bin').read_bytes()
+
+        await cellar.decrypt_from(backend, tmp_path / 'restored')
+        assert self.read_tree(tmp_path / 'restored' / 'level1') == self.read_tree(plaindir)
+
+    @pytest.mark.asyncio
+    async def test_abort(self, tmp_path):
+        backend = LocalBackend(tmp_path / 'encrypted')
+        writer = await backend.writer('dir/file')
+        await writer.write(b'partial')
+        # temp files are not listed and are dropped on abort
+        assert await backend.names() == []
+        await writer.abort()
+        assert not list((tmp_path / 'encrypted' / 'dir').iterdir())
@@ -1,9 +1,12 @@
+import os
 from io import BytesIO
 from unittest.mock import patch
 
 import pytest
 
-from cellar.crypt import DecryptionError
+from cellar.crypt import CellarError, DecryptionError, walk
+from cellar.container import Header, FLAG_PACK
+from cellar.engines import engine_for, SecretStreamEngine
 
 from .base import CellarTests
 
@@ -45,3 +48,147 @@ class TestCellar(CellarTests):
             instream, outstream = BytesIO(self.ciphertext), BytesIO()
             await self.cellar.decrypt_stream(instream, outstream, True)
             assert self.plaintext == outstream.getvalue()
+
+    async def test_walk(self):
+        datadir = self.get_path()
+        assert sorted(walk(datadir)) == sorted(path for path in datadir.rglob('*') if path.is_file())
+
+    async def test_map_crypto(self):
+        cellar = self.cellar_class(self.key, concurrency=2)
+        seen = []
+
+        async def func(arg):
+            if arg == 'fail':
+                raise ValueError(arg)
+            seen.append(arg)
+
+        await cellar.map_crypto(func, range(10))
+        assert sorted(seen) == list(range(10))
+        with pytest.raises(ValueError):
+            await cellar.map_crypto(func, ['fail'] + list(range(10)))
+
+    async def test_mmap_crypto(self, tmp_path):
+        plainfile = tmp_path / 'plain'
+        plainfile.write_bytes(os.urandom(1000))
+        with self.patch:
+            streamed = self.cellar_class(self.key, block_size=64)
+            mapped = self.cellar_class(self.key, block_size=64, mmap_size=1, workers=2)
+            await streamed.read_write_crypto(plainfile, tmp_path / 'streamed')
+            await mapped.read_write_crypto(plainfile, tmp_path / 'mapped')
+        assert (tmp_path / 'streamed').read_bytes() == (tmp_path / 'mapped').read_bytes()
+        await mapped.read_write_crypto(tmp_path / 'mapped', tmp_path / 'decrypted', False)
+        assert (tmp_path / 'decrypted').read_bytes() == plainfile.read_bytes()
+        assert mapped.total_bytes == 1000 + 1000 + 16 * mapped.overhead
+
+    async def test_buffered_crypto(self, tmp_path):
+        plainfile = tmp_path / 'plain'
+        plainfile.write_bytes(os.urandom(1000))
+        streamed = self.cellar_class(self.key, block_size=64)
+        buffered = self.cellar_class(self.key, block_size=64, buffers=3, workers=2)
+        await buffered.read_write_crypto(plainfile, tmp_path / 'buffered')
+        ciphertext = (tmp_path / 'buffered').read_bytes()
+        assert len(ciphertext) == 1000 + 16 * buffered.overhead
+        # counter nonces are unique and raw chunks read back with SecretBox
+        nonces = {ciphertext[offset:offset + 24] for offset in range(0, len(ciphertext), 64 + buffered.overhead)}
+        assert len(nonces) == 16
+        await streamed.read_write_crypto(tmp_path / 'buffered', tmp_path / 'streamed', False)
+        assert (tmp_path / 'streamed').read_bytes() == plainfile.read_bytes()
+        await buffered.read_write_crypto(tmp_path / 'buffered', tmp_path / 'decrypted', False)
+        assert (tmp_path / 'decrypted').read_bytes() == plainfile.read_bytes()
+        assert buffered.total_bytes == 1000 + 1000 + 16 * buffered.overhead
+
+        corrupted = bytearray(ciphertext)
+        corrupted[500] ^= 1
+        (tmp_path / 'corrupted').write_bytes(bytes(corrupted))
+        with pytest.raises(DecryptionError):
+            await buffered.read_write_crypto(tmp_path / 'corrupted', tmp_path / 'decrypted', False)
+
+    async def test_pipelined_stream(self):
+        plaintext = os.urandom(10000)
+        with self.patch:
+            sequential, pipelined = BytesIO(), BytesIO()
+            await self.cellar_class(self.key, block_size=100).encrypt_stream(BytesIO(plaintext), sequential)
+            cellar = self.cellar_class(self.key, block_size=100, workers=4, read_ahead=8)
+            await cellar.encrypt_stream(BytesIO(plaintext), pipelined)
+        assert sequential.getvalue() == pipelined.getvalue()
+        outstream = BytesIO()
+        await cellar.decrypt_stream(BytesIO(pipelined.getvalue()), outstream)
+        assert outstream.getvalue() == plaintext
+
+        corrupted = bytearray(pipelined.getvalue())
+        corrupted[5000] ^= 1
+        with pytest.raises(DecryptionError):
+            await cellar.decrypt_stream(BytesIO(bytes(corrupted)), BytesIO())
+
+
+    @pytest.mark.parametrize('container', [False, True])
+    async def test_verify(self, tmp_path, container):
+        cellar = self.cellar_class(self.key, block_size=100, container=container, read_ahead=4, **self.cellar_kwargs)
+        (tmp_path / 'tree').mkdir()
+        for name in ('good', 'bad'):
+            (tmp_path / 'tree' / name).write_bytes(os.urandom(1000))
+            await cellar.read_write_crypto(tmp_path / 'tree' / name, tmp_path / name)
+            (tmp_path / name).replace(tmp_path / 'tree' / name)
+        corrupted = bytearray((tmp_path / 'tree' / 'bad').read_bytes())
+        offset = (32 + 4 if container else 0) + 3 * (100 + cellar.overhead + (4 if container else 0))
+        corrupted[offset + 50] ^= 1
+        (tmp_path / 'tree' / 'bad').write_bytes(bytes(corrupted))
+
+        assert (await cellar.verify_file(tmp_path / 'tree' / 'good'))['ok']
+        report = await cellar.verify_paths([tmp_path / 'tree'])
+        assert (report['ok'], report['files']) == (False, 2)
+        assert report['failed'] == [{'path': str(tmp_path / 'tree' / 'bad'), 'ok': False,
+                                     'corrupt_chunks': [offset], 'error': None}]
+        report = await cellar.verify_stream(BytesIO(bytes(corrupted[:500])))
+        assert not report['ok']
+
+    async def test_secretstream(self, tmp_path):
+        plaintext = os.urandom(1000)
+        cellar = self.cellar_class(self.key, block_size=100, engine='secretstream', read_ahead=4, **self.cellar_kwargs)
+        ciphertext = BytesIO()
+        await cellar.encrypt_stream(BytesIO(plaintext), ciphertext)
+        ciphertext = ciphertext.getvalue()
+        # container header, secretstream header and 17 bytes per chunk
+        assert len(ciphertext) == 32 + 24 + 1000 + 10 * 17
+        # the engine is found back from the header flags
+        assert engine_for(Header.unpack(ciphertext).flags) is SecretStreamEngine
+        assert engine_for(FLAG_PACK) is None
+        outstream = BytesIO()
+        await cellar.decrypt_stream(BytesIO(ciphertext), outstream)
+        assert outstream.getvalue() == plaintext
+
+        # chunks can not be dropped, reordered or cut off
+        chunks = [ciphertext[offset:offset + 117] for offset in range(56, len(ciphertext), 117)]
+        for damaged in (ciphertext[:56] + b''.join(chunks[:-1]),
+                        ciphertext[:56] + b''.join([chunks[1], chunks[0]] + chunks[2:]),
+                        ciphertext[:56] + b''.join(chunks[:3] + chunks[4:])):
+            with pytest.raises(DecryptionError):
+                await cellar.decrypt_stream(BytesIO(damaged), BytesIO())
+            report = await cellar.verify_stream(BytesIO(damaged))
+            assert not report['ok']
+        assert (await cellar.verify_stream(BytesIO(ciphertext)))['ok']
+
+        # secretbox cellars still read it, and the other way around
+        plainfile = tmp_path / 'plain'
+        plainfile.write_bytes(plaintext)
+        secretbox = self.cellar_class(self.key, block_size=100, **self.cellar_kwargs)
+        await cellar.read_write_crypto(plainfile, tmp_path / 'stream')
+        await secretbox.read_write_crypto(tmp_path / 'stream', tmp_path / 'decrypted', False)
+        assert (tmp_path / 'decrypted').read_bytes() == plaintext
+        await secretbox.read_write_crypto(plainfile, tmp_path / 'box')
+        await cellar.read_write_crypto(tmp_path / 'box', tmp_path / 'decrypted', False)
+        assert (tmp_path / 'decrypted').read_bytes() == plaintext
+        assert await cellar.decrypt_bytes(tmp_path / 'stream', 150, 300) == plaintext[150:450]
+
+        empty = BytesIO()
+        await cellar.encrypt_stream(BytesIO(), empty)
+        outstream = BytesIO()
+        await cellar.decrypt_stream(BytesIO(empty.getvalue()), outstream)
+        assert outstream.getvalue() == b''
+
+        with pytest.raises(CellarError):
+            self.cellar_class(self.key, engine='secretstream', container=True)
+
+
+class TestThreadedCellar(TestCellar):
+    cellar_kwargs = {'workers': 4}
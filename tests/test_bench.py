@@ -0,0 +1,58 @@
+import json
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from click.testing import CliRunner
+
+from cellar.cli import cli
+from cellar.bench import bench, make_tree, percentiles, sample_rss, PROFILES, TARGETS
+from cellar.engines import ENGINES
+
+from .base import CellarTests
+
+
+class TestBench(CellarTests):
+
+    def test_make_tree(self, tmp_path):
+        tree = make_tree(tmp_path, 'mixed', 0.01)
+        assert tree == tmp_path / 'mixed'
+        assert len([path for path in tree.rglob('*') if path.is_file()]) == 10
+
+    def test_percentiles(self):
+        assert percentiles([]) == {}
+        assert percentiles([0.004, 0.001, 0.002, 0.003]) == {'p50': 3, 'p90': 4, 'p99': 4, 'p100': 4}
+
+    @pytest.mark.skipif(not Path('/proc/self/statm').exists(), reason='only the peak of the process is known')
+    def test_sample_rss(self):
+        async def hold(size):
+            data = b'x' * size
+            await asyncio.sleep(0.05)
+            return len(data)
+
+        size, big = asyncio.run(sample_rss(hold(64 * 2 ** 20)))
+        assert size == 64 * 2 ** 20
+        # each run has its own peak, not the one of the whole process so far
+        assert asyncio.run(sample_rss(hold(0)))[1] < big - 32 * 2 ** 10
+
+    def test_bench(self, tmp_path):
+        results = bench(block_sizes=(1024,), concurrencies=(4,), scale=0.001, directory=tmp_path, key=self.key)
+        assert len(results) == len(PROFILES) * len(TARGETS) * len(ENGINES) * 2
+        for result in results:
+            assert result['bytes'] >= 0 and result['seconds'] > 0
+            assert set(result['latency_ms']) == {'p50', 'p90', 'p99', 'p100'}
+        overhead = {result['engine']: result['overhead'] for result in results if result['profile'] == 'huge'
+                    and result['target'] == 'stream' and result['operation'] == 'encrypt'}
+        assert overhead['secretstream'] < overhead['secretbox']
+        assert list(tmp_path.iterdir()) == []
+
+    def test_command(self, tmp_path):
+        # the global --block-size and --concurrency do not clash with the swept ones
+        result = CliRunner().invoke(cli, ['-b', '4096', '-c', '8', 'bench', '--scale', '0.01', '--profile', 'tiny',
+                                          '--target', 'overwrite', '-b', '1024', '-c', '4', '-e', 'secretbox',
+                                          '-d', str(tmp_path)])
+        assert result.exit_code == 0, result.output
+        results = json.loads(result.output)
+        assert len(results) == 2
+        assert all((result['block_size'], result['concurrency']) == (1024, 4) for result in results)
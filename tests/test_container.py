@@ -0,0 +1,97 @@
+import os
+from io import BytesIO
+
+import pytest
+
+from cellar.crypt import BaseCellar, CellarError, DecryptionError, ContainerError
+from cellar.container import Header, VERSION
+from cellar.compress import CODECS
+
+from .base import CellarTests
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestContainer(CellarTests):
+    cellar_kwargs = {'block_size': 64, 'container': True}
+    plaintext = os.urandom(1000)
+
+    async def encrypted(self, tmp_path, cellar=None):
+        cellar = cellar or self.cellar
+        plainfile, cipherfile = tmp_path / 'plain', tmp_path / 'cipher'
+        plainfile.write_bytes(self.plaintext)
+        await cellar.read_write_crypto(plainfile, cipherfile)
+        return cipherfile
+
+    async def decrypt_range(self, cellar, path, offset, length):
+        out = BytesIO()
+
+        async def write(data):
+            out.write(data)
+
+        await cellar.decrypt_range(path, write, offset, length)
+        return out.getvalue()
+
+    async def test_header(self, tmp_path):
+        cipherfile = await self.encrypted(tmp_path)
+        header = Header.unpack(cipherfile.read_bytes())
+        assert (header.version, header.block_size, header.chunk_count, header.length) == (VERSION, 64, 16, 1000)
+
+    async def test_roundtrip(self, tmp_path):
+        cipherfile = await self.encrypted(tmp_path)
+        # decryption reads the block size from the header
+        cellar = BaseCellar(self.key)
+        await cellar.read_write_crypto(cipherfile, tmp_path / 'decrypted', False)
+        assert (tmp_path / 'decrypted').read_bytes() == self.plaintext
+
+    async def test_stream(self):
+        instream, outstream = BytesIO(self.plaintext), BytesIO()
+        await self.cellar.encrypt_stream(instream, outstream)
+        assert Header.unpack(outstream.getvalue()).length == 0
+        instream, outstream = BytesIO(outstream.getvalue()), BytesIO()
+        await self.cellar.decrypt_stream(instream, outstream)
+        assert outstream.getvalue() == self.plaintext
+
+    @pytest.mark.parametrize('container', [True, False])
+    async def test_decrypt_range(self, tmp_path, container):
+        cellar = BaseCellar(self.key, block_size=64, container=container)
+        cipherfile = await self.encrypted(tmp_path, cellar)
+        for offset, length in [(0, 10), (60, 10), (64, 64), (130, None), (990, 100), (2000, 1), (5, 0)]:
+            end = None if length is None else offset + length
+            assert await self.decrypt_range(cellar, cipherfile, offset, length) == self.plaintext[offset:end]
+
+    async def test_truncated(self, tmp_path):
+        cipherfile = await self.encrypted(tmp_path)
+        cipherfile.write_bytes(cipherfile.read_bytes()[:500])
+        with pytest.raises(DecryptionError):
+            await self.cellar.read_write_crypto(cipherfile, tmp_path / 'decrypted', False)
+
+
+class TestCompressedContainer(TestContainer):
+    cellar_kwargs = {'block_size': 64, 'compression': 'zlib', 'workers': 2}
+    plaintext = (b'compress me ' * 100)[:1000]
+
+    @pytest.mark.parametrize('codec', list(CODECS))
+    async def test_codecs(self, tmp_path, codec):
+        cellar = BaseCellar(self.key, block_size=256, compression=codec, compression_level=9)
+        cipherfile = await self.encrypted(tmp_path, cellar)
+        header = Header.unpack(cipherfile.read_bytes())
+        assert header.flags == CODECS[codec][0]
+        assert cipherfile.stat().st_size < len(self.plaintext)
+        assert await self.decrypt_range(BaseCellar(self.key), cipherfile, 300, 50) == self.plaintext[300:350]
+        await BaseCellar(self.key).read_write_crypto(cipherfile, tmp_path / 'decrypted', False)
+        assert (tmp_path / 'decrypted').read_bytes() == self.plaintext
+
+    @pytest.mark.parametrize('codec, level', [('bz2', 0), ('zlib', 10), ('lzma', -1), ('zstd', None)])
+    async def test_invalid_level(self, codec, level):
+        # caught up front rather than failing every file
+        with pytest.raises(CellarError):
+            BaseCellar(self.key, compression=codec, compression_level=level)
+
+    async def test_unknown_codec(self, tmp_path):
+        cipherfile = await self.encrypted(tmp_path)
+        data = bytearray(cipherfile.read_bytes())
+        data[7] |= CODECS['lzma'][0]  # zlib and lzma
+        cipherfile.write_bytes(data)
+        with pytest.raises(ContainerError):
+            await self.cellar.read_write_crypto(cipherfile, tmp_path / 'decrypted', False)
@@ -1,3 +1,4 @@
+from shutil import copytree
 from unittest.mock import patch
 
 import pytest
@@ -54,3 +55,41 @@ class TestCrypt(CellarTests):
             assert cfiles == self.cipherfiles
             await self.cellar.decrypt_dir(cipherdir)
             assert self.plainfiles == self.file_shas(plaindir)
+
+    async def test_encrypt_dir_layout(self, tmp_path):
+        plaindir = copytree(self.get_path('level1'), tmp_path / 'level1')
+        encbase = await self.cellar.encrypt_dir(plaindir)
+        # one encrypted directory per source directory even with random nonces
+        assert len([path for path in encbase.iterdir() if path.is_dir()]) == 2
+        assert len(list(encbase.rglob('*'))) == 6
+
+
+class TestThreadedCrypt(TestCrypt):
+    cellar_kwargs = {'workers': 4}
+
+
+class TestMmapCrypt(TestCrypt):
+    cellar_kwargs = {'workers': 2, 'mmap_size': 1}
+
+
+class TestDeterministicCrypt(CellarTests):
+    cellar_class = EncryptedPathCellar
+    cellar_kwargs = {'deterministic': True}
+
+    async def test_encrypt_name(self):
+        cellar = self.cellar
+        encname = await cellar.encrypt_name('foo.txt')
+        assert encname == await cellar.encrypt_name(b'foo.txt')
+        assert encname != await cellar.encrypt_name('bar.txt')
+        assert await cellar.decrypt_name(f'{cellar.prefix}{encname}') == 'foo.txt'
+
+    async def test_encrypt_dir(self, tmp_path):
+        plaindir = copytree(self.get_path('level1'), tmp_path / 'level1')
+        plainfiles = {path.relative_to(plaindir): self.sha(path) for path in plaindir.rglob('*') if path.is_file()}
+        encbase = await self.cellar.encrypt_dir(plaindir, preserve=True)
+        cipherpaths = sorted(encbase.rglob('*'))
+        assert len(cipherpaths) == 6
+        assert encbase == await self.cellar.encrypt_dir(plaindir)
+        assert sorted(encbase.rglob('*')) == cipherpaths
+        await self.cellar.decrypt_dir(encbase)
+        assert {path.relative_to(plaindir): self.sha(path) for path in plaindir.rglob('*') if path.is_file()} == plainfiles
@@ -0,0 +1,84 @@
+import pytest
+
+from cellar.crypt import EncryptedPathCellar, CellarError, DecryptionError
+from cellar.index import Index
+
+from .base import CellarTests
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestIndex(CellarTests):
+    cellar_class = EncryptedPathCellar
+    cellar_kwargs = {'keep': True}
+    relpaths = ['bar1.txt', 'foo1.txt', 'level2/bar2.txt', 'level2/foo2.txt']
+
+    async def test_index(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir)
+        index = cellar.load_index(encbase)
+        assert sorted(index.files) == self.relpaths
+        for relpath, entry in index.files.items():
+            stat = (plaindir / relpath).stat()
+            assert (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns)
+            assert (encbase / entry['cipher']).is_file()
+        assert b'foo1.txt' not in Index.for_tree(encbase).read_bytes()
+        assert [relpath for relpath, _ in index.find('foo*')] == ['foo1.txt', 'level2/foo2.txt']
+        assert [relpath for relpath, _ in index.find('level2/*')] == ['level2/bar2.txt', 'level2/foo2.txt']
+        assert index.select(['level2/', 'foo1.txt', 'missing'])[1] == ['missing']
+
+        # a torn last line is skipped and cut off before appending
+        with open(Index.for_tree(encbase), 'ab') as fo:
+            fo.write(b'torn')
+        index = cellar.load_index(encbase)
+        assert sorted(index.files) == self.relpaths
+        index.open().remove('foo1.txt')
+        index.close(False)
+        assert sorted(cellar.load_index(encbase).files) == ['bar1.txt', 'level2/bar2.txt', 'level2/foo2.txt']
+
+        # any other line that does not decrypt is the wrong key, not an empty index
+        with pytest.raises(DecryptionError):
+            self.cellar_class(b'w' * 32, **self.cellar_kwargs).load_index(encbase)
+
+    async def test_decrypt_only(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir, preserve=False)
+        with pytest.raises(CellarError):
+            await cellar.decrypt_dir(encbase, only=['missing'])
+
+        assert await cellar.decrypt_dir(encbase, preserve=False, only=['level2']) == plaindir
+        assert sorted(path.relative_to(plaindir).as_posix() for path in plaindir.rglob('*') if path.is_file()) == \
+            ['level2/bar2.txt', 'level2/foo2.txt']
+        assert (plaindir / 'level2' / 'foo2.txt').read_bytes() == self.get_path('foo.txt').read_bytes()
+        assert sorted(cellar.load_index(encbase).files) == ['bar1.txt', 'foo1.txt']
+        assert len([path for path in encbase.rglob('*') if path.is_file()]) == 2
+
+        await cellar.decrypt_dir(encbase, preserve=False)
+        assert not encbase.exists() and not Index.for_tree(encbase).exists()
+        assert len([path for path in plaindir.rglob('*') if path.is_file()]) == 4
+
+
+class TestDeterministicIndex(TestIndex):
+    cellar_kwargs = {'keep': True, 'deterministic': True, 'manifest': True}
+
+    async def test_update(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir)
+        index_path = Index.for_tree(encbase)
+        saved = index_path.read_bytes()
+
+        # nothing changed so the index is not rewritten
+        await cellar.encrypt_dir(plaindir)
+        assert index_path.read_bytes() == saved
+
+        (plaindir / 'foo1.txt').unlink()
+        (plaindir / 'level2' / 'new.txt').write_bytes(b'new\n')
+        await cellar.encrypt_dir(plaindir)
+        index = cellar.load_index(encbase)
+        assert sorted(index.files) == ['bar1.txt', 'level2/bar2.txt', 'level2/foo2.txt', 'level2/new.txt']
+        assert index.files['level2/new.txt']['size'] == 4
+        # compacted into a single line
+        assert index_path.read_bytes().count(b'\n') == 1
@@ -0,0 +1,149 @@
+import pytest
+
+from cellar.crypt import OverwritePathCellar, EncryptedPathCellar, DecryptionError
+from cellar.journal import Journal
+from cellar.index import Index
+
+from .base import CellarTests
+
+pytestmark = pytest.mark.asyncio
+
+
+class Interrupted(Exception):
+    pass
+
+
+class JournalTests(CellarTests):
+    cellar_kwargs = {'journal': True, 'concurrency': 1}
+
+
+class TestOverwriteJournal(JournalTests):
+    cellar_class = OverwritePathCellar
+
+    def interrupt(self, cellar, method, after):
+        """
+        Makes the cellar method write a partial temp file and fail once after files are done
+        """
+        func, calls = getattr(cellar, method), []
+
+        async def failing(path, *args):
+            calls.append(path)
+            if len(calls) > after:
+                cellar.tmp_path(path).write_bytes(b'partial')
+                raise Interrupted(path)
+            return await func(path, *args)
+
+        setattr(cellar, method, failing)
+        return calls
+
+    async def test_resume(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        plainfiles = self.shas(plaindir)
+        cellar = self.cellar
+        calls = self.interrupt(cellar, 'encrypt_file', 2)
+        with pytest.raises(Interrupted):
+            await cellar.encrypt_dir(plaindir)
+        journal = Journal(Journal.for_dir(plaindir, 'encrypt'), plaindir, cellar.box).load()
+        assert journal.path.is_file()
+        assert len(journal.done) == 2
+        assert list(journal.started) == [calls[-1].relative_to(plaindir).as_posix()]
+        assert cellar.tmp_path(calls[-1]).is_file()
+
+        cellar = self.cellar
+        await cellar.encrypt_dir(plaindir)
+        # only the files that were not done are encrypted and temp files are gone
+        assert cellar.total_bytes == 8
+        assert not journal.path.exists()
+        assert sorted(self.shas(plaindir)) == sorted(plainfiles)
+        await cellar.decrypt_dir(plaindir)
+        assert self.shas(plaindir) == plainfiles
+
+    async def test_lost_records(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        plainfiles = self.shas(plaindir)
+        cellar = self.cellar
+        self.interrupt(cellar, 'encrypt_file', 2)
+        with pytest.raises(Interrupted):
+            await cellar.encrypt_dir(plaindir)
+        # files whose done record was lost are found to be encrypted already
+        path = Journal.for_dir(plaindir, 'encrypt')
+        lines = path.read_bytes().splitlines(True)
+        path.write_bytes(b''.join(lines[:3] + lines[4:]))
+        cellar = self.cellar
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == 8
+        await cellar.decrypt_dir(plaindir)
+        assert self.shas(plaindir) == plainfiles
+
+    async def test_resume_decrypt(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        plainfiles = self.shas(plaindir)
+        cellar = self.cellar
+        await cellar.encrypt_dir(plaindir)
+        cipherfiles = self.shas(plaindir)
+        path = Journal.for_dir(plaindir, 'decrypt')
+        other = self.cellar_class(b'w' * 32, **self.cellar_kwargs)
+
+        # files that do not decrypt are not taken for files an interrupted run decrypted
+        path.write_bytes(b'')
+        with pytest.raises(DecryptionError):
+            await other.decrypt_dir(plaindir)
+        # only the output of the file that failed is left
+        assert self.shas(plaindir).keys() - cipherfiles.keys() == {'foo1.txt.dec'}
+        assert self.shas(plaindir).items() >= cipherfiles.items()
+        # nor is a journal written with another key resumed
+        record = {'op': 'start', 'path': 'foo1.txt', 'target': str(cellar.tmp_path(plaindir / 'foo1.txt', False))}
+        path.write_bytes(Journal(path, plaindir, cellar.box).encode(record))
+        with pytest.raises(DecryptionError):
+            await other.decrypt_dir(plaindir)
+        assert self.shas(plaindir).items() >= cipherfiles.items()
+
+        # with the right key, the started file that was decrypted before its done record was written is skipped
+        await cellar.decrypt_file(plaindir / 'foo1.txt')
+        await cellar.decrypt_dir(plaindir)
+        assert self.shas(plaindir) == plainfiles
+        assert not path.exists()
+
+
+class TestEncryptedPathJournal(JournalTests):
+    cellar_class = EncryptedPathCellar
+
+    async def test_resume(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        plainfiles = self.shas(plaindir)
+        cellar, calls = self.cellar, []
+        encrypt_file = cellar.encrypt_file
+
+        async def failing(path, cipherfile, preserve):
+            calls.append(path)
+            if len(calls) > 2:
+                cipherfile.write_bytes(b'partial')
+                raise Interrupted(path)
+            return await encrypt_file(path, cipherfile, preserve)
+
+        cellar.encrypt_file = failing
+        with pytest.raises(Interrupted):
+            await cellar.encrypt_dir(plaindir)
+        assert len(list(tmp_path.glob(f'{cellar.prefix}*'))) == 1
+
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir)
+        # the same encrypted directories are reused and the partial file is replaced
+        assert cellar.total_bytes == 8
+        assert not plaindir.exists()
+        assert sorted(path.name for path in tmp_path.iterdir()) == [Index.for_tree(encbase).name, encbase.name]
+        assert len([path for path in encbase.rglob('*') if path.is_file()]) == 4
+        # files indexed before the interruption are kept
+        assert sorted(cellar.load_index(encbase).files) == sorted(plainfiles)
+        await cellar.decrypt_dir(encbase)
+        assert self.shas(plaindir) == plainfiles
+
+    async def test_complete(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        plainfiles = self.shas(plaindir)
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir)
+        assert not Journal.for_dir(plaindir, 'encrypt').exists()
+        await cellar.decrypt_dir(encbase)
+        assert not Journal.for_dir(encbase, 'decrypt').exists()
+        assert self.shas(plaindir) == plainfiles
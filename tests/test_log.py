@@ -0,0 +1,51 @@
+import json
+import logging
+import threading
+
+from cellar import log
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record)
+        self.threads.add(threading.current_thread())
+
+
+class TestLog:
+
+    def test_summary(self):
+        logger = logging.getLogger('cellar.test.summary')
+        logger.setLevel(logging.INFO)
+        handler = Records()
+        logger.addHandler(handler)
+        summary = log.Summary(logger, every=3, interval=60)
+        for number in range(7):
+            summary.add('Encrypted' if number % 2 else 'Decrypted', f'file{number}')
+        assert len(handler.records) == 2
+        summary.flush()
+        messages = [record.getMessage() for record in handler.records]
+        assert messages[0].startswith('Decrypted 2 files, Encrypted 1 files in the last')
+        assert messages[2].startswith('Decrypted 1 files in the last')
+        summary.flush()
+        assert len(handler.records) == 3
+
+    def test_json_formatter(self):
+        record = logging.LogRecord('cellar', logging.WARNING, __file__, 1, 'Failed on %s', ('foo',), None, 'func')
+        data = json.loads(log.JSONFormatter().format(record))
+        assert (data['level'], data['message'], data['function']) == ('WARNING', 'Failed on foo', 'func')
+
+    def test_setup(self, tmp_path):
+        with open(tmp_path / 'log', 'w') as logfile:
+            listener = log.setup(2, logfile, json_format=True)
+            handler = Records()
+            listener.handlers += (handler,)
+            log.logger.info('in the background')
+            log.shutdown()
+        assert log.logger.handlers == []
+        assert handler.threads and threading.current_thread() not in handler.threads
+        assert json.loads((tmp_path / 'log').read_text())['message'] == 'in the background'
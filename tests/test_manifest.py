@@ -0,0 +1,142 @@
+import os
+import pytest
+
+from cellar.crypt import OverwritePathCellar, EncryptedPathCellar, CellarError
+
+from .base import CellarTests
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestOverwriteManifest(CellarTests):
+    cellar_class = OverwritePathCellar
+    cellar_kwargs = {'manifest': True, 'block_size': 64}
+
+    async def test_manifest(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        cellar = self.cellar
+        await cellar.encrypt_dir(plaindir)
+        manifest = await cellar.load_manifest(plaindir)
+        assert manifest.path == tmp_path / '.level1.manifest'
+        assert sorted(manifest.files) == ['bar1.txt', 'foo1.txt', 'level2/bar2.txt', 'level2/foo2.txt']
+        cipherfiles = self.shas(plaindir)
+
+        # nothing changed so nothing is encrypted twice
+        cellar.total_bytes = 0
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == 0
+        assert self.shas(plaindir) == cipherfiles
+
+        # touching a file without changing it leaves it as is since all of it still authenticates
+        os.utime(plaindir / 'foo1.txt', ns=(0, 0))
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == 0
+        assert self.shas(plaindir) == cipherfiles
+        # only the stats of the ciphertext are kept
+        manifest = await cellar.load_manifest(plaindir)
+        assert manifest.files['foo1.txt']['hash'] is None
+        assert manifest.files['foo1.txt']['mtime_ns'] == 0
+
+        (plaindir / 'new.txt').write_bytes(b'new\n')
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == 4
+        assert self.shas(plaindir).keys() - cipherfiles.keys() == {'new.txt'}
+
+        # plaintext appended to a file of several chunks is encrypted with it, not only the first chunk is checked
+        (plaindir / 'big').write_bytes(os.urandom(200))
+        await cellar.encrypt_dir(plaindir)
+        with open(plaindir / 'big', 'ab') as fo:
+            fo.write(b'TOP SECRET\n')
+        size = (plaindir / 'big').stat().st_size
+        cellar.total_bytes = 0
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == size
+        assert b'TOP SECRET' not in (plaindir / 'big').read_bytes()
+
+        await cellar.decrypt_dir(plaindir)
+        assert (plaindir / 'new.txt').read_bytes() == b'new\n'
+        assert (plaindir / 'level2' / 'foo2.txt').read_bytes() == self.get_path('foo.txt').read_bytes()
+
+        # decrypted files no longer match the manifest so they are encrypted again
+        size = sum(map(len, self.read_tree(plaindir).values()))
+        cellar.total_bytes = 0
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == size
+
+
+class TestShardedOverwriteManifest(TestOverwriteManifest):
+    cellar_kwargs = {'manifest': True, 'block_size': 64, 'processes': 2, 'shard_size': 2}
+
+
+class TestEncryptedPathManifest(TestOverwriteManifest):
+    cellar_class = EncryptedPathCellar
+
+    async def test_manifest(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir, preserve=True)
+        cipherfiles = self.shas(encbase)
+        assert len(cipherfiles) == 4
+
+        cellar.total_bytes = 0
+        assert await cellar.encrypt_dir(plaindir, preserve=True) == encbase
+        assert cellar.total_bytes == 0
+        assert self.shas(encbase) == cipherfiles
+
+        # changed files replace their old ciphertext
+        (plaindir / 'foo1.txt').write_bytes(b'changed\n')
+        await cellar.encrypt_dir(plaindir, preserve=True)
+        assert cellar.total_bytes == 8
+        assert len(self.shas(encbase)) == 4
+
+        plainfiles = self.shas(plaindir)
+        await cellar.decrypt_dir(encbase, preserve=True)
+        assert self.shas(plaindir) == plainfiles
+
+
+class TestEncryptedPathDelta(TestOverwriteManifest):
+    cellar_class = EncryptedPathCellar
+    cellar_kwargs = {'delta': True, 'keep': True, 'block_size': 100}
+
+    async def test_invalid(self, tmp_path):
+        # without the plaintext to compare with, every file would be rewritten
+        with pytest.raises(CellarError):
+            OverwritePathCellar(self.key, delta=True)
+        with pytest.raises(CellarError):
+            EncryptedPathCellar(self.key, delta=True)
+        with pytest.raises(CellarError):
+            await self.cellar.encrypt_dir(self.copy_data(tmp_path), preserve=False)
+
+    async def test_manifest(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        plaintext = bytearray(os.urandom(1000))
+        (plaindir / 'big').write_bytes(plaintext)
+        cellar = self.cellar
+        encbase = await cellar.encrypt_dir(plaindir)
+        manifest = await cellar.load_manifest(plaindir)
+        assert len(manifest.files['big']['chunks']) == 10
+        cipherfile = tmp_path / manifest.files['big']['cipher']
+        ciphertext = cipherfile.read_bytes()
+        assert len(ciphertext) == 1000 + 10 * cellar.overhead
+
+        # only the changed chunk is re-encrypted and rewritten in place
+        plaintext[550] ^= 1
+        (plaindir / 'big').write_bytes(plaintext)
+        cellar.total_bytes = 0
+        assert await cellar.encrypt_dir(plaindir) == encbase
+        assert cellar.total_bytes == 100
+        chunk_size = 100 + cellar.overhead
+        changed = cipherfile.read_bytes()
+        assert [index for index in range(10) if changed[index * chunk_size:(index + 1) * chunk_size] !=
+                ciphertext[index * chunk_size:(index + 1) * chunk_size]] == [5]
+
+        # shrinking the file truncates the ciphertext
+        (plaindir / 'big').write_bytes(plaintext[:420])
+        cellar.total_bytes = 0
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == 20
+        assert cipherfile.stat().st_size == 420 + 5 * cellar.overhead
+
+        plainfiles = self.shas(plaindir)
+        await cellar.decrypt_dir(encbase, preserve=False)
+        assert self.shas(plaindir) == plainfiles
@@ -1,4 +1,7 @@
-from unittest.mock import patch
+import os
+import threading
+from io import BytesIO
+from unittest.mock import patch, Mock
 
 from cellar.crypt import OverwritePathCellar
 
@@ -44,3 +47,82 @@ class TestOverwriteCrypt(CellarTests):
             assert cfiles == self.cipherfiles
             await self.cellar.decrypt_dir(cipherdir)
             assert self.plainfiles == self.file_shas(plaindir)
+
+    async def test_crypt_paths(self):
+        with self.patch:
+            cellar = self.cellar
+            paths = [self.get_path('level1'), self.get_path('foo.txt'), self.get_path('missing.txt')]
+            failures = await cellar.crypt_paths(paths + paths[:1])
+            assert [path for path, _ in failures] == paths[2:]
+            assert self.file_shas(self.get_path('level1')) == self.cipherfiles
+            assert self.sha(self.get_path('foo.txt')) == self.cipherfilesha
+            assert await cellar.crypt_paths(paths[:2], False) == []
+            assert self.file_shas(self.get_path('level1')) == self.plainfiles
+
+    async def test_crypt_stdin(self, tmp_path):
+        # a slow producer on stdin does not hold back the other paths
+        plainfile = tmp_path / 'foo.txt'
+        plainfile.write_bytes(b'foo\n')
+        cellar, out, encrypted = self.cellar, BytesIO(), threading.Event()
+        encrypt_stream, encrypt_file = cellar.encrypt_stream, cellar.encrypt_file
+
+        async def encrypt_to_out(instream, threaded):
+            await encrypt_stream(instream, out, threaded=threaded)
+
+        async def encrypt_and_signal(path):
+            await encrypt_file(path)
+            encrypted.set()
+
+        cellar.encrypt_stream, cellar.encrypt_file = encrypt_to_out, encrypt_and_signal
+        read, write = os.pipe()
+        waited = []
+
+        def produce():
+            waited.append(encrypted.wait(5))
+            os.write(write, b'piped\n')
+            os.close(write)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        with open(read, 'rb') as stdin, patch('sys.stdin', Mock(buffer=stdin)):
+            assert await cellar.crypt_paths(['-', plainfile]) == []
+        producer.join()
+        assert waited == [True]
+        plain = BytesIO()
+        await cellar.decrypt_stream(BytesIO(out.getvalue()), plain)
+        assert plain.getvalue() == b'piped\n'
+
+
+class TestThreadedOverwriteCrypt(TestOverwriteCrypt):
+    cellar_kwargs = {'workers': 4}
+
+
+class TestMmapOverwriteCrypt(TestOverwriteCrypt):
+    cellar_kwargs = {'workers': 2, 'mmap_size': 1}
+
+
+class TestBufferedOverwriteCrypt(TestOverwriteCrypt):
+    cellar_kwargs = {'workers': 2, 'buffers': 2}
+
+    @property
+    def patch(self):
+        def write(nonces, buffer, offset=0):
+            buffer[offset:offset + len(self.nonce)] = self.nonce
+        return patch('cellar.buffers.NonceSequence.write', write)
+
+
+class TestShardedOverwriteCrypt(CellarTests):
+    cellar_class = OverwritePathCellar
+    cellar_kwargs = {'processes': 2, 'shard_size': 1}
+
+    async def test_encrypt_dir(self):
+        plaindir = self.get_path('level1')
+        plainfiles = self.file_shas(plaindir)
+        cellar = self.cellar
+        await cellar.encrypt_dir(plaindir)
+        assert cellar.total_bytes == 16
+        cipherfiles = self.file_shas(plaindir)
+        assert all(cipherfiles[path] != sha for path, sha in plainfiles.items())
+        await cellar.decrypt_dir(plaindir)
+        assert cellar.total_bytes == 16 + 16 + 4 * 40
+        assert plainfiles == self.file_shas(plaindir)
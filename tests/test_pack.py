@@ -0,0 +1,96 @@
+import os
+from io import BytesIO
+
+import pytest
+
+from cellar.crypt import CellarError, ContainerError
+from cellar.container import Header, FLAG_PACK
+from cellar.pack import PackReader, member_path, volumes
+
+from .base import CellarTests
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestPack(CellarTests):
+    cellar_kwargs = {'block_size': 64}
+
+    def make_tree(self, root):
+        files = {'a.txt': b'a' * 100, 'empty': b'', 'sub/b.bin': os.urandom(1000), 'sub/deep/c': b'c'}
+        for name, data in files.items():
+            path = root / 'tree' / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+        return root / 'tree', files
+
+    async def test_roundtrip(self, tmp_path):
+        cellar = self.cellar
+        tree, files = self.make_tree(tmp_path)
+        os.chmod(tree / 'a.txt', 0o600)
+        assert await cellar.pack_dir(tree, tmp_path / 'tree.pack') == [tmp_path / 'tree.pack']
+        assert Header.unpack((tmp_path / 'tree.pack').read_bytes()).flags & FLAG_PACK
+        assert sorted(await cellar.unpack(tmp_path / 'tree.pack', tmp_path / 'out')) == sorted(files)
+        assert self.read_tree(tmp_path / 'out') == files
+        assert (tmp_path / 'out' / 'a.txt').stat().st_mode & 0o777 == 0o600
+        assert (tmp_path / 'out' / 'a.txt').stat().st_mtime_ns == (tree / 'a.txt').stat().st_mtime_ns
+
+    async def test_volumes(self, tmp_path):
+        cellar = self.cellar
+        tree, files = self.make_tree(tmp_path)
+        packed = await cellar.pack_dir(tree, tmp_path / 'tree.pack', volume_size=1)
+        assert len(packed) == len(files) == len(list(volumes(tmp_path / 'tree.pack')))
+        await cellar.unpack(tmp_path / 'tree.pack', tmp_path / 'out')
+        assert self.read_tree(tmp_path / 'out') == files
+        # repacking into fewer volumes removes the old ones
+        assert len(await cellar.pack_dir(tree, tmp_path / 'tree.pack')) == 1
+        assert list(volumes(tmp_path / 'tree.pack')) == [tmp_path / 'tree.pack']
+
+    async def test_members(self, tmp_path):
+        cellar = self.cellar
+        tree, files = self.make_tree(tmp_path)
+        await cellar.pack_dir(tree, tmp_path / 'tree.pack', volume_size=1)
+        indexes = [await cellar.read_pack_index(path) for path in volumes(tmp_path / 'tree.pack')]
+        assert sorted(name for index in indexes for name in index) == sorted(files)
+        assert await cellar.unpack(tmp_path / 'tree.pack', tmp_path / 'out', ['sub/b.bin']) == ['sub/b.bin']
+        assert self.read_tree(tmp_path / 'out') == {'sub/b.bin': files['sub/b.bin']}
+        with pytest.raises(CellarError):
+            await cellar.unpack(tmp_path / 'tree.pack', tmp_path / 'out', ['missing'])
+
+    async def test_unindexed_members(self, tmp_path):
+        # packs written to streams have no plaintext length in the header, members are found in one pass
+        cellar = self.cellar
+        tree, files = self.make_tree(tmp_path)
+        reader = PackReader(tree, iter(sorted(path for path in tree.rglob('*') if path.is_file())), cellar.block_size)
+        with open(tmp_path / 'tree.pack', 'wb') as fo:
+            async def write(data):
+                fo.write(data)
+            await cellar.encrypt_chunks(reader.read, write, header=Header(cellar.block_size, flags=FLAG_PACK))
+        assert await cellar.read_pack_index(tmp_path / 'tree.pack') is None
+        await cellar.unpack(tmp_path / 'tree.pack', tmp_path / 'out', ['sub/deep/c'])
+        assert self.read_tree(tmp_path / 'out') == {'sub/deep/c': b'c'}
+
+    async def test_stream(self, tmp_path):
+        cellar = self.cellar
+        tree, files = self.make_tree(tmp_path)
+        stream = BytesIO()
+        await cellar.pack_stream(tree, stream)
+        assert b'sub/b.bin' not in stream.getvalue()
+        stream.seek(0)
+        assert sorted(await cellar.unpack_stream(tmp_path / 'out', stream)) == sorted(files)
+        assert self.read_tree(tmp_path / 'out') == files
+        with pytest.raises(ContainerError):
+            await cellar.unpack_stream(tmp_path / 'out', BytesIO(b'x' * 100))
+
+    async def test_invalid(self, tmp_path):
+        with pytest.raises(ContainerError):
+            member_path(tmp_path, '../escape')
+        (tmp_path / 'plain').write_bytes(b'x' * 100)
+        with pytest.raises(ContainerError):
+            await self.cellar.read_pack_index(tmp_path / 'plain')
+        tree, _ = self.make_tree(tmp_path)
+        with pytest.raises(CellarError):
+            await self.cellar.pack_dir(tree, tree / 'inside.pack')
+
+
+class TestPrefetchedPack(TestPack):
+    cellar_kwargs = {'block_size': 64, 'read_ahead': 4}
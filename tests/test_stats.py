@@ -0,0 +1,46 @@
+import pickle
+
+import pytest
+
+from cellar.crypt import OverwritePathCellar
+from cellar.stats import Stats, progress_line, sizeof
+
+from .base import CellarTests
+
+
+class TestStats(CellarTests):
+    cellar_class = OverwritePathCellar
+
+    def test_timer(self):
+        stats = Stats()
+        with stats.timer('crypto'):
+            pass
+        assert stats.times['crypto'] > 0
+        assert stats.times['read'] == 0
+
+    def test_merge(self):
+        stats, other = Stats(), Stats()
+        other.bytes, other.files = 10, 2
+        other.add_time('write', 1.5)
+        stats.merge(pickle.loads(pickle.dumps(other)))
+        assert (stats.bytes, stats.files, stats.times['write']) == (10, 2, 1.5)
+
+    def test_snapshot(self):
+        stats = Stats()
+        stats.bytes, stats.expected_bytes = 10, 30
+        snapshot = stats.snapshot()
+        assert snapshot['bytes'] == 10 and snapshot['eta'] > 0
+        assert 'eta' in progress_line(snapshot)
+        assert sizeof(3 * 2 ** 20) == '3.0 MiB'
+
+    @pytest.mark.asyncio
+    async def test_cellar_stats(self):
+        snapshots = []
+        cellar = self.cellar
+        cellar.stats.subscribe(snapshots.append)
+        await cellar.stats.watch(cellar.encrypt_file(self.get_path('foo.txt')), 0.001)
+        await cellar.stats.watch(cellar.decrypt_file(self.get_path('foo.txt')), 0.001)
+        assert snapshots[-1]['files'] == 2
+        assert snapshots[-1]['bytes'] == cellar.total_bytes > 0
+        assert snapshots[-1]['in_flight'] == 0
+        assert all(snapshots[-1]['times'][phase] > 0 for phase in ('read', 'crypto', 'write', 'rename'))
@@ -0,0 +1,84 @@
+import os
+from io import BytesIO
+
+import pytest
+
+from cellar.crypt import (OverwritePathCellar, EncryptedPathCellar, CellarError, ContainerError, DecryptionError,
+                          stream_reader, stream_writer)
+from cellar.container import Header, FLAG_RECIPE
+
+from .base import CellarTests
+
+pytestmark = pytest.mark.asyncio
+
+
+class TestStore(CellarTests):
+    cellar_class = OverwritePathCellar
+    block_size = 100
+
+    def cellar_for(self, tmp_path, **kwargs):
+        return self.cellar_class(self.key, block_size=self.block_size, store=tmp_path / 'store', **kwargs)
+
+    def objects(self, tmp_path):
+        return sorted(path for path in (tmp_path / 'store').rglob('*') if path.is_file())
+
+    async def test_dedup(self, tmp_path):
+        cellar = self.cellar_for(tmp_path)
+        shared = os.urandom(300)
+        tree = tmp_path / 'tree'
+        (tree / 'sub').mkdir(parents=True)
+        files = {'a': shared + b'a' * 50, 'sub/b': shared, 'sub/c': shared + b'a' * 50, 'empty': b''}
+        for name, data in files.items():
+            (tree / name).write_bytes(data)
+        await cellar.encrypt_dir(tree)
+        # the 3 chunks shared by all files and the 50 byte tail are stored once
+        assert len(self.objects(tmp_path)) == 4
+        assert cellar.total_bytes == sum(map(len, files.values()))
+        header = Header.unpack((tree / 'a').read_bytes())
+        assert header.flags & FLAG_RECIPE and (header.chunk_count, header.length) == (4, 350)
+        assert shared not in (tree / 'sub' / 'b').read_bytes()
+
+        await cellar.decrypt_dir(tree)
+        assert {name: (tree / name).read_bytes() for name in files} == files
+
+        # recipes can not be decrypted without their store
+        await cellar.encrypt_file(tree / 'a')
+        with pytest.raises(ContainerError):
+            await self.cellar_class(self.key).decrypt_file(tree / 'a')
+        with pytest.raises(ContainerError):
+            await cellar.decrypt_bytes(tree / 'a', 0, 10)
+
+    async def test_corrupt_store(self, tmp_path):
+        cellar = self.cellar_for(tmp_path)
+        for name in ('one', 'two'):
+            (tmp_path / name).write_bytes(name.encode().ljust(100, b'.'))
+            await cellar.read_write_crypto(tmp_path / name, tmp_path / f'{name}.enc')
+        # a chunk swapped for another one of the store does not match its digest
+        first, second = self.objects(tmp_path)
+        first.write_bytes(second.read_bytes())
+        with pytest.raises(DecryptionError):
+            await cellar.decrypt_chunks(stream_reader(BytesIO((tmp_path / 'one.enc').read_bytes())),
+                                        stream_writer(BytesIO()))
+        second.unlink()
+        with pytest.raises(ContainerError):
+            await cellar.read_write_crypto(tmp_path / 'two.enc', tmp_path / 'two', False)
+
+    async def test_invalid(self, tmp_path):
+        with pytest.raises(CellarError):
+            self.cellar_for(tmp_path, engine='secretstream')
+        with pytest.raises(CellarError):
+            self.cellar_for(tmp_path, compression='zlib')
+
+
+class TestEncryptedPathStore(TestStore):
+    cellar_class = EncryptedPathCellar
+
+    async def test_dedup(self, tmp_path):
+        cellar = self.cellar_for(tmp_path, deterministic=True)
+        plaindir = self.copy_data(tmp_path)
+        plainfiles = self.read_tree(plaindir)
+        encbase = await cellar.encrypt_dir(plaindir)
+        # the tree holds 2 distinct contents
+        assert len(self.objects(tmp_path)) == 2
+        await cellar.decrypt_dir(encbase)
+        assert self.read_tree(plaindir) == plainfiles
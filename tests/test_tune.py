@@ -0,0 +1,137 @@
+import os
+import asyncio
+from io import BytesIO
+
+import pytest
+
+from cellar.crypt import OverwritePathCellar, CellarError, stream_reader, stream_writer
+from cellar.container import Header
+from cellar.tune import Limiter, Tuner, pick_block_size, rss, MIN_BLOCK_SIZE, MAX_BLOCK_SIZE
+
+from .base import CellarTests
+
+
+def test_pick_block_size():
+    assert pick_block_size(0) == pick_block_size(100) == MIN_BLOCK_SIZE
+    assert pick_block_size(16 * 2 ** 20) == 2 ** 20
+    assert pick_block_size(16 * 2 ** 20 + 16) == 2 ** 21
+    assert pick_block_size(2 ** 40) == MAX_BLOCK_SIZE
+
+
+def test_rss():
+    assert rss() is None or rss() > 0
+
+
+class TestTuner:
+
+    def test_climb(self):
+        tuner = Tuner(limit=8, max_limit=20)
+        # up while the throughput rises
+        assert tuner.adjust(100, 1.0) == 10
+        assert tuner.adjust(150, 1.0) == 12
+        # back down when it drops, and on while that helps
+        assert tuner.adjust(100, 1.0) == 9
+        assert tuner.adjust(130, 1.0) == 7
+        # flat throughput with files taking longer only queues them up
+        tuner.direction = 1
+        assert tuner.adjust(130, 2.0) == 6
+        # not raised past max_limit, nor when files did not wait on the limit
+        tuner.direction = 1
+        tuner.limiter.limit = 19
+        assert tuner.adjust(1000, 1.0) == 20
+        tuner.limiter.limit = 8
+        assert tuner.adjust(2000, 1.0, saturated=False) == 8
+        assert [limit for limit, *_ in tuner.history] == [8, 10, 12, 9, 7, 19, 8]
+
+    def test_max_rss(self):
+        tuner = Tuner(limit=16, max_rss=1000)
+        assert tuner.adjust(100, 1.0, 2000) == 8
+        assert tuner.adjust(200, 1.0, 1200) == 4
+        assert tuner.adjust(400, 1.0, 300) == 5
+        # 5 more files at 500 bytes would go over
+        assert tuner.adjust(800, 1.0, 900) == 5
+        assert tuner.adjust(100, 1.0, 900) == 4
+
+
+@pytest.mark.asyncio
+class TestLimiter:
+
+    async def test_limit(self):
+        limiter = Limiter(2)
+        running, most = 0, 0
+
+        async def hold():
+            nonlocal running, most
+            async with limiter:
+                running += 1
+                most = max(most, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        tasks = [asyncio.ensure_future(hold()) for _ in range(6)]
+        await asyncio.sleep(0.005)
+        assert limiter.held == 2 and limiter.waits == 4
+        limiter.limit = 4
+        assert limiter.held == 4
+        await asyncio.gather(*tasks)
+        assert most == 4 and limiter.held == 0 and limiter.releases == 6
+        assert limiter.held_time >= 6 * 0.01
+
+    async def test_cancel(self):
+        limiter = Limiter(1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        limiter.release()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert limiter.held == 0
+        await asyncio.wait_for(limiter.acquire(), 1)
+
+
+class TestAutoTune(CellarTests):
+    cellar_class = OverwritePathCellar
+    cellar_kwargs = {'auto_tune': True, 'concurrency': 8}
+
+    def test_invalid(self):
+        with pytest.raises(CellarError):
+            self.cellar_class(self.key, auto_tune=True, delta=True)
+
+    @pytest.mark.asyncio
+    async def test_block_sizes(self, tmp_path):
+        cellar = self.cellar
+        files = {'small': os.urandom(1000), 'big': os.urandom(3 * 2 ** 20)}
+        for name, data in files.items():
+            (tmp_path / name).write_bytes(data)
+            await cellar.encrypt_file(tmp_path / name)
+        assert Header.unpack((tmp_path / 'small').read_bytes()).block_size == MIN_BLOCK_SIZE
+        header = Header.unpack((tmp_path / 'big').read_bytes())
+        assert (header.block_size, header.chunk_count) == (2 ** 18, 12)
+
+        # decrypting needs neither auto-tuning nor the same block size
+        decrypter = self.cellar_class(self.key, block_size=1000)
+        for name, data in files.items():
+            await decrypter.decrypt_file(tmp_path / name)
+            assert (tmp_path / name).read_bytes() == data
+
+        # streams of unknown length use block_size
+        out = BytesIO()
+        await cellar.encrypt_stream(BytesIO(files['small']), out)
+        assert Header.unpack(out.getvalue()).block_size == cellar.block_size
+        plain = BytesIO()
+        await decrypter.decrypt_chunks(stream_reader(BytesIO(out.getvalue())), stream_writer(plain))
+        assert plain.getvalue() == files['small']
+
+    def test_run(self, tmp_path):
+        plaindir = self.copy_data(tmp_path)
+        for number in range(50):
+            (plaindir / f'{number}.bin').write_bytes(os.urandom(100000))
+        files = self.read_tree(plaindir)
+        cellar = self.cellar
+        cellar.tuner.interval = 0.001
+        cellar.run(cellar.encrypt_dir(plaindir))
+        assert all(data != files[relpath] for relpath, data in self.read_tree(plaindir).items())
+        assert cellar.tuner.history
+        assert 1 <= cellar.tuner.limiter.limit <= 8 and cellar.tuner.limiter.held == 0
+        cellar.run(cellar.decrypt_dir(plaindir))
+        assert self.read_tree(plaindir) == files
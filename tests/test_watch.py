@@ -0,0 +1,83 @@
+import asyncio
+from time import sleep, monotonic
+
+import pytest
+
+from cellar.crypt import OverwritePathCellar, EncryptedPathCellar
+from cellar.watch import Poller, Inotify
+
+from .base import CellarTests
+
+
+@pytest.mark.parametrize('watcher_class', [Poller, Inotify])
+def test_watcher(tmp_path, watcher_class):
+    if watcher_class is Inotify and not Inotify.available():
+        pytest.skip('inotify is not available')
+    (tmp_path / 'old').write_bytes(b'old')
+    watcher = watcher_class(tmp_path, settle=0.05)
+    try:
+        assert watcher.poll() == []
+        sleep(0.1)
+        assert watcher.poll() == [tmp_path / 'old']
+        (tmp_path / 'sub').mkdir()
+        (tmp_path / 'sub' / 'new').write_bytes(b'new')
+        assert watcher.poll() == []
+        sleep(0.1)
+        assert watcher.poll() == [tmp_path / 'sub' / 'new']
+        sleep(0.1)
+        assert watcher.poll() == []
+    finally:
+        watcher.close()
+
+
+@pytest.mark.asyncio
+class TestOverwriteWatch(CellarTests):
+    cellar_class = OverwritePathCellar
+    poll = False
+
+    async def wait_for(self, condition, timeout=5):
+        started = monotonic()
+        while not condition():
+            assert monotonic() - started < timeout
+            await asyncio.sleep(0.02)
+
+    def encrypted(self, path):
+        return path.exists() and path.read_bytes() != b'plaintext'
+
+    def files(self, directory):
+        return sorted(path for path in directory.rglob('*') if path.is_file())
+
+    async def test_watch(self, tmp_path):
+        cellar = self.cellar
+        stop = asyncio.Event()
+        (tmp_path / 'before').write_bytes(b'plaintext')
+        task = asyncio.ensure_future(cellar.watch(tmp_path, 0.02, 0.05, self.poll, stop))
+        await self.wait_for(lambda: len(self.files(tmp_path)) == 1 and self.encrypted(self.files(tmp_path)[0]))
+
+        (tmp_path / 'level2').mkdir()
+        (tmp_path / 'level2' / 'after').write_bytes(b'plaintext')
+        await self.wait_for(lambda: len(self.files(tmp_path)) == 2 and all(map(self.encrypted, self.files(tmp_path))))
+        ciphertexts = {path: path.read_bytes() for path in self.files(tmp_path)}
+
+        # ciphertext is never encrypted twice
+        await asyncio.sleep(0.2)
+        stop.set()
+        await task
+        assert {path: path.read_bytes() for path in self.files(tmp_path)} == ciphertexts
+        for path in ciphertexts:
+            assert await cellar.is_encrypted(path)
+
+
+class TestPolledOverwriteWatch(TestOverwriteWatch):
+    poll = True
+
+
+class TestEncryptedPathWatch(TestOverwriteWatch):
+    cellar_class = EncryptedPathCellar
+
+    def encrypted(self, path):
+        return path.name.startswith(self.cellar_class.prefix)
+
+
+class TestPolledEncryptedPathWatch(TestEncryptedPathWatch):
+    poll = True